@@ -13,6 +13,10 @@ dbutils.widgets.text("min_dbr_version", "12.2", "Min required DBR version")
 
 # COMMAND ----------
 
+# MAGIC %run ./03-dataset-downloader
+
+# COMMAND ----------
+
 import requests
 import collections
 import os
@@ -49,13 +53,7 @@ class DBDemos():
       try:
         spark.sql(f"GRANT CREATE, USAGE on DATABASE `{catalog}`.`{db}` TO `account users`")
         spark.sql(f"ALTER SCHEMA `{catalog}`.`{db}` OWNER TO `account users`")
-        for t in spark.sql(f'SHOW TABLES in {catalog}.{db}').collect():
-          try:
-            spark.sql(f'GRANT ALL PRIVILEGES ON TABLE {catalog}.{db}.{t["tableName"]} TO `account users`')
-            spark.sql(f'ALTER TABLE {catalog}.{db}.{t["tableName"]} OWNER TO `account users`')
-          except Exception as e:
-            if "NOT_IMPLEMENTED.TRANSFER_MATERIALIZED_VIEW_OWNERSHIP" not in str(e) and "STREAMING_TABLE_OPERATION_NOT_ALLOWED.UNSUPPORTED_OPERATION" not in str(e) :
-              print(f'WARN: Couldn t set table {catalog}.{db}.{t["tableName"]} owner to account users, error: {e}')
+        DBDemos.apply_table_permissions(catalog, db)
       except Exception as e:
         print("Couldn't grant access to the schema to all users:"+str(e))    
 
@@ -65,6 +63,47 @@ class DBDemos():
     if volume_name:
       spark.sql(f'CREATE VOLUME IF NOT EXISTS {volume_name};')
 
+
+  #Grant ALL PRIVILEGES and ownership on all the schema tables to the principal.
+  #Existing grants/owners are read from the information_schema and only the missing statements are sent, in parallel.
+  #With dry_run=True, nothing is executed and the planned statements are returned.
+  @staticmethod
+  def apply_table_permissions(catalog, db, principal = "account users", dry_run = False, max_workers = 8):
+    import time
+    from concurrent.futures import ThreadPoolExecutor
+    timings = {}
+    start = time.time()
+    tables = spark.sql(f"""SELECT table_name, table_owner FROM `{catalog}`.information_schema.tables WHERE table_schema = '{db}'""").collect()
+    grants = spark.sql(f"""SELECT table_name, privilege_type FROM `{catalog}`.information_schema.table_privileges
+                           WHERE table_schema = '{db}' AND grantee = '{principal}' AND privilege_type = 'ALL PRIVILEGES'""").collect()
+    timings['list_existing'] = time.time() - start
+
+    start = time.time()
+    granted = {g['table_name'] for g in grants}
+    statements = []
+    for t in tables:
+      table = f"`{catalog}`.`{db}`.`{t['table_name']}`"
+      if t['table_name'] not in granted:
+        statements.append(f"GRANT ALL PRIVILEGES ON TABLE {table} TO `{principal}`")
+      if t['table_owner'] != principal:
+        statements.append(f"ALTER TABLE {table} OWNER TO `{principal}`")
+    timings['plan'] = time.time() - start
+    if dry_run:
+      return statements
+
+    def run_statement(statement):
+      try:
+        spark.sql(statement)
+      except Exception as e:
+        if "NOT_IMPLEMENTED.TRANSFER_MATERIALIZED_VIEW_OWNERSHIP" not in str(e) and "STREAMING_TABLE_OPERATION_NOT_ALLOWED.UNSUPPORTED_OPERATION" not in str(e) :
+          print(f'WARN: Couldn t run {statement}, error: {e}')
+    start = time.time()
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+      collections.deque(executor.map(run_statement, statements))
+    timings['apply'] = time.time() - start
+    print(f"{len(statements)} permission statements applied on {len(tables)} tables in `{catalog}`.`{db}` - " +
+          ", ".join([f"{phase}: {duration:.1f}s" for phase, duration in timings.items()]))
+    return statements
                      
   #Return true if the folder is empty or does not exists
   @staticmethod
@@ -100,37 +139,11 @@ class DBDemos():
                               c.PermissionsChange(add=[c.Privilege[permission]], principal=principal)])
     
 
+  #Files already downloaded and unchanged are skipped. Mirrors are tried in order (see DatasetDownloader), use local_dir for offline tests
   @staticmethod
-  def download_file_from_git(dest, owner, repo, path):
-    def download_file(url, destination):
-      local_filename = url.split('/')[-1]
-      # NOTE the stream=True parameter below
-      with requests.get(url, stream=True) as r:
-        r.raise_for_status()
-        print('saving '+destination+'/'+local_filename)
-        with open(destination+'/'+local_filename, 'wb') as f:
-          for chunk in r.iter_content(chunk_size=8192): 
-            # If you have chunk encoded response uncomment if
-            # and set chunk_size parameter to None.
-            #if chunk: 
-            f.write(chunk)
-      return local_filename
-
-    if not os.path.exists(dest):
-      os.makedirs(dest)
-    from concurrent.futures import ThreadPoolExecutor
-    files = requests.get(f'https://api.github.com/repos/{owner}/{repo}/contents{path}').json()
-    files = [f['download_url'] for f in files if 'NOTICE' not in f['name']]
-    def download_to_dest(url):
-      try:
-        #Temporary fix to avoid hitting github limits - Swap github to our S3 bucket to download files
-        s3url = url.replace("https://raw.githubusercontent.com/databricks-demos/dbdemos-dataset/main/", "https://notebooks.databricks.com/demos/dbdemos-dataset/")
-        download_file(s3url, dest)
-      except:
-        download_file(url, dest)
-    with ThreadPoolExecutor(max_workers=10) as executor:
-      collections.deque(executor.map(download_to_dest, files))
-         
+  def download_file_from_git(dest, owner, repo, path, mirrors = None, local_dir = None, max_workers = 10):
+    return DatasetDownloader(mirrors, local_dir, max_workers).download_folder(dest, owner, repo, path)
+
 
   #force the experiment to the field demos one. Required to launch as a batch
   @staticmethod
@@ -194,16 +207,22 @@ class DBDemos():
       print(f"All stream stopped {'' if len(start_with) == 0 else f'(starting with: {start_with}.)'}")
 
   @staticmethod
-  def wait_for_all_stream(start = ""):
-    import time
+  def wait_for_all_stream(start = "", timeout = None):
     actives = DBDemos.get_active_streams(start)
     if len(actives) > 0:
       print(f"{len(actives)} streams still active, waiting... ({[s.name for s in actives]})")
-    while len(actives) > 0:
-      spark.streams.awaitAnyTermination()
-      time.sleep(1)
-      actives = DBDemos.get_active_streams(start)
+    if not stream_waiter.wait_until(lambda: len(DBDemos.get_active_streams(start)) == 0, timeout):
+      raise TimeoutError(f"Streams still active after {timeout} sec: {[s.name for s in DBDemos.get_active_streams(start)]}")
     print("All streams completed.")
+    print(stream_waiter.progress_report().to_string(index=False))
+
+  #Return as soon as the table exists and has data (woken up on each batch committed by the streams of this notebook)
+  @staticmethod
+  def wait_for_table(table_name, timeout_duration=120):
+    def table_ready():
+      return spark.catalog.tableExists(table_name) and spark.table(table_name).limit(1).count() > 0
+    if not stream_waiter.wait_until(table_ready, timeout_duration, poll_interval=1):
+      raise Exception(f"couldn't find table {table_name} or table is empty. Do you have data being generated to be consumed?")
 
   @staticmethod
   def get_last_experiment(demo_name, experiment_path = "/Shared/dbdemos/experiments/"):
@@ -241,6 +260,113 @@ class DBDemos():
 
 # COMMAND ----------
 
+import threading
+import time
+import pandas as pd
+from pyspark.sql.streaming import StreamingQueryListener
+
+#Collect the streams progress and wake up the waiting functions on each stream event (batch committed, stream terminated) instead of polling with fixed sleeps
+class StreamWaiter(StreamingQueryListener):
+  def __init__(self):
+    self.condition = threading.Condition()
+    self.events = 0
+    self.stats = {}
+    self.terminated = {}
+    #Input rows and termination of each run (the query id is kept across runs of the same checkpoint, the run id isn't)
+    self.run_rows = {}
+    self.terminated_runs = set()
+    #False until spark.streams.addListener succeeds (it can fail, ex: on shared or serverless compute): no event will be received
+    self.registered = False
+
+  def onQueryStarted(self, event):
+    pass
+
+  def onQueryProgress(self, event):
+    p = event.progress
+    with self.condition:
+      s = self.stats.setdefault(str(p.id), {"name": p.name, "batches": 0, "committed_batches": 0, "rows": 0, "duration_ms": 0, "last_rows_per_sec": 0.0, "last_batch_ms": 0})
+      batch_ms = p.durationMs.get("triggerExecution", 0)
+      s["batches"] += 1
+      s["rows"] += p.numInputRows
+      self.run_rows[str(p.runId)] = self.run_rows.get(str(p.runId), 0) + p.numInputRows
+      s["duration_ms"] += batch_ms
+      s["last_batch_ms"] = batch_ms
+      s["last_rows_per_sec"] = p.processedRowsPerSecond
+      if p.numInputRows > 0:
+        s["committed_batches"] += 1
+      self.events += 1
+      self.condition.notify_all()
+
+  def onQueryIdle(self, event):
+    pass
+
+  def onQueryTerminated(self, event):
+    with self.condition:
+      self.terminated[str(event.id)] = event.exception
+      self.terminated_runs.add(str(event.runId))
+      self.events += 1
+      self.condition.notify_all()
+
+  #Block until predicate() is true, re-evaluating it after each stream event. Tables written by other notebooks don't send events here, so we also re-check every poll_interval sec.
+  def wait_until(self, predicate, timeout = None, poll_interval = 5):
+    deadline = None if timeout is None else time.time() + timeout
+    while True:
+      with self.condition:
+        events_seen = self.events
+      if predicate():
+        return True
+      remaining = poll_interval if deadline is None else min(poll_interval, deadline - time.time())
+      if remaining <= 0:
+        return False
+      with self.condition:
+        if self.events == events_seen:
+          self.condition.wait(remaining)
+
+  #Signal sent on the first batch committed by the given query (or the min_batches first ones)
+  def wait_for_first_batch(self, query, timeout = None, min_batches = 1):
+    def committed():
+      with self.condition:
+        return self.stats.get(str(query.id), {}).get("committed_batches", 0) >= min_batches or str(query.id) in self.terminated
+    return self.wait_until(committed, timeout)
+
+  #Total input rows of a finished query run. The events are received asynchronously: wait for the termination event of the run (usually already there)
+  #Falls back to the query recentProgress (last 100 micro-batches only) if the listener isn't registered or didn't receive it
+  def run_input_rows(self, query, timeout = 10):
+    run_id = str(query.runId)
+    def run_terminated():
+      with self.condition:
+        return run_id in self.terminated_runs
+    if not self.registered or not (run_terminated() or self.wait_until(run_terminated, timeout, poll_interval=1)):
+      return sum(p["numInputRows"] for p in query.recentProgress)
+    with self.condition:
+      return self.run_rows.get(run_id, 0)
+
+  def progress_report(self):
+    with self.condition:
+      return pd.DataFrame([{"stream": s["name"] or query_id,
+                            "batches": s["batches"],
+                            "input_rows": s["rows"],
+                            "avg_rows_per_sec": s["rows"] / (s["duration_ms"] / 1000) if s["duration_ms"] > 0 else 0.0,
+                            "last_rows_per_sec": s["last_rows_per_sec"],
+                            "avg_batch_duration_ms": s["duration_ms"] / s["batches"],
+                            "last_batch_duration_ms": s["last_batch_ms"],
+                            "terminated": query_id in self.terminated} for query_id, s in self.stats.items()])
+
+#Re-running the setup shouldn't stack listeners
+if "stream_waiter" in globals():
+  try:
+    spark.streams.removeListener(stream_waiter)
+  except Exception:
+    pass
+stream_waiter = StreamWaiter()
+try:
+  spark.streams.addListener(stream_waiter)
+  stream_waiter.registered = True
+except Exception as e:
+  print(f"WARN: couldn't register the stream listener, waiting for streams will fall back to polling: {e}")
+
+# COMMAND ----------
+
 #Let's skip some warnings for cleaner output
 import warnings
 warnings.filterwarnings("ignore")
@@ -257,25 +257,106 @@ def stop_all_streams(start_with = "", sleep_time=0):
             pass
     print(f"All stream stopped {'' if len(start_with) == 0 else f'(starting with: {start_with}.)'}")
     
-def wait_for_all_stream(start = ""):
-  import time
+def wait_for_all_stream(start = "", timeout = None):
   actives = get_active_streams(start)
   if len(actives) > 0:
     print(f"{len(actives)} streams still active, waiting... ({[s.name for s in actives]})")
-  while len(actives) > 0:
-    spark.streams.awaitAnyTermination()
-    time.sleep(1)
-    actives = get_active_streams(start)
+  if not stream_waiter.wait_until(lambda: len(get_active_streams(start)) == 0, timeout):
+    raise TimeoutError(f"Streams still active after {timeout} sec: {[s.name for s in get_active_streams(start)]}")
   print("All streams completed.")
-  
+  print(stream_waiter.progress_report().to_string(index=False))
+
+#Return as soon as the table exists and has data (woken up on each batch committed by the streams of this notebook)
 def wait_for_table(table_name, timeout_duration=120):
-  import time
-  i = 0
-  while not spark._jsparkSession.catalog().tableExists(table_name) or spark.table(table_name).count() == 0:
-    time.sleep(1)
-    if i > timeout_duration:
-      raise Exception(f"couldn't find table {table_name} or table is empty. Do you have data being generated to be consumed?")
-    i += 1
+  def table_ready():
+    return spark._jsparkSession.catalog().tableExists(table_name) and spark.table(table_name).limit(1).count() > 0
+  if not stream_waiter.wait_until(table_ready, timeout_duration, poll_interval=1):
+    raise Exception(f"couldn't find table {table_name} or table is empty. Do you have data being generated to be consumed?")
+
+# COMMAND ----------
+
+import threading
+from pyspark.sql.streaming import StreamingQueryListener
+
+#Collect the streams progress and wake up the waiting functions on each stream event (batch committed, stream terminated) instead of polling with fixed sleeps
+class StreamWaiter(StreamingQueryListener):
+  def __init__(self):
+    self.condition = threading.Condition()
+    self.events = 0
+    self.stats = {}
+    self.terminated = {}
+
+  def onQueryStarted(self, event):
+    pass
+
+  def onQueryProgress(self, event):
+    p = event.progress
+    with self.condition:
+      s = self.stats.setdefault(str(p.id), {"name": p.name, "batches": 0, "committed_batches": 0, "rows": 0, "duration_ms": 0, "last_rows_per_sec": 0.0, "last_batch_ms": 0})
+      batch_ms = p.durationMs.get("triggerExecution", 0)
+      s["batches"] += 1
+      s["rows"] += p.numInputRows
+      s["duration_ms"] += batch_ms
+      s["last_batch_ms"] = batch_ms
+      s["last_rows_per_sec"] = p.processedRowsPerSecond
+      if p.numInputRows > 0:
+        s["committed_batches"] += 1
+      self.events += 1
+      self.condition.notify_all()
+
+  def onQueryIdle(self, event):
+    pass
+
+  def onQueryTerminated(self, event):
+    with self.condition:
+      self.terminated[str(event.id)] = event.exception
+      self.events += 1
+      self.condition.notify_all()
+
+  #Block until predicate() is true, re-evaluating it after each stream event. Tables written by other notebooks don't send events here, so we also re-check every poll_interval sec.
+  def wait_until(self, predicate, timeout = None, poll_interval = 5):
+    deadline = None if timeout is None else time.time() + timeout
+    while True:
+      with self.condition:
+        events_seen = self.events
+      if predicate():
+        return True
+      remaining = poll_interval if deadline is None else min(poll_interval, deadline - time.time())
+      if remaining <= 0:
+        return False
+      with self.condition:
+        if self.events == events_seen:
+          self.condition.wait(remaining)
+
+  #Signal sent on the first batch committed by the given query (or the min_batches first ones)
+  def wait_for_first_batch(self, query, timeout = None, min_batches = 1):
+    def committed():
+      with self.condition:
+        return self.stats.get(str(query.id), {}).get("committed_batches", 0) >= min_batches or str(query.id) in self.terminated
+    return self.wait_until(committed, timeout)
+
+  def progress_report(self):
+    with self.condition:
+      return pd.DataFrame([{"stream": s["name"] or query_id,
+                            "batches": s["batches"],
+                            "input_rows": s["rows"],
+                            "avg_rows_per_sec": s["rows"] / (s["duration_ms"] / 1000) if s["duration_ms"] > 0 else 0.0,
+                            "last_rows_per_sec": s["last_rows_per_sec"],
+                            "avg_batch_duration_ms": s["duration_ms"] / s["batches"],
+                            "last_batch_duration_ms": s["last_batch_ms"],
+                            "terminated": query_id in self.terminated} for query_id, s in self.stats.items()])
+
+#Re-running the setup shouldn't stack listeners
+if "stream_waiter" in globals():
+  try:
+    spark.streams.removeListener(stream_waiter)
+  except Exception:
+    pass
+stream_waiter = StreamWaiter()
+try:
+  spark.streams.addListener(stream_waiter)
+except Exception as e:
+  print(f"WARN: couldn't register the stream listener, waiting for streams will fall back to polling: {e}")
 
 # COMMAND ----------
 
@@ -415,38 +496,13 @@ with warnings.catch_warnings():
 
 # COMMAND ----------
 
+# MAGIC %run ./03-dataset-downloader
+
+# COMMAND ----------
+
 import requests
 import collections
 import os
-def download_file(url, destination):
-    local_filename = url.split('/')[-1]
-    # NOTE the stream=True parameter below
-    with requests.get(url, stream=True) as r:
-        r.raise_for_status()
-        print('saving '+destination+'/'+local_filename)
-        with open(destination+'/'+local_filename, 'wb') as f:
-            for chunk in r.iter_content(chunk_size=8192): 
-                # If you have chunk encoded response uncomment if
-                # and set chunk_size parameter to None.
-                #if chunk: 
-                f.write(chunk)
-    return local_filename
-  
-def download_file_from_git(dest, owner, repo, path):
-    if not os.path.exists(dest):
-      os.makedirs(dest)
-    from concurrent.futures import ThreadPoolExecutor
-    files = requests.get(f'https://api.github.com/repos/{owner}/{repo}/contents{path}').json()
-    files = [f['download_url'] for f in files if 'NOTICE' not in f['name']]
-    def download_to_dest(url):
-        try:
-            #Temporary fix to avoid hitting github limits - Swap github to our S3 bucket to download files
-            s3url = url.replace("https://raw.githubusercontent.com/databricks-demos/dbdemos-dataset/main/", "https://notebooks.databricks.com/demos/dbdemos-dataset/")
-            download_file(s3url, dest)
-        except:
-            download_file(url, dest)
-    with ThreadPoolExecutor(max_workers=10) as executor:
-        collections.deque(executor.map(download_to_dest, files))
 
 # COMMAND ----------
 
@@ -0,0 +1,184 @@
+# Databricks notebook source
+# MAGIC %md
+# MAGIC
+# MAGIC # Load test helpers. Hide this cell results
+# MAGIC Replay requests against a model serving endpoint (or any http app) with asyncio, at a target QPS or concurrency, and save the latency percentiles, error rate and throughput in a Delta table.
+# MAGIC
+# MAGIC Use `start_load_test_stub()` to run the load test against a local FastAPI stub endpoint (offline tests, requires `fastapi` and `uvicorn`). The http client uses `aiohttp`.
+# MAGIC
+# MAGIC Do not edit
+
+# COMMAND ----------
+
+import asyncio
+import itertools
+import random
+import time
+import uuid
+import numpy as np
+import pandas as pd
+from concurrent.futures import ThreadPoolExecutor
+
+#Send the payloads to the url and record the latency of each request.
+# - qps: open loop, the requests are sent at the target rate whatever the endpoint latency (max_in_flight requests at most)
+# - concurrency: closed loop, each of the `concurrency` workers sends its next request as soon as it gets the previous answer
+#send can be replaced by another coroutine send(payload) returning the http status, ex: to plug another transport in tests
+class EndpointLoadTester():
+  def __init__(self, url, headers = None, timeout = 120, max_in_flight = 500, send = None):
+    self.url = url
+    self.headers = headers or {}
+    self.timeout = timeout
+    self.max_in_flight = max_in_flight
+    self.send = send
+
+  async def send_http(self, session, payload):
+    async with session.post(self.url, json=payload, headers=self.headers) as response:
+      await response.read()
+      return response.status
+
+  async def timed_request(self, send, payload, scheduled_at, start_time, results):
+    start = time.time()
+    status, error = None, None
+    try:
+      status = await send(payload)
+      if status >= 400:
+        error = f"http {status}"
+    except Exception as e:
+      error = f"{type(e).__name__}: {e}"[:500]
+    results.append({"offset_sec": start - start_time, "lag_ms": (start - scheduled_at) * 1000, "latency_ms": (time.time() - start) * 1000, "status": status, "error": error})
+
+  async def run_async(self, payloads, qps = None, concurrency = None, duration_sec = 60, max_requests = None):
+    session = None
+    send = self.send
+    if send is None:
+      import aiohttp
+      #Pooled connections, one per request in flight
+      session = aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=concurrency or self.max_in_flight), timeout=aiohttp.ClientTimeout(total=self.timeout))
+      send = lambda payload: self.send_http(session, payload)
+    results = []
+    payload_cycle = itertools.cycle(payloads)
+    start_time = time.time()
+    end_time = start_time + duration_sec
+    try:
+      if qps is not None:
+        in_flight = asyncio.Semaphore(self.max_in_flight)
+        async def limited_request(payload, scheduled_at):
+          async with in_flight:
+            await self.timed_request(send, payload, scheduled_at, start_time, results)
+        tasks = []
+        for i in itertools.count():
+          scheduled_at = start_time + i / qps
+          if scheduled_at >= end_time or (max_requests is not None and i >= max_requests):
+            break
+          await asyncio.sleep(max(0, scheduled_at - time.time()))
+          tasks.append(asyncio.ensure_future(limited_request(next(payload_cycle), scheduled_at)))
+        await asyncio.gather(*tasks)
+      else:
+        sent = itertools.count()
+        async def worker():
+          while time.time() < end_time and (max_requests is None or next(sent) < max_requests):
+            await self.timed_request(send, next(payload_cycle), time.time(), start_time, results)
+        await asyncio.gather(*[worker() for _ in range(concurrency or 1)])
+    finally:
+      if session is not None:
+        await session.close()
+    return results, time.time() - start_time
+
+  #Run the load test, returns the summary (dict) and the details of each request (pandas DataFrame)
+  def run(self, payloads, qps = None, concurrency = None, duration_sec = 60, max_requests = None, name = None):
+    assert (qps is None) != (concurrency is None), "set either qps or concurrency"
+    assert len(payloads) > 0, "no payload to send"
+    #Notebooks already run an event loop: run the load test in its own loop
+    with ThreadPoolExecutor(max_workers=1) as executor:
+      results, elapsed = executor.submit(asyncio.run, self.run_async(payloads, qps, concurrency, duration_sec, max_requests)).result()
+    requests_df = pd.DataFrame(results, columns=["offset_sec", "lag_ms", "latency_ms", "status", "error"])
+    summary = EndpointLoadTester.summarize(requests_df, elapsed)
+    summary.update({"test_id": str(uuid.uuid4()), "name": name or self.url, "url": self.url, "target_qps": qps, "concurrency": concurrency,
+                    "duration_sec": round(elapsed, 2), "timestamp": pd.Timestamp.now(tz="UTC").tz_localize(None)})
+    requests_df.insert(0, "test_id", summary["test_id"])
+    return summary, requests_df
+
+  @staticmethod
+  def summarize(requests_df, elapsed):
+    ok = requests_df[requests_df["error"].isnull()]
+    latencies = ok["latency_ms"].to_numpy()
+    percentile = lambda p: round(float(np.percentile(latencies, p)), 1) if len(latencies) > 0 else None
+    return {"requests": len(requests_df), "errors": len(requests_df) - len(ok),
+            "error_rate": round((len(requests_df) - len(ok)) / len(requests_df), 4) if len(requests_df) > 0 else None,
+            "throughput_rps": round(len(ok) / elapsed, 2) if elapsed > 0 else None,
+            "p50_ms": percentile(50), "p95_ms": percentile(95), "p99_ms": percentile(99),
+            "mean_ms": round(float(latencies.mean()), 1) if len(latencies) > 0 else None,
+            "max_ms": round(float(latencies.max()), 1) if len(latencies) > 0 else None,
+            "max_lag_ms": round(float(requests_df["lag_ms"].max()), 1) if len(requests_df) > 0 else None}
+
+#Load tester for a model serving endpoint of the current workspace, or of another server with the same api (ex: base_url of the local stub)
+def serving_endpoint_load_tester(endpoint_name, base_url = None, **kwargs):
+  if base_url is not None:
+    return EndpointLoadTester(f"{base_url}/serving-endpoints/{endpoint_name}/invocations", **kwargs)
+  from databricks.sdk import WorkspaceClient
+  config = WorkspaceClient().config
+  return EndpointLoadTester(f"{config.host}/serving-endpoints/{endpoint_name}/invocations", headers=config.authenticate(), **kwargs)
+
+LOAD_TEST_SUMMARY_SCHEMA = """test_id STRING, name STRING, url STRING, timestamp TIMESTAMP, target_qps DOUBLE, concurrency INT, duration_sec DOUBLE, requests INT, errors INT,
+                               error_rate DOUBLE, throughput_rps DOUBLE, p50_ms DOUBLE, p95_ms DOUBLE, p99_ms DOUBLE, mean_ms DOUBLE, max_ms DOUBLE, max_lag_ms DOUBLE"""
+LOAD_TEST_REQUESTS_SCHEMA = "test_id STRING, offset_sec DOUBLE, lag_ms DOUBLE, latency_ms DOUBLE, status INT, error STRING"
+
+#Append the summary to the results table, and the details of each request to <results_table>_requests
+def save_load_test_results(summary, requests_df, results_table = "load_test_results"):
+  row = dict(summary, target_qps=float(summary["target_qps"]) if summary["target_qps"] is not None else None)
+  columns = [c.strip().split(" ")[0] for c in LOAD_TEST_SUMMARY_SCHEMA.split(",")]
+  spark.createDataFrame([tuple(row[c] for c in columns)], LOAD_TEST_SUMMARY_SCHEMA).write.mode("append").saveAsTable(results_table)
+  if requests_df is not None and len(requests_df) > 0:
+    rows = [(r.test_id, float(r.offset_sec), float(r.lag_ms), float(r.latency_ms), int(r.status) if pd.notnull(r.status) else None, r.error if pd.notnull(r.error) else None)
+            for r in requests_df.itertuples()]
+    spark.createDataFrame(rows, LOAD_TEST_REQUESTS_SCHEMA).write.mode("append").saveAsTable(f"{results_table}_requests")
+  print(f"load test {summary['name']}: {summary['requests']} requests, error rate {summary['error_rate']}, {summary['throughput_rps']} req/s, "
+        f"p50 {summary['p50_ms']}ms, p95 {summary['p95_ms']}ms, p99 {summary['p99_ms']}ms. Results saved in {results_table}")
+
+# COMMAND ----------
+
+#Local FastAPI app answering like a serving endpoint (chat completion for messages, one prediction per record otherwise), with a random latency and error rate
+def create_load_test_stub_app(latency_ms = 50, jitter_ms = 20, error_rate = 0.01):
+  from fastapi import FastAPI, Request
+  from fastapi.responses import JSONResponse
+  app = FastAPI()
+
+  @app.post("/serving-endpoints/{endpoint_name}/invocations")
+  async def invocations(endpoint_name: str, request: Request):
+    body = await request.json()
+    await asyncio.sleep(max(0, random.gauss(latency_ms, jitter_ms)) / 1000)
+    if random.random() < error_rate:
+      return JSONResponse({"error_code": "TEMPORARILY_UNAVAILABLE", "message": "stub error"}, status_code=503)
+    if "messages" in body:
+      return {"choices": [{"index": 0, "message": {"role": "assistant", "content": f"stub answer from {endpoint_name}"}}]}
+    return {"predictions": [0] * len(body.get("dataframe_records", body.get("inputs", [None])))}
+  return app
+
+#Stubs already running in this notebook, by settings: re-running the notebook reuses them instead of starting new servers
+load_test_stubs = globals().get("load_test_stubs", {})
+
+#Start the stub in a background thread. Returns (server, base url); set server.should_exit = True to stop it
+#port = 0 binds a free port (the returned url has the real one), so several notebooks can run their own stub at the same time
+def start_load_test_stub(port = 0, timeout = 30, **kwargs):
+  import threading
+  import uvicorn
+  key = (port, tuple(sorted(kwargs.items())))
+  if key in load_test_stubs:
+    server, thread, url = load_test_stubs[key]
+    if thread.is_alive() and not server.should_exit:
+      return server, url
+  server = uvicorn.Server(uvicorn.Config(create_load_test_stub_app(**kwargs), host="127.0.0.1", port=port, log_level="warning"))
+  thread = threading.Thread(target=server.run, daemon=True)
+  thread.start()
+  deadline = time.time() + timeout
+  while not server.started:
+    #uvicorn exits its thread when the startup fails (ex: port already in use)
+    if not thread.is_alive():
+      raise RuntimeError(f"The load test stub couldn't start on port {port}, is the port already in use? Use port=0 to bind a free port")
+    if time.time() > deadline:
+      server.should_exit = True
+      raise TimeoutError(f"The load test stub didn't start in {timeout} sec")
+    time.sleep(0.1)
+  url = f"http://127.0.0.1:{server.servers[0].sockets[0].getsockname()[1]}"
+  load_test_stubs[key] = (server, thread, url)
+  return server, url
@@ -0,0 +1,155 @@
+# Databricks notebook source
+# MAGIC %md
+# MAGIC
+# MAGIC # Fake data helpers. Hide this cell results
+# MAGIC Vectorized column generators for the demo data generators, replacing the row-level Faker UDFs (one python call per row and column):
+# MAGIC
+# MAGIC - names, emails, addresses, dates in a range, weighted choices and nullable UUIDs are pure Spark expressions. The values are picked in pools pre-sampled once with Faker and the random draws (`rand(seed)`) are seeded per partition by Spark: the same partitioning generates the same data.
+# MAGIC - `fake_pool_udf` wraps any other Faker method as an Arrow `pandas_udf`: each partition samples its own pool with a Faker seeded with the partition id, then draws the values with numpy.
+# MAGIC
+# MAGIC Requires `Faker` (`%pip install Faker`). Do not edit
+
+# COMMAND ----------
+
+import datetime
+import itertools
+import time
+import numpy as np
+import pandas as pd
+import pyspark.sql.functions as F
+from typing import Iterator
+from faker import Faker
+
+#Each generator gets its own seed (otherwise 2 columns would draw the same random sequence). Call set_fake_data_seed to replay the same data.
+fake_data_seeds = itertools.count(0)
+
+def set_fake_data_seed(seed):
+  global fake_data_seeds
+  fake_data_seeds = itertools.count(seed * 1000)
+  Faker.seed(seed)
+
+def next_fake_data_seed(seed = None):
+  return next(fake_data_seeds) if seed is None else seed
+
+#Sample a pool of values on the driver, ex: fake_pool(lambda f: f.first_name())
+def fake_pool(generate, size = 1000, seed = None):
+  fake = Faker()
+  fake.seed_instance(next_fake_data_seed(seed))
+  return [generate(fake) for _ in range(size)]
+
+#Uniform choice in the list of values
+def random_element(values, seed = None):
+  values = list(values)
+  index = (F.rand(next_fake_data_seed(seed)) * len(values)).cast("int") + 1
+  return F.element_at(F.array(*[F.lit(v) for v in values]), index)
+
+#Weighted choice, ex: weighted_choice({"APPEND": 0.5, "DELETE": 0.1, "UPDATE": 0.3, None: 0.01}). The weights don't have to sum to 1
+def weighted_choice(weights, seed = None):
+  r = F.rand(next_fake_data_seed(seed)) * float(sum(weights.values()))
+  column = None
+  for value, threshold in zip(weights.keys(), itertools.accumulate(weights.values())):
+    column = F.when(r < threshold, F.lit(value)) if column is None else column.when(r < threshold, F.lit(value))
+  return column
+
+def fake_first_name(seed = None, pool_size = 1000):
+  seed = next_fake_data_seed(seed)
+  return random_element(fake_pool(lambda f: f.first_name(), pool_size, seed), seed)
+
+def fake_last_name(seed = None, pool_size = 1000):
+  seed = next_fake_data_seed(seed)
+  return random_element(fake_pool(lambda f: f.last_name(), pool_size, seed), seed)
+
+#Same shape as Faker ascii_company_email (ex: jsmith@company.com), combining a name pool and a domain pool
+def fake_email(seed = None, pool_size = 1000):
+  seed = next_fake_data_seed(seed)
+  user = F.lower(F.concat(F.substring(fake_first_name(seed * 10 + 1, pool_size), 1, 1), fake_last_name(seed * 10 + 2, pool_size)))
+  return F.concat(F.regexp_replace(user, "[^a-z]", ""), F.lit("@"), random_element(fake_pool(lambda f: f.domain_name(), pool_size, seed * 10 + 3), seed * 10 + 3))
+
+#Same shape as Faker address (street, city, state and zipcode), on one line if single_line
+def fake_address(single_line = False, seed = None, pool_size = 1000):
+  seed = next_fake_data_seed(seed)
+  street = random_element(fake_pool(lambda f: f.street_address(), pool_size, seed * 10 + 1), seed * 10 + 1)
+  city = random_element(fake_pool(lambda f: f.city(), pool_size, seed * 10 + 2), seed * 10 + 2)
+  state = random_element(fake_pool(lambda f: f.state_abbr(), 50, seed * 10 + 3), seed * 10 + 3)
+  zipcode = F.lpad((F.rand(seed * 10 + 4) * 100000).cast("int").cast("string"), 5, "0")
+  return F.concat(street, F.lit(" " if single_line else "\n"), city, F.lit(", "), state, F.lit(" "), zipcode)
+
+#Uniform date between start and end (datetime), formatted with a Spark datetime pattern (ex: "MM-dd-yyyy HH:mm:ss") or as a timestamp if format is None
+def fake_date_between(start, end, format = None, seed = None):
+  start_ts, end_ts = start.timestamp(), end.timestamp()
+  date = F.timestamp_seconds((F.lit(start_ts) + F.rand(next_fake_data_seed(seed)) * (end_ts - start_ts)).cast("long"))
+  return date if format is None else F.date_format(date, format)
+
+#Between the beginning of the month and now, like Faker date_time_this_month
+def fake_date_this_month(format = None, seed = None):
+  now = datetime.datetime.now()
+  return fake_date_between(now.replace(day=1, hour=0, minute=0, second=0, microsecond=0), now, format, seed)
+
+#UUID built from a hash of the seed, partition and row position (reproducible for the same partitioning), null with the probability null_rate
+def fake_uuid(null_rate = 0.0, seed = None):
+  seed = next_fake_data_seed(seed)
+  h = F.md5(F.concat_ws("-", F.lit(seed), F.spark_partition_id(), F.monotonically_increasing_id()))
+  uuid = F.concat_ws("-", F.substring(h, 1, 8), F.substring(h, 9, 4), F.substring(h, 13, 4), F.substring(h, 17, 4), F.substring(h, 21, 12))
+  return uuid if null_rate <= 0 else F.when(F.rand(seed) >= null_rate, uuid)
+
+#Any other Faker method as an Arrow pandas_udf, ex: fake_pool_udf(lambda f: f.country_code())(F.col("id")).
+#The input column is only used for the number of rows. Each partition samples its own pool, seeded with the partition id
+def fake_pool_udf(generate, return_type = "string", pool_size = 1000, seed = None):
+  seed = next_fake_data_seed(seed)
+  @F.pandas_udf(return_type)
+  def fake_values(batches: Iterator[pd.Series]) -> Iterator[pd.Series]:
+    from pyspark import TaskContext
+    partition_seed = seed * 100000 + TaskContext.get().partitionId()
+    fake = Faker()
+    fake.seed_instance(partition_seed)
+    pool = np.array([generate(fake) for _ in range(pool_size)], dtype=object)
+    rng = np.random.default_rng(partition_seed)
+    for batch in batches:
+      yield pd.Series(pool[rng.integers(0, pool_size, len(batch))])
+  return fake_values
+
+# COMMAND ----------
+
+#Ids are allocated from a high-water mark saved in a small Delta table (state_path), so that each generated batch gets new ids, even across runs.
+#Returns the first id of the range [start, start + count)
+def allocate_ids(state_path, stream, count):
+  from delta.tables import DeltaTable
+  exists = DeltaTable.isDeltaTable(spark, state_path)
+  row = spark.read.format("delta").load(state_path).where(F.col("stream") == stream).first() if exists else None
+  start = row["next_id"] if row is not None else 0
+  state = spark.createDataFrame([(stream, start + count, datetime.datetime.now())], "stream STRING, next_id BIGINT, updated_at TIMESTAMP")
+  if not exists:
+    state.write.format("delta").mode("append").save(state_path)
+  else:
+    DeltaTable.forPath(spark, state_path).alias("t").merge(state.alias("s"), "t.stream = s.stream").whenMatchedUpdateAll().whenNotMatchedInsertAll().execute()
+  return start
+
+#Id below the high-water mark following a power law: skew = 1 is uniform, the bigger the skew the more the draws concentrate on a few hot keys (the oldest ids)
+def skewed_key(high_water_mark, skew = 1.0, seed = None):
+  return F.least(F.floor(F.pow(F.rand(next_fake_data_seed(seed)), F.lit(float(skew))) * high_water_mark), F.lit(high_water_mark - 1)).cast("bigint")
+
+# COMMAND ----------
+
+#Compare the rows/sec of the row-level Faker UDFs with the vectorized generators for the same columns (written to the noop sink)
+def benchmark_fake_data(rows = 100000, partitions = 8):
+  import uuid
+  import random
+  fake = Faker()
+  date_format = "%m-%d-%Y %H:%M:%S"
+  before = {"firstname": F.udf(fake.first_name)(), "lastname": F.udf(fake.last_name)(), "email": F.udf(fake.ascii_company_email)(),
+            "address": F.udf(fake.address)(), "creation_date": F.udf(lambda: fake.date_time_this_month().strftime(date_format))(),
+            "operation": F.udf(lambda: fake.random_elements(elements={"APPEND": 0.5, "DELETE": 0.1, "UPDATE": 0.3}, length=1)[0])(),
+            "id": F.udf(lambda: str(uuid.uuid4()) if random.uniform(0, 1) < 0.98 else None)()}
+  after = {"firstname": fake_first_name(), "lastname": fake_last_name(), "email": fake_email(), "address": fake_address(),
+           "creation_date": fake_date_this_month("MM-dd-yyyy HH:mm:ss"), "operation": weighted_choice({"APPEND": 0.5, "DELETE": 0.1, "UPDATE": 0.3}),
+           "id": fake_uuid(null_rate=0.02)}
+  results = []
+  for name, columns in [("faker udfs", before), ("vectorized", after)]:
+    df = spark.range(0, rows).repartition(partitions)
+    for column, value in columns.items():
+      df = df.withColumn(column, value)
+    start = time.time()
+    df.write.format("noop").mode("overwrite").save()
+    duration = time.time() - start
+    results.append((name, rows, round(duration, 2), round(rows / duration)))
+  return pd.DataFrame(results, columns=["generator", "rows", "duration_sec", "rows_per_sec"])
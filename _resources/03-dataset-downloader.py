@@ -0,0 +1,170 @@
+# Databricks notebook source
+# MAGIC %md
+# MAGIC
+# MAGIC # Dataset downloader. Hide this cell results
+# MAGIC Downloads the demo dataset folders (from the S3 mirror, github or a local folder), shared by the setup notebooks. Do not edit
+
+# COMMAND ----------
+
+import requests
+import collections
+import os
+
+#Download dataset folders with a pooled session, retries, resume of partial files and a local manifest to skip unchanged files.
+#Each file is fetched from the first working mirror: the notebooks.databricks.com S3 mirror, then github, then a local folder (offline tests).
+class DatasetDownloader():
+  DEFAULT_MIRRORS = ["s3", "github", "local"]
+  MANIFEST_FILE = ".dbdemos_manifest.json"
+
+  #ref: branch, tag or commit of the github repos (default branch if None)
+  def __init__(self, mirrors = None, local_dir = None, max_workers = 10, chunk_size = 1024*1024, ref = None):
+    import threading
+    from requests.adapters import HTTPAdapter
+    from urllib3.util.retry import Retry
+    self.mirrors = mirrors or DatasetDownloader.DEFAULT_MIRRORS
+    #local folder mirroring the github repos: <local_dir>/<repo>/<path>
+    self.local_dir = local_dir or os.environ.get("DBDEMOS_DATASET_LOCAL_DIR")
+    self.max_workers = max_workers
+    self.chunk_size = chunk_size
+    self.ref = ref
+    self.lock = threading.Lock()
+    #Reuse the same connections for all the files, retrying with backoff on throttling and server errors
+    retries = Retry(total=5, backoff_factor=0.5, status_forcelist=[429, 500, 502, 503, 504], allowed_methods=["GET"])
+    adapter = HTTPAdapter(pool_connections=max_workers, pool_maxsize=max_workers, max_retries=retries)
+    self.session = requests.Session()
+    self.session.mount("https://", adapter)
+    self.session.mount("http://", adapter)
+
+  #download_url: the raw url returned by the github API for the listed ref
+  def mirror_url(self, mirror, owner, repo, file_path, download_url = None):
+    if mirror == "s3":
+      return f"https://notebooks.databricks.com/demos/{repo}/{file_path}" if f"{owner}/{repo}" == "databricks-demos/dbdemos-dataset" else None
+    elif mirror == "github":
+      return download_url or f"https://raw.githubusercontent.com/{owner}/{repo}/{self.ref or 'HEAD'}/{file_path}"
+    elif mirror == "local":
+      return os.path.join(self.local_dir, repo, file_path) if self.local_dir else None
+    raise ValueError(f"Unknown mirror {mirror}, must be one of {DatasetDownloader.DEFAULT_MIRRORS}")
+
+  def list_files(self, owner, repo, path):
+    path = path.strip("/")
+    try:
+      r = self.session.get(f"https://api.github.com/repos/{owner}/{repo}/contents/{path}", params={"ref": self.ref} if self.ref else None, timeout=30)
+      r.raise_for_status()
+      return [{"name": f["name"], "path": f["path"], "size": f["size"], "sha": f["sha"], "download_url": f.get("download_url")}
+              for f in r.json() if f["type"] == "file" and "NOTICE" not in f["name"]]
+    except Exception as e:
+      folder = self.mirror_url("local", owner, repo, path)
+      if folder is None or not os.path.isdir(folder):
+        raise
+      print(f"Couldn't list {owner}/{repo}/{path} from github ({e}), listing local folder {folder} instead")
+      return [{"name": n, "path": f"{path}/{n}", "size": os.path.getsize(os.path.join(folder, n)), "sha": None, "download_url": None}
+              for n in sorted(os.listdir(folder)) if os.path.isfile(os.path.join(folder, n)) and "NOTICE" not in n]
+
+  #Same sha as the one returned by the github API for the file content
+  @staticmethod
+  def git_blob_sha(file_path):
+    import hashlib
+    sha = hashlib.sha1(f"blob {os.path.getsize(file_path)}\0".encode())
+    with open(file_path, "rb") as f:
+      for chunk in iter(lambda: f.read(1024*1024), b""):
+        sha.update(chunk)
+    return sha.hexdigest()
+
+  def load_manifest(self, dest):
+    import json
+    try:
+      with open(os.path.join(dest, DatasetDownloader.MANIFEST_FILE)) as f:
+        return json.load(f)
+    except Exception:
+      return {}
+
+  def save_manifest(self, dest, manifest):
+    import json
+    with open(os.path.join(dest, DatasetDownloader.MANIFEST_FILE), "w") as f:
+      json.dump(manifest, f)
+
+  #Download url to part_path, resuming from the existing partial file if any. Returns the etag, or None if the file didn't change (304)
+  def fetch(self, url, local_path, part_path, entry):
+    headers = {}
+    offset = os.path.getsize(part_path) if os.path.exists(part_path) else 0
+    if offset > 0:
+      headers["Range"] = f"bytes={offset}-"
+    elif os.path.exists(local_path) and entry.get("etag"):
+      headers["If-None-Match"] = entry["etag"]
+    with self.session.get(url, stream=True, headers=headers, timeout=60) as r:
+      if r.status_code == 304:
+        return None
+      #416: nothing left after the offset, the partial file is already complete (ex: crash before the rename). It's verified as-is
+      if r.status_code == 416 and offset > 0:
+        return r.headers.get("ETag", "")
+      r.raise_for_status()
+      #206: the server accepted the range, append to the partial file. Otherwise restart from scratch.
+      with open(part_path, "ab" if r.status_code == 206 else "wb") as f:
+        for chunk in r.iter_content(chunk_size=self.chunk_size):
+          f.write(chunk)
+      return r.headers.get("ETag", "")
+
+  def download_file(self, file, dest, owner, repo, entry):
+    local_path = os.path.join(dest, file["name"])
+    if os.path.exists(local_path) and os.path.getsize(local_path) == file["size"] and file["sha"] is not None and entry.get("sha") == file["sha"]:
+      return "skipped", entry
+    #hidden file (ignored by spark readers) until the download is complete and verified
+    part_path = os.path.join(dest, f".{file['name']}.part")
+    errors = []
+    for mirror in self.mirrors:
+      source = self.mirror_url(mirror, owner, repo, file["path"], file.get("download_url"))
+      if source is None:
+        continue
+      try:
+        return self.download_from_mirror(mirror, source, file, local_path, part_path, entry)
+      except Exception as e:
+        errors.append(f"{mirror}: {e}")
+    raise Exception(f"Couldn't download {owner}/{repo}/{file['path']} from any mirror {self.mirrors}: {errors}")
+
+  def download_from_mirror(self, mirror, source, file, local_path, part_path, entry):
+    #A resumed download that doesn't match the checksum (ex: file changed since the partial download) is downloaded again from scratch
+    for attempt in range(2):
+      resumed = os.path.exists(part_path)
+      if mirror == "local":
+        import shutil
+        shutil.copyfile(source, part_path)
+        etag = ""
+      else:
+        etag = self.fetch(source, local_path, part_path, entry)
+        if etag is None:
+          return "skipped", entry
+      size = os.path.getsize(part_path)
+      sha = DatasetDownloader.git_blob_sha(part_path)
+      if size == file["size"] and (file["sha"] is None or sha == file["sha"]):
+        os.replace(part_path, local_path)
+        print(f"saving {local_path} (from {mirror})")
+        return mirror, {"size": size, "sha": sha, "etag": etag}
+      os.remove(part_path)
+      if not resumed:
+        break
+    raise Exception(f"checksum mismatch (size {size} vs {file['size']}, sha {sha} vs {file['sha']})")
+
+  def download_folder(self, dest, owner, repo, path):
+    import time
+    from concurrent.futures import ThreadPoolExecutor
+    start = time.time()
+    os.makedirs(dest, exist_ok=True)
+    files = self.list_files(owner, repo, path)
+    manifest = self.load_manifest(dest)
+    def download(file):
+      source, entry = self.download_file(file, dest, owner, repo, manifest.get(file["name"], {}))
+      with self.lock:
+        manifest[file["name"]] = entry
+      return source
+    try:
+      with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+        sources = collections.Counter(executor.map(download, files))
+    finally:
+      #Keep track of the files downloaded so far, even if one of them failed
+      self.save_manifest(dest, manifest)
+    print(f"{len(files)} files from {owner}/{repo}/{path.strip('/')} ready in {dest} in {time.time()-start:.1f}s: {dict(sources)}")
+    return sources
+
+#Files already downloaded and unchanged are skipped. Mirrors are tried in order (see DatasetDownloader), use local_dir for offline tests
+def download_file_from_git(dest, owner, repo, path, mirrors = None, local_dir = None, max_workers = 10):
+  return DatasetDownloader(mirrors, local_dir, max_workers).download_folder(dest, owner, repo, path)
@@ -39,6 +39,75 @@ if data_exists:
 
 # COMMAND ----------
 
+# MAGIC %md
+# MAGIC ### Generation settings
+# MAGIC
+# MAGIC All the tables are generated column by column with NumPy (no per-row loop), drawing Faker values from pre-generated pools. Generation is seeded: the same `generation_seed` always produces the same dataset.
+# MAGIC
+# MAGIC - `data_scale` multiplies the number of users and the daily transaction volume (ex: `100` for 1M users)
+# MAGIC - `generation_mode`: `pandas` generates the transactions on the driver, `spark` generates them directly as a Spark DataFrame partitioned by day and injects the silver table issues with Spark (no driver memory limit)
+
+# COMMAND ----------
+
+generation_seed = 42
+data_scale = 1
+generation_mode = "pandas"
+faker_pool_size = 5000
+
+# COMMAND ----------
+
+from faker import Faker
+import numpy as np
+import pandas as pd
+from datetime import datetime, timedelta
+
+Faker.seed(generation_seed)
+fake = Faker()
+rng = np.random.default_rng(generation_seed)
+
+# Faker is slow: we generate a pool of values once per method and sample from it instead of calling Faker for each row
+faker_pools = {}
+def faker_pool(method, size=faker_pool_size, **kwargs):
+    key = (method, size, tuple(sorted(kwargs.items())))
+    if key not in faker_pools:
+        faker_pools[key] = np.array([getattr(fake, method)(**kwargs) for _ in range(size)], dtype=object)
+    return faker_pools[key]
+
+def sample_pool(method, num_rows, **kwargs):
+    return rng.choice(faker_pool(method, **kwargs), num_rows)
+
+def random_hex(num_rows, num_bytes):
+    hexs = rng.bytes(num_rows * num_bytes).hex()
+    size = num_bytes * 2
+    return np.array([hexs[i:i + size] for i in range(0, len(hexs), size)], dtype=object)
+
+def random_uuids(num_rows):
+    raw = np.frombuffer(rng.bytes(num_rows * 16), dtype=np.uint8).reshape(num_rows, 16).copy()
+    raw[:, 6] = (raw[:, 6] & 0x0F) | 0x40  # version 4
+    raw[:, 8] = (raw[:, 8] & 0x3F) | 0x80  # RFC 4122 variant
+    hexs = raw.tobytes().hex()
+    return np.array([f"{hexs[i:i+8]}-{hexs[i+8:i+12]}-{hexs[i+12:i+16]}-{hexs[i+16:i+20]}-{hexs[i+20:i+32]}" for i in range(0, len(hexs), 32)], dtype=object)
+
+# Split a flat array of values into num_rows lists of random length between min_len and max_len
+def random_lists(values_generator, num_rows, min_len, max_len):
+    lengths = rng.integers(min_len, max_len + 1, num_rows)
+    values = values_generator(lengths.sum())
+    return [list(v) for v in np.split(values, np.cumsum(lengths)[:-1])]
+
+def random_dates(start_date, end_date, num_rows):
+    days = rng.integers(0, (end_date - start_date).days + 1, num_rows)
+    return pd.to_datetime(np.datetime64(start_date, "D") + days).date
+
+# Pick a value in options_per_key[key] for each key (ex: a product name matching the product category)
+def choice_per_key(keys, options_per_key):
+    values = np.empty(len(keys), dtype=object)
+    for key, options in options_per_key.items():
+        mask = keys == key
+        values[mask] = rng.choice(options, mask.sum())
+    return values
+
+# COMMAND ----------
+
 # MAGIC %md
 # MAGIC ### Genearate the user table
 # MAGIC
@@ -70,49 +139,36 @@ if data_exists:
 
 if not data_exists:
 
-    from faker import Faker
-    import pandas as pd
-    import random
-    from datetime import datetime, timedelta
-
-    # Initialize Faker
-    fake = Faker()
-
     # Function to generate user data
     def generate_user_data(num_rows=10000):
-        user_data = []
-        
-        for _ in range(num_rows):
-            user = {
-                "UserID": fake.uuid4(),
-                "Username": fake.user_name(),
-                "Email": fake.email(),
-                "PasswordHash": fake.sha256(),
-                "FullName": fake.name(),
-                "DateOfBirth": fake.date_of_birth(minimum_age=18, maximum_age=90),
-                "Gender": random.choice(["Male", "Female", "Other"]),
-                "PhoneNumber": fake.phone_number(),
-                "Address": fake.address(),
-                "City": fake.city(),
-                "State": fake.state(),
-                "Country": fake.country(),
-                "PostalCode": fake.postcode(),
-                "RegistrationDate": fake.date_this_decade(),
-                "LastLoginDate": fake.date_time_between(start_date="-1y", end_date="now"),
-                "AccountStatus": random.choice(["Active", "Suspended", "Inactive"]),
-                "UserRole": random.choice(["Customer", "Admin"]),
-                "PreferredPaymentMethod": random.choice(["Credit Card", "Debit Card", "PayPal", "Bank Transfer"]),
-                "TotalPurchaseAmount": round(random.uniform(0, 10000), 2),
-                "NewsletterSubscription": random.choice([True, False]),
-                "Wishlist": [fake.uuid4() for _ in range(random.randint(0, 10))],
-                "CartItems": [fake.uuid4() for _ in range(random.randint(0, 5))]
-            }
-            user_data.append(user)
-        
-        return pd.DataFrame(user_data)
+        today = datetime.now().date()
+        return pd.DataFrame({
+            "UserID": random_uuids(num_rows),
+            "Username": sample_pool("user_name", num_rows),
+            "Email": sample_pool("email", num_rows),
+            "PasswordHash": random_hex(num_rows, 32),
+            "FullName": sample_pool("name", num_rows),
+            "DateOfBirth": random_dates(today - timedelta(days=90 * 365), today - timedelta(days=18 * 365), num_rows),
+            "Gender": rng.choice(["Male", "Female", "Other"], num_rows),
+            "PhoneNumber": sample_pool("phone_number", num_rows),
+            "Address": sample_pool("address", num_rows),
+            "City": sample_pool("city", num_rows),
+            "State": sample_pool("state", num_rows),
+            "Country": sample_pool("country", num_rows),
+            "PostalCode": sample_pool("postcode", num_rows),
+            "RegistrationDate": random_dates(today.replace(year=today.year - today.year % 10, month=1, day=1), today, num_rows),
+            "LastLoginDate": pd.Timestamp.now() - pd.to_timedelta(rng.integers(0, 365 * 86400, num_rows), unit="s"),
+            "AccountStatus": rng.choice(["Active", "Suspended", "Inactive"], num_rows),
+            "UserRole": rng.choice(["Customer", "Admin"], num_rows),
+            "PreferredPaymentMethod": rng.choice(["Credit Card", "Debit Card", "PayPal", "Bank Transfer"], num_rows),
+            "TotalPurchaseAmount": np.round(rng.uniform(0, 10000, num_rows), 2),
+            "NewsletterSubscription": rng.random(num_rows) < 0.5,
+            "Wishlist": random_lists(random_uuids, num_rows, 0, 10),
+            "CartItems": random_lists(random_uuids, num_rows, 0, 5)
+        })
 
     # Generate the user data
-    user_df = generate_user_data(10000)
+    user_df = generate_user_data(10000 * data_scale)
 
 
 
@@ -183,13 +239,6 @@ if not data_exists:
 # COMMAND ----------
 
 if not data_exists:
-    from faker import Faker
-    import pandas as pd
-    import random
-
-    # Initialize Faker
-    fake = Faker()
-
     # Expanded list of realistic product names related to categories
     product_names = {
         "Electronics": [
@@ -293,38 +342,36 @@ if not data_exists:
 
     # Function to generate product data
     def generate_product_data(num_rows=10000):
-        product_data = []
-        
-        for _ in range(num_rows):
-            category = random.choice(list(subcategories.keys()))
-            product = {
-                "ProductID": fake.uuid4(),
-                "ProductName": random.choice(product_names[category]),
-                "Category": category,
-                "SubCategory": random.choice(subcategories[category]),
-                "Brand": random.choice(brands),
-                "Description": random.choice(descriptions[category]),
-                "Price": round(random.uniform(5, 2000), 2),
-                "Discount": round(random.uniform(0, 0.5), 2),  # Discount as a fraction
-                "StockQuantity": random.randint(0, 1000),
-                "SKU": fake.bothify(text='???-########'),
-                "ProductImageURL": fake.image_url(),
-                "ProductRating": round(random.uniform(1, 5), 1),
-                "NumberOfReviews": random.randint(0, 5000),
-                "SupplierID": fake.uuid4(),
-                "DateAdded": fake.date_this_decade(),
-                "Dimensions": f"{random.uniform(1, 100):.2f} x {random.uniform(1, 100):.2f} x {random.uniform(1, 100):.2f}",
-                "Weight": round(random.uniform(0.1, 50), 2),
-                "Color": fake.color_name(),
-                "Material": random.choice(["Plastic", "Metal", "Wood", "Glass", "Fabric"]),
-                "WarrantyPeriod": f"{random.randint(1, 24)} months",
-                "ReturnPolicy": random.choice(["30 days", "60 days", "No returns"]),
-                "ShippingCost": round(random.uniform(0, 50), 2),
-                "ProductTags": [fake.word() for _ in range(random.randint(1, 5))]
-            }
-            product_data.append(product)
-        
-        return pd.DataFrame(product_data)
+        today = datetime.now().date()
+        categories = rng.choice(list(subcategories.keys()), num_rows)
+        dimensions = rng.uniform(1, 100, (num_rows, 3))
+        sku_letters = rng.choice(list("abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ"), (num_rows, 3))
+        sku_digits = rng.integers(0, 10**8, num_rows)
+        return pd.DataFrame({
+            "ProductID": random_uuids(num_rows),
+            "ProductName": choice_per_key(categories, product_names),
+            "Category": categories,
+            "SubCategory": choice_per_key(categories, subcategories),
+            "Brand": rng.choice(brands, num_rows),
+            "Description": choice_per_key(categories, descriptions),
+            "Price": np.round(rng.uniform(5, 2000, num_rows), 2),
+            "Discount": np.round(rng.uniform(0, 0.5, num_rows), 2),  # Discount as a fraction
+            "StockQuantity": rng.integers(0, 1001, num_rows),
+            "SKU": [f"{''.join(l)}-{d:08d}" for l, d in zip(sku_letters, sku_digits)],
+            "ProductImageURL": sample_pool("image_url", num_rows),
+            "ProductRating": np.round(rng.uniform(1, 5, num_rows), 1),
+            "NumberOfReviews": rng.integers(0, 5001, num_rows),
+            "SupplierID": random_uuids(num_rows),
+            "DateAdded": random_dates(today.replace(year=today.year - today.year % 10, month=1, day=1), today, num_rows),
+            "Dimensions": [f"{l:.2f} x {w:.2f} x {h:.2f}" for l, w, h in dimensions],
+            "Weight": np.round(rng.uniform(0.1, 50, num_rows), 2),
+            "Color": sample_pool("color_name", num_rows),
+            "Material": rng.choice(["Plastic", "Metal", "Wood", "Glass", "Fabric"], num_rows),
+            "WarrantyPeriod": [f"{m} months" for m in rng.integers(1, 25, num_rows)],
+            "ReturnPolicy": rng.choice(["30 days", "60 days", "No returns"], num_rows),
+            "ShippingCost": np.round(rng.uniform(0, 50, num_rows), 2),
+            "ProductTags": random_lists(lambda n: rng.choice(faker_pool("word"), n), num_rows, 1, 5)
+        })
 
     # Generate the product data
     product_df = generate_product_data(10000)
@@ -399,85 +446,91 @@ if not data_exists:
 # COMMAND ----------
 
 if not data_exists:
-    from faker import Faker
-    import pandas as pd
-    import random
-    from datetime import datetime, timedelta
-
-    # Initialize Faker
-    fake = Faker()
+    payment_methods = ["Credit Card", "Debit Card", "PayPal", "Bank Transfer"]
+
+    # Compute the number of transactions for each day of the range, for all the days at once
+    def compute_daily_volumes(start_date, end_date, campaigns={}, volume_scale=1):
+        days = pd.date_range(start_date, end_date, freq="D")
+        # Seasonality factor per month (January first): winter 1.6, spring 1.1, summer 1.2, autumn 1.4
+        seasonality_factors = np.array([1.6, 1.1, 1.1, 1.1, 1.1, 1.2, 1.2, 1.2, 1.4, 1.4, 1.4, 1.6])
+        seasonality_factor = seasonality_factors[days.month - 1]
+        # Weekend transaction volumes are higher than weekdays
+        day_factor = np.where(days.weekday < 5, 1.0, 1.3)
+        # Marketing campaign factor
+        campaign_factor = np.array([campaigns.get(d, 1.0) for d in days.strftime("%Y-%m-%d")])
+        base_transactions = (100 * volume_scale * day_factor * seasonality_factor * campaign_factor).astype(int)
+        # Apply a random multiplier to introduce variability
+        daily_transactions = (base_transactions * rng.uniform(0.9, 1.1, len(days))).astype(int)
+        return days, daily_transactions
 
     # Function to generate transaction data
-    def generate_transaction_data(user_df, product_df, start_date, end_date, campaigns={}):
-        transaction_data = []
-        
-        # Convert date strings to datetime objects
-        start_date = datetime.strptime(start_date, "%Y-%m-%d")
-        end_date = datetime.strptime(end_date, "%Y-%m-%d")
-        
-        # Define seasonality factors
-        seasonality_factors = {
-            "winter": 1.6,
-            "spring": 1.1,
-            "summer": 1.2,
-            "autumn": 1.4
-        }
-        
-        # Iterate over each date in the range
-        current_date = start_date
-        while current_date <= end_date:
-            # Determine seasonality factor based on month
-            month = current_date.month
-            if month in [12, 1]:
-                seasonality_factor = seasonality_factors["winter"]
-            elif month in [2, 3, 4, 5]:
-                seasonality_factor = seasonality_factors["spring"]
-            elif month in [6, 7, 8]:
-                seasonality_factor = seasonality_factors["summer"]
-            else:
-                seasonality_factor = seasonality_factors["autumn"]
-            
-            # Determine weekday/weekend factor
-            if current_date.weekday() < 5:  # Weekday
-                day_factor = 1.0
-            else:  # Weekend
-                day_factor = 1.3
-            
-            # Determine marketing campaign factor
-            campaign_factor = campaigns.get(current_date.strftime("%Y-%m-%d"), 1.0)
-            
-            # Calculate the base number of transactions for the day
-            base_transactions = int(100 * day_factor * seasonality_factor * campaign_factor)
-            
-            # Apply a random multiplier to introduce variability
-            random_multiplier = random.uniform(0.9, 1.1)  # Adjust the range for desired variability
-            daily_transactions = int(base_transactions * random_multiplier)
-            
-            # Generate transactions for the day
-            for _ in range(daily_transactions):
-                user = user_df.sample(1).iloc[0]
-                product = product_df.sample(1).iloc[0]
-                quantity = random.randint(1, 5)
-                transaction = {
-                    "TransactionID": fake.uuid4(),
-                    "UserID": user["UserID"],
-                    "ProductID": product["ProductID"],
-                    "TransactionDate": fake.date_time_between(start_date=current_date, end_date=current_date + timedelta(days=1)),
-                    "Quantity": quantity,
-                    "UnitPrice": product["Price"],
-                    "TotalPrice": round(product["Price"] * quantity, 2),
-                    "PaymentMethod": random.choice(["Credit Card", "Debit Card", "PayPal", "Bank Transfer"]),
-                    "ShippingAddress": user["Address"],
-                    "LoyaltyPointsEarned": int(round(product["Price"] * quantity * 0.1)),  # Example: 10% of the total price in loyalty points
-                    "GiftWrap": random.choice(["yes", "no"]),
-                    "SpecialInstructions": fake.sentence() if random.choice([True, False]) else ""
-                }
-                transaction_data.append(transaction)
-            
-            # Move to the next day
-            current_date += timedelta(days=1)
-        
-        return pd.DataFrame(transaction_data)
+    def generate_transaction_data(user_df, product_df, start_date, end_date, campaigns={}, volume_scale=1):
+        days, daily_transactions = compute_daily_volumes(start_date, end_date, campaigns, volume_scale)
+        num_rows = daily_transactions.sum()
+        # Sample all the users and products at once instead of calling df.sample(1) for each transaction
+        user_idx = rng.integers(0, len(user_df), num_rows)
+        product_idx = rng.integers(0, len(product_df), num_rows)
+        unit_price = product_df["Price"].to_numpy()[product_idx]
+        quantity = rng.integers(1, 6, num_rows)
+        total_price = unit_price * quantity
+        transaction_date = days.to_numpy().repeat(daily_transactions) + rng.integers(0, 86400, num_rows).astype("timedelta64[s]")
+        return pd.DataFrame({
+            "TransactionID": random_uuids(num_rows),
+            "UserID": user_df["UserID"].to_numpy()[user_idx],
+            "ProductID": product_df["ProductID"].to_numpy()[product_idx],
+            "TransactionDate": transaction_date,
+            "Quantity": quantity,
+            "UnitPrice": unit_price,
+            "TotalPrice": np.round(total_price, 2),
+            "PaymentMethod": rng.choice(payment_methods, num_rows),
+            "ShippingAddress": user_df["Address"].to_numpy()[user_idx],
+            "LoyaltyPointsEarned": np.round(total_price * 0.1).astype(int),  # Example: 10% of the total price in loyalty points
+            "GiftWrap": rng.choice(["yes", "no"], num_rows),
+            "SpecialInstructions": np.where(rng.random(num_rows) < 0.5, sample_pool("sentence", num_rows), "")
+        })
+
+    # Same generation, but distributed with Spark: the daily volumes are computed on the driver and each day is exploded into its transactions.
+    # Random values are derived from a hash of (seed, day, transaction number) so that the output doesn't depend on the cluster partitioning.
+    def generate_transaction_data_spark(spark_user_df, spark_product_df, start_date, end_date, campaigns={}, volume_scale=1, seed=generation_seed):
+        from pyspark.sql import functions as F, Window
+        days, daily_transactions = compute_daily_volumes(start_date, end_date, campaigns, volume_scale)
+        volumes = spark.createDataFrame(pd.DataFrame({"TransactionDay": days.date, "DailyTransactions": daily_transactions}))
+
+        def random_int(name, max_value):
+            return F.pmod(F.xxhash64(F.lit(seed), F.lit(name), "TransactionDay", "TransactionNumber"), F.lit(max_value))
+
+        def random_element(name, values):
+            return F.element_at(F.array(*[F.lit(v) for v in values]), (random_int(name, len(values)) + 1).cast("int"))
+
+        users = spark_user_df.select("UserID", F.col("Address").alias("ShippingAddress")) \
+            .withColumn("user_idx", F.row_number().over(Window.orderBy("UserID")) - 1)
+        products = spark_product_df.select("ProductID", F.col("Price").alias("UnitPrice")) \
+            .withColumn("product_idx", F.row_number().over(Window.orderBy("ProductID")) - 1)
+        transaction_hash = F.sha2(F.concat_ws("-", F.lit(seed), "TransactionDay", "TransactionNumber"), 256)
+
+        # Broadcast the users and products to keep the day partitioning (no shuffle on the transactions)
+        return volumes.repartition(len(days), "TransactionDay") \
+            .withColumn("TransactionNumber", F.explode(F.sequence(F.lit(1), F.col("DailyTransactions")))) \
+            .withColumn("user_idx", random_int("user", users.count())) \
+            .withColumn("product_idx", random_int("product", products.count())) \
+            .join(F.broadcast(users), "user_idx") \
+            .join(F.broadcast(products), "product_idx") \
+            .withColumn("Quantity", (random_int("quantity", 5) + 1).cast("int")) \
+            .withColumn("TotalPrice", F.round(F.col("UnitPrice") * F.col("Quantity"), 2)) \
+            .select(
+                F.concat_ws("-", transaction_hash.substr(1, 8), transaction_hash.substr(9, 4), F.concat(F.lit("4"), transaction_hash.substr(14, 3)),
+                            transaction_hash.substr(17, 4), transaction_hash.substr(21, 12)).alias("TransactionID"),
+                "UserID",
+                "ProductID",
+                (F.col("TransactionDay").cast("timestamp").cast("long") + random_int("time", 86400)).cast("timestamp").alias("TransactionDate"),
+                "Quantity",
+                F.col("UnitPrice").cast("float").alias("UnitPrice"),
+                F.col("TotalPrice").cast("float").alias("TotalPrice"),
+                random_element("payment", payment_methods).alias("PaymentMethod"),
+                "ShippingAddress",
+                F.round(F.col("TotalPrice") * 0.1).cast("int").alias("LoyaltyPointsEarned"),
+                random_element("gift", ["yes", "no"]).alias("GiftWrap"),
+                F.when(random_int("instructions", 2) == 0, random_element("sentence", faker_pool("sentence"))).otherwise(F.lit("")).alias("SpecialInstructions"))
 
     # Generate the transaction data
     # Set the current date
@@ -498,7 +551,10 @@ if not data_exists:
     }
 
     # Generate the transaction data
-    transaction_df = generate_transaction_data(user_df, product_df, start_date, end_date, campaigns)
+    if generation_mode == "spark":
+        spark_transaction_df = generate_transaction_data_spark(spark_user_df, spark_product_df, start_date, end_date, campaigns, volume_scale=data_scale)
+    else:
+        transaction_df = generate_transaction_data(user_df, product_df, start_date, end_date, campaigns, volume_scale=data_scale)
 
 # COMMAND ----------
 
@@ -521,14 +577,18 @@ if not data_exists:
         StructField("SpecialInstructions", StringType(), False)
     ])
 
-    # Create Spark DataFrame
-    spark_transaction_df = spark.createDataFrame(transaction_df, schema)
+    # Create Spark DataFrame (already generated as a Spark DataFrame in spark mode)
+    if generation_mode != "spark":
+        spark_transaction_df = spark.createDataFrame(transaction_df, schema)
 
     # Write the Spark DataFrame to Delta format
     spark_transaction_df.write.mode('overwrite').saveAsTable('bronze_transaction')
 
     # Join the DataFrames
-    joined_df = transaction_df.merge(user_df, on="UserID", how="left").merge(product_df, on="ProductID", how="left")
+    if generation_mode == "spark":
+        joined_df = spark.table('bronze_transaction').join(spark_user_df, "UserID", "left").join(spark_product_df, "ProductID", "left")
+    else:
+        joined_df = transaction_df.merge(user_df, on="UserID", how="left").merge(product_df, on="ProductID", how="left")
 
 # COMMAND ----------
 
@@ -618,11 +678,59 @@ def inject_issues(df, campaign_start_dates):
     
     return df
 
+# Spark version of inject_issues, applying the same rules with column expressions so that it scales beyond the driver memory.
+# Each pandas df.sample(frac) is replaced by a seeded rand() < frac filter: the output matches the pandas version statistically.
+def inject_issues_spark(df, campaign_start_dates, seed=generation_seed):
+    from pyspark.sql import functions as F
+    import itertools
+    frac_rng = np.random.default_rng(seed)
+    seeds = itertools.count(seed)
+    def sample(frac):
+        return F.rand(next(seeds)) < frac
+
+    def set_when(df, column, condition, value):
+        return df.withColumn(column, F.when(condition, value).otherwise(F.col(column)))
+
+    transaction_day = F.to_date("TransactionDate")
+    campaign_mask = F.lit(False)
+    for start_date in pd.to_datetime(campaign_start_dates):
+        campaign_mask = campaign_mask | transaction_day.between(F.lit(start_date.date()), F.lit((start_date + pd.Timedelta(days=9)).date()))
+    after_may_2024_mask = (F.year(transaction_day) == 2024) & (F.month(transaction_day) >= 5)
+
+    # Steady nulls around 10-15% in specified columns
+    for column in ['ProductTags', 'ShippingAddress', 'Wishlist', 'GiftWrap']:
+        df = set_when(df, column, sample(frac_rng.uniform(0.1, 0.15)), F.lit(None))
+
+    # Steady nulls around 10% in PreferredPaymentMethod columns
+    df = set_when(df, 'PreferredPaymentMethod', sample(frac_rng.uniform(0.05, 0.09)), F.lit(None))
+
+    # 60% zeros in Discount and 10% zeros in ProductRating distributed evenly over time
+    df = set_when(df, 'Discount', sample(0.6), F.lit(0))
+    df = set_when(df, 'ProductRating', sample(0.1), F.lit(0))
+
+    # NumberOfReviews drops to 5% in sync with marketing campaigns, plus steady 20-30% zeros
+    df = set_when(df, 'NumberOfReviews', campaign_mask & sample(0.05), F.lit(0))
+    df = set_when(df, 'NumberOfReviews', sample(frac_rng.uniform(0.2, 0.3)), F.lit(0))
+    df = set_when(df, 'PreferredPaymentMethod', campaign_mask & sample(0.48), F.lit(None))
+    df = set_when(df, 'PaymentMethod', campaign_mask & sample(0.8), F.lit('Apple Pay'))
+
+    # Overwrite over 50% of WarrantyPeriod and ReturnPolicy after May 2024
+    df = set_when(df, 'WarrantyPeriod', after_may_2024_mask & sample(0.7), F.lit('15 days'))
+    df = set_when(df, 'ReturnPolicy', after_may_2024_mask & sample(0.7), F.lit('no returns'))
+
+    # Dramatic change in Quantity and TotalPrice for 10 days after each campaign start date
+    df = set_when(df, 'Quantity', campaign_mask, F.col('Quantity') * 1.5)
+    df = set_when(df, 'TotalPrice', campaign_mask, F.col('Quantity') * F.col('UnitPrice'))
+    return df.withColumn('Campaign_flag', campaign_mask)
+
 if not data_exists:
     # Example usage
     campaign_start_dates = [(current_date - timedelta(days=1)).strftime("%Y-%m-%d")]
     #campaign_start_dates = ["2023-07-15", "2023-11-23", "2024-03-10", (current_date - timedelta(days=1)).strftime("%Y-%m-%d")]
-    joined_df_with_issues = inject_issues(joined_df, campaign_start_dates)
+    if generation_mode == "spark":
+        spark_joined_df_with_issues = inject_issues_spark(joined_df, campaign_start_dates)
+    else:
+        joined_df_with_issues = inject_issues(joined_df, campaign_start_dates)
 
 
 # COMMAND ----------
@@ -691,19 +799,23 @@ if not data_exists:
         StructField('ProductTags', ArrayType(StringType()), True),
         StructField('Campaign_flag', BooleanType(), True)
     ])
-    # Convert the 'DateOfBirth' column to datetime
-    joined_df_with_issues['DateOfBirth'] = pd.to_datetime(joined_df_with_issues['DateOfBirth'], errors='coerce')
-    joined_df_with_issues['RegistrationDate'] = pd.to_datetime(joined_df_with_issues['RegistrationDate'], errors='coerce')
-    joined_df_with_issues['DateAdded'] = pd.to_datetime(joined_df_with_issues['DateAdded'], errors='coerce')
-
-    # Ensure Wishlist, CartItems, and ProductTags columns are lists or null
-    joined_df_with_issues['Wishlist'] = joined_df_with_issues['Wishlist'].apply(lambda x: x if x is None or isinstance(x, list) else [x])
-    joined_df_with_issues['CartItems'] = joined_df_with_issues['CartItems'].apply(lambda x: x if x is None or isinstance(x, list) else [x])
-    joined_df_with_issues['ProductTags'] = joined_df_with_issues['ProductTags'].apply(lambda x: x if x is None or isinstance(x, list) else [x])
-
-
-    # Convert pandas DataFrame to Spark DataFrame with schema
-    spark_joined_df_with_issues = spark.createDataFrame(joined_df_with_issues, schema)
+    if generation_mode == "spark":
+        from pyspark.sql import functions as F
+        # Align the column order and types with the pandas version
+        spark_joined_df_with_issues = spark_joined_df_with_issues.select([F.col(f.name).cast(f.dataType) for f in schema.fields])
+    else:
+        # Convert the 'DateOfBirth' column to datetime
+        joined_df_with_issues['DateOfBirth'] = pd.to_datetime(joined_df_with_issues['DateOfBirth'], errors='coerce')
+        joined_df_with_issues['RegistrationDate'] = pd.to_datetime(joined_df_with_issues['RegistrationDate'], errors='coerce')
+        joined_df_with_issues['DateAdded'] = pd.to_datetime(joined_df_with_issues['DateAdded'], errors='coerce')
+
+        # Ensure Wishlist, CartItems, and ProductTags columns are lists or null
+        joined_df_with_issues['Wishlist'] = joined_df_with_issues['Wishlist'].apply(lambda x: x if x is None or isinstance(x, list) else [x])
+        joined_df_with_issues['CartItems'] = joined_df_with_issues['CartItems'].apply(lambda x: x if x is None or isinstance(x, list) else [x])
+        joined_df_with_issues['ProductTags'] = joined_df_with_issues['ProductTags'].apply(lambda x: x if x is None or isinstance(x, list) else [x])
+
+        # Convert pandas DataFrame to Spark DataFrame with schema
+        spark_joined_df_with_issues = spark.createDataFrame(joined_df_with_issues, schema)
 
     # Write the Spark DataFrame to Delta format
     spark_joined_df_with_issues.write.option("mergeSchema", "true").mode('overwrite').saveAsTable('silver_transaction')
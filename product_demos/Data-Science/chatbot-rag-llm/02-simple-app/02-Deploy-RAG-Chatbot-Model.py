@@ -277,6 +277,34 @@ if active_deployment:
 
 # COMMAND ----------
 
+# MAGIC %md
+# MAGIC ## Load testing the endpoint
+# MAGIC
+# MAGIC Let's replay the questions of our evaluation dataset against the chatbot endpoint at increasing QPS, to see how the latency evolves with the load.
+# MAGIC
+# MAGIC The latency percentiles (p50/p95/p99), error rate and throughput of each run are saved in the `load_test_results` table (and each request in `load_test_results_requests`). Set `use_local_stub` to `True` to try the load test offline against a local FastAPI stub endpoint.
+
+# COMMAND ----------
+
+# MAGIC %run ../../../../_resources/01-load-test
+
+# COMMAND ----------
+
+run_load_test = False
+use_local_stub = False
+
+if run_load_test:
+  base_url = start_load_test_stub()[1] if use_local_stub else None
+  questions = spark.table("eval_set_databricks_documentation").select("request").toPandas()["request"].tolist()
+  payloads = [{"messages": [{"role": "user", "content": q}]} for q in questions]
+  tester = serving_endpoint_load_tester(deployment_info.endpoint_name, base_url=base_url)
+  for qps in [1, 5, 10]:
+    summary, requests_df = tester.run(payloads, qps=qps, duration_sec=60, name=f"rag_chatbot qps={qps}")
+    save_load_test_results(summary, requests_df)
+  display(spark.table("load_test_results").orderBy("timestamp"))
+
+# COMMAND ----------
+
 # MAGIC %md
 # MAGIC ## Congratulations! You have deployed your first GenAI RAG model!
 # MAGIC
@@ -60,6 +60,8 @@ except:
 
 # MAGIC %md
 # MAGIC ## Let's now create our chatbot application using Gradio
+# MAGIC
+# MAGIC The answer is streamed from the serving endpoint token by token: the user sees the beginning of the answer as soon as it's generated. Requests are sent with a pooled async http client, so the concurrent users don't each block a thread. The time to first token and tokens/sec (chunks/sec when the endpoint doesn't return its token usage) are logged for each request.
 
 # COMMAND ----------
 
@@ -67,9 +69,15 @@ except:
 # MAGIC from fastapi import FastAPI
 # MAGIC import gradio as gr
 # MAGIC import os
+# MAGIC import json
+# MAGIC import time
+# MAGIC import logging
+# MAGIC import httpx
 # MAGIC from gradio.themes.utils import sizes
 # MAGIC from databricks.sdk import WorkspaceClient
-# MAGIC from databricks.sdk.service.serving import ChatMessage, ChatMessageRole
+# MAGIC
+# MAGIC logging.basicConfig(level=logging.INFO)
+# MAGIC logger = logging.getLogger("chatbot_app")
 # MAGIC
 # MAGIC app = FastAPI()
 # MAGIC
@@ -77,28 +85,84 @@ except:
 # MAGIC w = WorkspaceClient()
 # MAGIC available_endpoints = [x.name for x in w.serving_endpoints.list()]
 # MAGIC
+# MAGIC # Async client with pooled connections shared by all the users: waiting for the endpoint doesn't block a thread per request
+# MAGIC http_client = None
+# MAGIC
+# MAGIC
+# MAGIC def get_http_client():
+# MAGIC     global http_client
+# MAGIC     if http_client is None:
+# MAGIC         http_client = httpx.AsyncClient(
+# MAGIC             base_url=w.config.host,
+# MAGIC             limits=httpx.Limits(max_connections=100, max_keepalive_connections=20),
+# MAGIC             timeout=httpx.Timeout(120.0, connect=10.0),
+# MAGIC         )
+# MAGIC     return http_client
+# MAGIC
 # MAGIC
-# MAGIC def respond(message, history, dropdown):
+# MAGIC def to_messages(message, history):
+# MAGIC     messages = [
+# MAGIC         {"role": role, "content": content}
+# MAGIC         for human, assistant in history or []
+# MAGIC         for role, content in (("user", human), ("assistant", assistant))
+# MAGIC         if content
+# MAGIC     ]
+# MAGIC     messages.append({"role": "user", "content": message})
+# MAGIC     return messages
+# MAGIC
+# MAGIC
+# MAGIC # Yield the answer tokens as they are generated. Endpoints not supporting streaming return the full answer as a single json response
+# MAGIC # The token usage is saved in the usage dict when the endpoint returns it (in the response or the last chunk)
+# MAGIC async def stream_answer(endpoint, messages, usage):
+# MAGIC     request = {"messages": messages, "temperature": 1.0, "stream": True}
+# MAGIC     # authenticate() returns fresh auth headers (the app OAuth token is refreshed by the sdk)
+# MAGIC     async with get_http_client().stream("POST", f"/serving-endpoints/{endpoint}/invocations", json=request, headers=w.config.authenticate()) as response:
+# MAGIC         if response.status_code != 200:
+# MAGIC             await response.aread()
+# MAGIC             raise Exception(f"{response.status_code} {response.text}")
+# MAGIC         if not response.headers.get("content-type", "").startswith("text/event-stream"):
+# MAGIC             answer = json.loads(await response.aread())
+# MAGIC             usage.update(answer.get("usage") or {})
+# MAGIC             yield answer["choices"][0]["message"]["content"]
+# MAGIC             return
+# MAGIC         async for line in response.aiter_lines():
+# MAGIC             if not line.startswith("data:"):
+# MAGIC                 continue
+# MAGIC             data = line[len("data:"):].strip()
+# MAGIC             if data == "[DONE]":
+# MAGIC                 break
+# MAGIC             chunk = json.loads(data)
+# MAGIC             usage.update(chunk.get("usage") or {})
+# MAGIC             if chunk.get("choices"):
+# MAGIC                 content = chunk["choices"][0].get("delta", {}).get("content")
+# MAGIC                 if content:
+# MAGIC                     yield content
+# MAGIC
+# MAGIC
+# MAGIC async def respond(message, history, dropdown):
 # MAGIC     if len(message.strip()) == 0:
-# MAGIC         return "ERROR the question should not be empty"
+# MAGIC         yield "ERROR the question should not be empty"
+# MAGIC         return
+# MAGIC     start = time.time()
+# MAGIC     time_to_first_token, chunks, answer, usage = None, 0, "", {}
 # MAGIC     try:
-# MAGIC         messages = []
-# MAGIC         if history:
-# MAGIC             for human, assistant in history:
-# MAGIC                 messages.append(ChatMessage(content=human, role=ChatMessageRole.USER))
-# MAGIC                 messages.append(
-# MAGIC                     ChatMessage(content=assistant, role=ChatMessageRole.ASSISTANT)
-# MAGIC                 )
-# MAGIC         messages.append(ChatMessage(content=message, role=ChatMessageRole.USER))
-# MAGIC         response = w.serving_endpoints.query(
-# MAGIC             name=dropdown,
-# MAGIC             messages=messages,
-# MAGIC             temperature=1.0,
-# MAGIC             stream=False,
-# MAGIC         )
+# MAGIC         async for content in stream_answer(dropdown, to_messages(message, history), usage):
+# MAGIC             if time_to_first_token is None:
+# MAGIC                 time_to_first_token = time.time() - start
+# MAGIC             chunks += 1
+# MAGIC             answer += content
+# MAGIC             yield answer
 # MAGIC     except Exception as error:
-# MAGIC         return f"ERROR requesting endpoint {dropdown}: {error}"
-# MAGIC     return response.choices[0].message.content
+# MAGIC         logger.error(f"endpoint {dropdown} failed after {time.time() - start:.2f}s: {error}")
+# MAGIC         yield f"{answer}\n\nERROR requesting endpoint {dropdown}: {error}" if answer else f"ERROR requesting endpoint {dropdown}: {error}"
+# MAGIC         return
+# MAGIC     duration = time.time() - start
+# MAGIC     if time_to_first_token is not None:
+# MAGIC         generation_time = duration - time_to_first_token
+# MAGIC         # The streamed chunks don't always contain 1 token: report tokens/sec only when the endpoint returns the token usage
+# MAGIC         count, unit = (usage["completion_tokens"], "tokens") if usage.get("completion_tokens") else (chunks, "chunks")
+# MAGIC         per_sec = f"{count / generation_time:.1f}" if generation_time > 0 else "n/a"
+# MAGIC         logger.info(f"endpoint {dropdown}: time to first token {time_to_first_token:.2f}s, {count} {unit} in {duration:.2f}s ({per_sec} {unit}/sec)")
 # MAGIC
 # MAGIC
 # MAGIC theme = gr.themes.Soft(
@@ -1,9 +1,15 @@
 from fastapi import FastAPI
 import gradio as gr
 import os
+import json
+import time
+import logging
+import httpx
 from gradio.themes.utils import sizes
 from databricks.sdk import WorkspaceClient
-from databricks.sdk.service.serving import ChatMessage, ChatMessageRole
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger("chatbot_app")
 
 app = FastAPI()
 
@@ -11,28 +17,84 @@ app = FastAPI()
 w = WorkspaceClient()
 available_endpoints = [x.name for x in w.serving_endpoints.list()]
 
+# Async client with pooled connections shared by all the users: waiting for the endpoint doesn't block a thread per request
+http_client = None
+
+
+def get_http_client():
+    global http_client
+    if http_client is None:
+        http_client = httpx.AsyncClient(
+            base_url=w.config.host,
+            limits=httpx.Limits(max_connections=100, max_keepalive_connections=20),
+            timeout=httpx.Timeout(120.0, connect=10.0),
+        )
+    return http_client
+
 
-def respond(message, history, dropdown):
+def to_messages(message, history):
+    messages = [
+        {"role": role, "content": content}
+        for human, assistant in history or []
+        for role, content in (("user", human), ("assistant", assistant))
+        if content
+    ]
+    messages.append({"role": "user", "content": message})
+    return messages
+
+
+# Yield the answer tokens as they are generated. Endpoints not supporting streaming return the full answer as a single json response
+# The token usage is saved in the usage dict when the endpoint returns it (in the response or the last chunk)
+async def stream_answer(endpoint, messages, usage):
+    request = {"messages": messages, "temperature": 1.0, "stream": True}
+    # authenticate() returns fresh auth headers (the app OAuth token is refreshed by the sdk)
+    async with get_http_client().stream("POST", f"/serving-endpoints/{endpoint}/invocations", json=request, headers=w.config.authenticate()) as response:
+        if response.status_code != 200:
+            await response.aread()
+            raise Exception(f"{response.status_code} {response.text}")
+        if not response.headers.get("content-type", "").startswith("text/event-stream"):
+            answer = json.loads(await response.aread())
+            usage.update(answer.get("usage") or {})
+            yield answer["choices"][0]["message"]["content"]
+            return
+        async for line in response.aiter_lines():
+            if not line.startswith("data:"):
+                continue
+            data = line[len("data:"):].strip()
+            if data == "[DONE]":
+                break
+            chunk = json.loads(data)
+            usage.update(chunk.get("usage") or {})
+            if chunk.get("choices"):
+                content = chunk["choices"][0].get("delta", {}).get("content")
+                if content:
+                    yield content
+
+
+async def respond(message, history, dropdown):
     if len(message.strip()) == 0:
-        return "ERROR the question should not be empty"
+        yield "ERROR the question should not be empty"
+        return
+    start = time.time()
+    time_to_first_token, chunks, answer, usage = None, 0, "", {}
     try:
-        messages = []
-        if history:
-            for human, assistant in history:
-                messages.append(ChatMessage(content=human, role=ChatMessageRole.USER))
-                messages.append(
-                    ChatMessage(content=assistant, role=ChatMessageRole.ASSISTANT)
-                )
-        messages.append(ChatMessage(content=message, role=ChatMessageRole.USER))
-        response = w.serving_endpoints.query(
-            name=dropdown,
-            messages=messages,
-            temperature=1.0,
-            stream=False,
-        )
+        async for content in stream_answer(dropdown, to_messages(message, history), usage):
+            if time_to_first_token is None:
+                time_to_first_token = time.time() - start
+            chunks += 1
+            answer += content
+            yield answer
     except Exception as error:
-        return f"ERROR requesting endpoint {dropdown}: {error}"
-    return response.choices[0].message.content
+        logger.error(f"endpoint {dropdown} failed after {time.time() - start:.2f}s: {error}")
+        yield f"{answer}\n\nERROR requesting endpoint {dropdown}: {error}" if answer else f"ERROR requesting endpoint {dropdown}: {error}"
+        return
+    duration = time.time() - start
+    if time_to_first_token is not None:
+        generation_time = duration - time_to_first_token
+        # The streamed chunks don't always contain 1 token: report tokens/sec only when the endpoint returns the token usage
+        count, unit = (usage["completion_tokens"], "tokens") if usage.get("completion_tokens") else (chunks, "chunks")
+        per_sec = f"{count / generation_time:.1f}" if generation_time > 0 else "n/a"
+        logger.info(f"endpoint {dropdown}: time to first token {time_to_first_token:.2f}s, {count} {unit} in {duration:.2f}s ({per_sec} {unit}/sec)")
 
 
 theme = gr.themes.Soft(
@@ -259,46 +259,59 @@ pprint(embeddings)
 
 # COMMAND ----------
 
+# The embedding model takes at most 150 inputs per request. Requests are sent concurrently (max_workers in flight per task),
+# retried with backoff on throttling/server errors, and split in smaller batches if the endpoint rejects the payload as too large.
+# Set base_url/token to test against a local stub endpoint instead of the Databricks foundation model.
+embedding_client_conf = {"endpoint": "databricks-gte-large-en", "max_batch_size": 150, "max_workers": 4, "max_retries": 5}
+
 @pandas_udf("array<float>")
-def get_embedding(contents: pd.Series) -> pd.Series:
-    import mlflow.deployments
-    deploy_client = mlflow.deployments.get_deploy_client("databricks")
-    def get_embeddings(batch):
-        #Note: this will fail if an exception is thrown during embedding creation (add try/except if needed) 
-        response = deploy_client.predict(endpoint="databricks-gte-large-en", inputs={"input": batch})
-        return [e['embedding'] for e in response.data]
+def get_embedding(batch_iter: Iterator[pd.Series]) -> Iterator[pd.Series]:
+    # One client (and its connection pool) for all the arrow batches of the task. Latency/throughput metrics are printed in the executor logs.
+    client = EmbeddingClient(**embedding_client_conf)
+    try:
+        for contents in batch_iter:
+            yield pd.Series(client.embed(contents.tolist()))
+    finally:
+        client.close()
 
-    # Splitting the contents into batches of 150 items each, since the embedding model takes at most 150 inputs per request.
-    max_batch_size = 150
-    batches = [contents.iloc[i:i + max_batch_size] for i in range(0, len(contents), max_batch_size)]
+# COMMAND ----------
 
-    # Process each batch and collect the results
-    all_embeddings = []
-    for batch in batches:
-        all_embeddings += get_embeddings(batch.tolist())
+# MAGIC %md
+# MAGIC ### Reusing the embeddings of unchanged chunks
+# MAGIC
+# MAGIC Most chunks don't change between 2 documentation refreshes. The embeddings are saved in an `embedding_cache` Delta table, keyed by the embedding endpoint and the sha256 of the chunk text: only the new or modified chunks are sent to the endpoint.
+# MAGIC
+# MAGIC The cache is first filled with the embeddings already present in `databricks_pdf_documentation` (if you ran this notebook before), and the entries of other (retired) embedding endpoints are removed.
+
+# COMMAND ----------
 
-    return pd.Series(all_embeddings)
+create_embedding_cache("embedding_cache")
+backfill_embedding_cache("databricks_pdf_documentation", embedding_client_conf["endpoint"])
+evict_embedding_cache(keep_endpoints=[embedding_client_conf["endpoint"]])
 
 # COMMAND ----------
 
+def append_chunks(batch_df, batch_id):
+  append_with_cached_embeddings(batch_df, 'databricks_pdf_documentation', get_embedding, embedding_client_conf["endpoint"])
+
 (spark.readStream.table('pdf_raw')
       .withColumn("content", F.explode(read_as_chunk("content")))
-      .withColumn("embedding", get_embedding("content"))
-      .selectExpr('path as url', 'content', 'embedding')
+      .selectExpr('path as url', 'content')
   .writeStream
     .trigger(availableNow=True)
     .option("checkpointLocation", f'dbfs:{volume_folder}/checkpoints/pdf_chunk')
-    .table('databricks_pdf_documentation').awaitTermination())
+    .foreachBatch(append_chunks)
+    .start().awaitTermination())
 
 #Let's also add our documentation web page from the simple demo (make sure you run the quickstart demo first)
 if table_exists(f'{catalog}.{db}.databricks_documentation'):
   (spark.readStream.option("skipChangeCommits", "true").table('databricks_documentation') #skip changes for more stable demo
-      .withColumn('embedding', get_embedding("content"))
-      .select('url', 'content', 'embedding')
+      .select('url', 'content')
   .writeStream
     .trigger(availableNow=True)
     .option("checkpointLocation", f'dbfs:{volume_folder}/checkpoints/docs_chunks')
-    .table('databricks_pdf_documentation').awaitTermination())
+    .foreachBatch(append_chunks)
+    .start().awaitTermination())
 
 # COMMAND ----------
 
@@ -53,6 +53,19 @@ rag_chain_config = {
         "schema": {"chunk_text": "content", "document_uri": "url", "primary_key": "id"},
         "vector_search_index": f"{catalog}.{db}.databricks_pdf_documentation_self_managed_vs_index",
     },
+    "cache_config": {
+        "backend": "memory",  # memory (per serving replica) or redis (shared, requires redis_url)
+        "redis_url": None,
+        "query_rewrite": {"enabled": True, "max_size": 10000, "ttl_seconds": 86400},
+        "retriever": {"enabled": True, "max_size": 10000, "ttl_seconds": 3600},
+        "semantic_answer": {"enabled": False, "similarity_threshold": 0.95, "max_size": 1000, "ttl_seconds": 3600},
+    },
+    "history_config": {
+        "keep_last_turns": 2,  # last user/assistant turns kept verbatim, older turns are summarized
+        "max_history_tokens": 1500,
+        "max_rewrite_history_tokens": 400,
+        "summary_cache": {"max_size": 10000, "ttl_seconds": 86400},
+    },
 }
 try:
     with open('rag_chain_config.yaml', 'w') as f:
@@ -84,6 +97,375 @@ model_config = mlflow.models.ModelConfig(development_config='rag_chain_config.ya
 
 # COMMAND ----------
 
+# MAGIC %md
+# MAGIC ### Caching layer
+# MAGIC
+# MAGIC Many questions sent to the assistant are repeated or very similar. The chain reuses previous results with 3 caches, configured in the `cache_config` section of `rag_chain_config.yaml`:
+# MAGIC
+# MAGIC - **query_rewrite**: exact match on the normalized chat history and question, to skip the query rewriting LLM call
+# MAGIC - **retriever**: LRU + TTL cache of the retrieved documents, keyed by the query text
+# MAGIC - **semantic_answer** (disabled by default): reuse a previous answer when the embedding of the new query is close enough to a cached one
+# MAGIC
+# MAGIC Entries are kept in memory by default. Set `backend` to `redis` (with `redis_url`) to share the query rewriting and retriever caches between the serving replicas. `caches.stats()` returns the hit/miss metrics of each cache.
+# MAGIC
+# MAGIC The caches only depend on the model and retriever runnables, so they can be tested with stubbed clients. The module is shipped with the chain using `code_paths`.
+
+# COMMAND ----------
+
+# MAGIC %%writefile rag_cache.py
+# MAGIC import collections
+# MAGIC import hashlib
+# MAGIC import json
+# MAGIC import threading
+# MAGIC import time
+# MAGIC
+# MAGIC import numpy as np
+# MAGIC
+# MAGIC # Caching layer for the RAG chain: exact match cache for the query rewriting, LRU+TTL cache for the retriever
+# MAGIC # and optional semantic cache for the answers. The caches are configured with the cache_config section of rag_chain_config.yaml
+# MAGIC
+# MAGIC
+# MAGIC # In-process backend: LRU eviction once max_size entries are stored, entries expire after ttl_seconds
+# MAGIC class InMemoryCacheBackend:
+# MAGIC     def __init__(self, max_size=10000, ttl_seconds=3600):
+# MAGIC         self.max_size = max_size
+# MAGIC         self.ttl_seconds = ttl_seconds
+# MAGIC         self.entries = collections.OrderedDict()
+# MAGIC         self.lock = threading.Lock()
+# MAGIC
+# MAGIC     def get(self, key):
+# MAGIC         with self.lock:
+# MAGIC             entry = self.entries.get(key)
+# MAGIC             if entry is None:
+# MAGIC                 return None
+# MAGIC             value, expires_at = entry
+# MAGIC             if expires_at < time.time():
+# MAGIC                 del self.entries[key]
+# MAGIC                 return None
+# MAGIC             self.entries.move_to_end(key)
+# MAGIC             return value
+# MAGIC
+# MAGIC     def set(self, key, value):
+# MAGIC         with self.lock:
+# MAGIC             self.entries[key] = (value, time.time() + self.ttl_seconds)
+# MAGIC             self.entries.move_to_end(key)
+# MAGIC             while len(self.entries) > self.max_size:
+# MAGIC                 self.entries.popitem(last=False)
+# MAGIC
+# MAGIC
+# MAGIC # Shared backend: all the serving replicas use the same cache. Values must be json serializable.
+# MAGIC class RedisCacheBackend:
+# MAGIC     def __init__(self, url, ttl_seconds=3600, prefix="rag_cache", **kwargs):
+# MAGIC         import redis
+# MAGIC         self.client = redis.Redis.from_url(url)
+# MAGIC         self.ttl_seconds = ttl_seconds
+# MAGIC         self.prefix = prefix
+# MAGIC
+# MAGIC     def get(self, key):
+# MAGIC         value = self.client.get(f"{self.prefix}:{key}")
+# MAGIC         return json.loads(value) if value is not None else None
+# MAGIC
+# MAGIC     def set(self, key, value):
+# MAGIC         self.client.set(f"{self.prefix}:{key}", json.dumps(value), ex=self.ttl_seconds)
+# MAGIC
+# MAGIC
+# MAGIC CACHE_BACKENDS = {"memory": InMemoryCacheBackend, "redis": RedisCacheBackend}
+# MAGIC
+# MAGIC
+# MAGIC def create_backend(backend, name, max_size, ttl_seconds, redis_url=None):
+# MAGIC     if backend not in CACHE_BACKENDS:
+# MAGIC         raise ValueError(f"Unknown cache backend {backend}, must be one of {list(CACHE_BACKENDS.keys())}")
+# MAGIC     if backend == "redis":
+# MAGIC         return RedisCacheBackend(redis_url, ttl_seconds=ttl_seconds, prefix=f"rag_cache:{name}")
+# MAGIC     return InMemoryCacheBackend(max_size=max_size, ttl_seconds=ttl_seconds)
+# MAGIC
+# MAGIC
+# MAGIC # Lower case and collapse the whitespaces so that "What is  Spark?" and "what is spark?" share the same entry
+# MAGIC def normalize_text(text):
+# MAGIC     return " ".join(str(text).lower().split())
+# MAGIC
+# MAGIC
+# MAGIC def cache_key(*parts):
+# MAGIC     return hashlib.sha256(json.dumps(parts, sort_keys=True).encode("utf-8")).hexdigest()
+# MAGIC
+# MAGIC
+# MAGIC # Exact match cache with hit/miss metrics
+# MAGIC class ExactCache:
+# MAGIC     def __init__(self, name, backend):
+# MAGIC         self.name = name
+# MAGIC         self.backend = backend
+# MAGIC         self.metrics = collections.Counter()
+# MAGIC
+# MAGIC     def get_or_compute(self, key, compute):
+# MAGIC         value = self.backend.get(key)
+# MAGIC         if value is not None:
+# MAGIC             self.metrics["hits"] += 1
+# MAGIC             return value
+# MAGIC         self.metrics["misses"] += 1
+# MAGIC         value = compute()
+# MAGIC         if value is not None:
+# MAGIC             self.backend.set(key, value)
+# MAGIC         return value
+# MAGIC
+# MAGIC
+# MAGIC # Reuse the answer of a previous query if the cosine similarity of their embeddings is above the threshold.
+# MAGIC # The entries are kept in process (the lookup is a brute force scan of at most max_size vectors).
+# MAGIC class SemanticCache:
+# MAGIC     def __init__(self, embed_query, similarity_threshold=0.95, max_size=1000, ttl_seconds=3600):
+# MAGIC         self.name = "semantic_answer"
+# MAGIC         self.embed_query = embed_query
+# MAGIC         self.similarity_threshold = similarity_threshold
+# MAGIC         self.max_size = max_size
+# MAGIC         self.ttl_seconds = ttl_seconds
+# MAGIC         self.vectors, self.answers, self.expires_at = [], [], []
+# MAGIC         self.metrics = collections.Counter()
+# MAGIC         self.lock = threading.Lock()
+# MAGIC
+# MAGIC     def embed(self, query):
+# MAGIC         vector = np.asarray(self.embed_query(query), dtype=np.float32)
+# MAGIC         return vector / (np.linalg.norm(vector) or 1.0)
+# MAGIC
+# MAGIC     # Returns (cached answer or None, normalized query embedding)
+# MAGIC     def lookup(self, query):
+# MAGIC         vector = self.embed(query)
+# MAGIC         with self.lock:
+# MAGIC             now = time.time()
+# MAGIC             valid = [i for i, expires_at in enumerate(self.expires_at) if expires_at >= now]
+# MAGIC             if len(valid) < len(self.expires_at):
+# MAGIC                 self.vectors = [self.vectors[i] for i in valid]
+# MAGIC                 self.answers = [self.answers[i] for i in valid]
+# MAGIC                 self.expires_at = [self.expires_at[i] for i in valid]
+# MAGIC             if self.vectors:
+# MAGIC                 similarities = np.stack(self.vectors) @ vector
+# MAGIC                 best = int(np.argmax(similarities))
+# MAGIC                 if similarities[best] >= self.similarity_threshold:
+# MAGIC                     self.metrics["hits"] += 1
+# MAGIC                     return self.answers[best], vector
+# MAGIC         self.metrics["misses"] += 1
+# MAGIC         return None, vector
+# MAGIC
+# MAGIC     def add(self, vector, answer):
+# MAGIC         with self.lock:
+# MAGIC             self.vectors.append(vector)
+# MAGIC             self.answers.append(answer)
+# MAGIC             self.expires_at.append(time.time() + self.ttl_seconds)
+# MAGIC             if len(self.vectors) > self.max_size:
+# MAGIC                 self.vectors, self.answers, self.expires_at = self.vectors[1:], self.answers[1:], self.expires_at[1:]
+# MAGIC
+# MAGIC
+# MAGIC class RagCaches:
+# MAGIC     def __init__(self, query_rewrite=None, retriever=None, semantic_answer=None):
+# MAGIC         self.query_rewrite = query_rewrite
+# MAGIC         self.retriever = retriever
+# MAGIC         self.semantic_answer = semantic_answer
+# MAGIC
+# MAGIC     # Build the caches from the cache_config section. Disabled caches are None.
+# MAGIC     @staticmethod
+# MAGIC     def from_config(cache_config, embed_query=None):
+# MAGIC         cache_config = cache_config or {}
+# MAGIC         backend = cache_config.get("backend", "memory")
+# MAGIC         redis_url = cache_config.get("redis_url")
+# MAGIC
+# MAGIC         def exact_cache(name):
+# MAGIC             conf = cache_config.get(name, {})
+# MAGIC             if not conf.get("enabled", False):
+# MAGIC                 return None
+# MAGIC             return ExactCache(name, create_backend(backend, name, conf.get("max_size", 10000), conf.get("ttl_seconds", 3600), redis_url))
+# MAGIC
+# MAGIC         semantic_conf = cache_config.get("semantic_answer", {})
+# MAGIC         semantic_answer = None
+# MAGIC         if semantic_conf.get("enabled", False):
+# MAGIC             semantic_answer = SemanticCache(embed_query, semantic_conf.get("similarity_threshold", 0.95),
+# MAGIC                                             semantic_conf.get("max_size", 1000), semantic_conf.get("ttl_seconds", 3600))
+# MAGIC         return RagCaches(exact_cache("query_rewrite"), exact_cache("retriever"), semantic_answer)
+# MAGIC
+# MAGIC     # Hit/miss metrics of the enabled caches
+# MAGIC     def stats(self):
+# MAGIC         stats = {}
+# MAGIC         for cache in [self.query_rewrite, self.retriever, self.semantic_answer]:
+# MAGIC             if cache is not None:
+# MAGIC                 hits, misses = cache.metrics["hits"], cache.metrics["misses"]
+# MAGIC                 stats[cache.name] = {"hits": hits, "misses": misses, "hit_rate": round(hits / (hits + misses), 3) if hits + misses > 0 else None}
+# MAGIC         return stats
+# MAGIC
+# MAGIC
+# MAGIC def format_history_for_key(chat_history):
+# MAGIC     return [[m["role"], normalize_text(m["content"])] for m in chat_history]
+# MAGIC
+# MAGIC
+# MAGIC # Wrap the query rewriting step. Only called when there is a chat history, the rewritten query is cached on the normalized (history, question)
+# MAGIC def cached_query_rewrite(rewrite_chain, cache):
+# MAGIC     def rewrite(x, config=None):
+# MAGIC         if cache is None:
+# MAGIC             return rewrite_chain.invoke(x, config)
+# MAGIC         key = cache_key(format_history_for_key(x["chat_history"]), normalize_text(x["question"]))
+# MAGIC         return cache.get_or_compute(key, lambda: rewrite_chain.invoke(x, config))
+# MAGIC     return rewrite
+# MAGIC
+# MAGIC
+# MAGIC # Wrap the retriever. The documents are cached as dicts on the normalized query text
+# MAGIC def cached_retriever(retriever, cache):
+# MAGIC     def retrieve(query, config=None):
+# MAGIC         if cache is None:
+# MAGIC             return retriever.invoke(query, config)
+# MAGIC         from langchain_core.documents import Document
+# MAGIC         docs = cache.get_or_compute(cache_key(normalize_text(query)),
+# MAGIC                                     lambda: [{"page_content": d.page_content, "metadata": d.metadata} for d in retriever.invoke(query, config)])
+# MAGIC         return [Document(page_content=d["page_content"], metadata=d["metadata"]) for d in docs]
+# MAGIC     return retrieve
+# MAGIC
+# MAGIC
+# MAGIC # Wrap the retrieval + generation steps: answer from the semantic cache when a similar query was already answered
+# MAGIC def cached_answer(answer_chain, cache):
+# MAGIC     def answer(x, config=None):
+# MAGIC         if cache is None:
+# MAGIC             return answer_chain.invoke(x, config)
+# MAGIC         cached, vector = cache.lookup(x["query"])
+# MAGIC         if cached is not None:
+# MAGIC             return cached
+# MAGIC         result = answer_chain.invoke(x, config)
+# MAGIC         cache.add(vector, result)
+# MAGIC         return result
+# MAGIC     return answer
+
+# COMMAND ----------
+
+# MAGIC %md
+# MAGIC ### Compressing the conversation history
+# MAGIC
+# MAGIC Sending the full history to the model makes the latency and cost grow with the conversation length, and very long conversations would overflow the context window. The history is compressed to the token budgets of the `history_config` section:
+# MAGIC
+# MAGIC - the last `keep_last_turns` turns are kept verbatim
+# MAGIC - the older turns are summarized incrementally: the summary is cached per conversation (using the cache backend), and only the turns added since the last summary are sent to the model, once they don't fit in `max_history_tokens` anymore
+# MAGIC - the query rewriting prompt only gets the most recent messages fitting in `max_rewrite_history_tokens`
+# MAGIC
+# MAGIC The tokens saved are logged for each request and added to `history_manager.metrics`.
+
+# COMMAND ----------
+
+# MAGIC %%writefile history_compression.py
+# MAGIC import collections
+# MAGIC import hashlib
+# MAGIC import logging
+# MAGIC
+# MAGIC from rag_cache import create_backend
+# MAGIC
+# MAGIC # Token-budgeted conversation history for the RAG chain: the last turns are kept verbatim, older turns are summarized
+# MAGIC # incrementally (the summary is cached per conversation) and the query rewriting prompt gets its own, smaller budget.
+# MAGIC # Configured with the history_config section of rag_chain_config.yaml
+# MAGIC
+# MAGIC logger = logging.getLogger("history_compression")
+# MAGIC
+# MAGIC CompressedHistory = collections.namedtuple("CompressedHistory", ["prompt_messages", "rewrite_history", "summary", "prompt_tokens_saved", "rewrite_tokens_saved"])
+# MAGIC
+# MAGIC
+# MAGIC # Count the tokens with tiktoken when available, approximate with 4 characters per token otherwise
+# MAGIC def default_token_counter():
+# MAGIC     try:
+# MAGIC         import tiktoken
+# MAGIC         encoding = tiktoken.get_encoding("cl100k_base")
+# MAGIC         return lambda text: len(encoding.encode(text))
+# MAGIC     except Exception:
+# MAGIC         return lambda text: len(text) // 4 + 1
+# MAGIC
+# MAGIC
+# MAGIC def format_messages_as_text(messages):
+# MAGIC     return "\n".join([f"{m['role']}: {m['content']}" for m in messages])
+# MAGIC
+# MAGIC
+# MAGIC class HistoryManager:
+# MAGIC     # summarize(previous_summary, messages) returns the new summary, previous_summary being "" for the first call
+# MAGIC     def __init__(self, summarize, count_tokens=None, keep_last_turns=2, max_history_tokens=1500, max_rewrite_history_tokens=400, summary_cache=None):
+# MAGIC         self.summarize = summarize
+# MAGIC         self.count_tokens = count_tokens or default_token_counter()
+# MAGIC         self.keep_last_turns = keep_last_turns
+# MAGIC         self.max_history_tokens = max_history_tokens
+# MAGIC         self.max_rewrite_history_tokens = max_rewrite_history_tokens
+# MAGIC         self.summary_cache = summary_cache or create_backend("memory", "history_summary", 10000, 86400)
+# MAGIC         self.metrics = collections.Counter()
+# MAGIC
+# MAGIC     @staticmethod
+# MAGIC     def from_config(history_config, summarize, cache_backend="memory", redis_url=None):
+# MAGIC         history_config = history_config or {}
+# MAGIC         cache_conf = history_config.get("summary_cache", {})
+# MAGIC         summary_cache = create_backend(cache_backend, "history_summary", cache_conf.get("max_size", 10000), cache_conf.get("ttl_seconds", 86400), redis_url)
+# MAGIC         return HistoryManager(summarize, keep_last_turns=history_config.get("keep_last_turns", 2),
+# MAGIC                               max_history_tokens=history_config.get("max_history_tokens", 1500),
+# MAGIC                               max_rewrite_history_tokens=history_config.get("max_rewrite_history_tokens", 400),
+# MAGIC                               summary_cache=summary_cache)
+# MAGIC
+# MAGIC     def tokens(self, messages):
+# MAGIC         # +4 for the role and message separators
+# MAGIC         return sum([self.count_tokens(m["content"]) + 4 for m in messages])
+# MAGIC
+# MAGIC     # Key of each prefix of the conversation: the key of messages[:i+1] is chained from the key of messages[:i]
+# MAGIC     @staticmethod
+# MAGIC     def prefix_keys(messages):
+# MAGIC         keys, key = [], ""
+# MAGIC         for m in messages:
+# MAGIC             key = hashlib.sha256(f"{key}|{m['role']}|{m['content']}".encode("utf-8")).hexdigest()
+# MAGIC             keys.append(key)
+# MAGIC         return keys
+# MAGIC
+# MAGIC     # Returns the latest cached summary of the conversation, the messages it doesn't cover yet and the prefix keys of the older messages
+# MAGIC     def cached_summary(self, older):
+# MAGIC         keys = HistoryManager.prefix_keys(older)
+# MAGIC         for i in range(len(older), 0, -2):
+# MAGIC             summary = self.summary_cache.get(keys[i - 1])
+# MAGIC             if summary is not None:
+# MAGIC                 return summary, older[i:], keys
+# MAGIC         return "", older, keys
+# MAGIC
+# MAGIC     def compress(self, history):
+# MAGIC         history_tokens = self.tokens(history)
+# MAGIC         summary, verbatim = "", history
+# MAGIC         if history_tokens > self.max_history_tokens:
+# MAGIC             # Keep full turns (user + assistant) so that the roles keep alternating
+# MAGIC             kept = history[-2 * self.keep_last_turns:] if self.keep_last_turns > 0 else []
+# MAGIC             older = history[:len(history) - len(kept)]
+# MAGIC             summary, pending, keys = self.cached_summary(older)
+# MAGIC             # Only summarize the new turns when they don't fit in the budget anymore
+# MAGIC             if pending and self.count_tokens(summary) + self.tokens(pending + kept) > self.max_history_tokens:
+# MAGIC                 summary = self.summarize(summary, pending)
+# MAGIC                 self.summary_cache.set(keys[-1], summary)
+# MAGIC                 self.metrics["summaries"] += 1
+# MAGIC                 pending = []
+# MAGIC             verbatim = pending + kept
+# MAGIC         prompt_messages = verbatim
+# MAGIC         if summary:
+# MAGIC             prompt_messages = [{"role": "user", "content": "Summarize our conversation so far."},
+# MAGIC                                {"role": "assistant", "content": summary}] + verbatim
+# MAGIC         rewrite_history = self.cap_rewrite_history(summary, verbatim)
+# MAGIC         compressed = CompressedHistory(prompt_messages, rewrite_history, summary,
+# MAGIC                                        history_tokens - self.tokens(prompt_messages),
+# MAGIC                                        history_tokens - self.count_tokens(rewrite_history))
+# MAGIC         self.metrics["requests"] += 1
+# MAGIC         self.metrics["prompt_tokens_saved"] += compressed.prompt_tokens_saved
+# MAGIC         self.metrics["rewrite_tokens_saved"] += compressed.rewrite_tokens_saved
+# MAGIC         logger.info(f"history of {len(history)} messages ({history_tokens} tokens): {compressed.prompt_tokens_saved} tokens saved in the prompt, "
+# MAGIC                     f"{compressed.rewrite_tokens_saved} in the query rewriting prompt")
+# MAGIC         return compressed
+# MAGIC
+# MAGIC     # Most recent messages fitting in max_rewrite_history_tokens, as text. The query rewriting mostly needs the last turns
+# MAGIC     def cap_rewrite_history(self, summary, messages):
+# MAGIC         budget = self.max_rewrite_history_tokens
+# MAGIC         lines = []
+# MAGIC         for m in reversed(messages):
+# MAGIC             line = f"{m['role']}: {m['content']}"
+# MAGIC             tokens = self.count_tokens(line)
+# MAGIC             if tokens > budget:
+# MAGIC                 if not lines:
+# MAGIC                     # Always keep (the end of) the last message
+# MAGIC                     lines.append(line[-budget * 4:])
+# MAGIC                 break
+# MAGIC             lines.append(line)
+# MAGIC             budget -= tokens
+# MAGIC         if summary and self.count_tokens(summary) <= budget:
+# MAGIC             lines.append(f"summary of the earlier conversation: {summary}")
+# MAGIC         return "\n".join(reversed(lines))
+
+# COMMAND ----------
+
 # DBTITLE 1,Chat History Extractor Chain
 # MAGIC %%writefile chain.py
 # MAGIC from langchain_community.embeddings import DatabricksEmbeddings
@@ -106,6 +488,9 @@ model_config = mlflow.models.ModelConfig(development_config='rag_chain_config.ya
 # MAGIC from langchain_core.runnables import RunnablePassthrough, RunnableBranch
 # MAGIC from langchain_core.messages import HumanMessage, AIMessage
 # MAGIC
+# MAGIC from rag_cache import RagCaches, cached_query_rewrite, cached_retriever, cached_answer
+# MAGIC from history_compression import HistoryManager, format_messages_as_text
+# MAGIC
 # MAGIC ## Enable MLflow Tracing
 # MAGIC mlflow.langchain.autolog()
 # MAGIC
@@ -171,7 +556,7 @@ model_config = mlflow.models.ModelConfig(development_config='rag_chain_config.ya
 # MAGIC prompt = ChatPromptTemplate.from_messages(
 # MAGIC     [
 # MAGIC         ("system", llm_config.get("llm_prompt_template")),
-# MAGIC         # Note: This chain does not compress the history, so very long converastions can overflow the context window.
+# MAGIC         # Note: the history is compressed to history_config.max_history_tokens (last turns verbatim, older turns summarized)
 # MAGIC         MessagesPlaceholder(variable_name="formatted_chat_history"),
 # MAGIC         # User's most current question
 # MAGIC         ("user", "{question}"),
@@ -179,9 +564,8 @@ model_config = mlflow.models.ModelConfig(development_config='rag_chain_config.ya
 # MAGIC )
 # MAGIC
 # MAGIC
-# MAGIC # Format the converastion history to fit into the prompt template above.
-# MAGIC def format_chat_history_for_prompt(chat_messages_array):
-# MAGIC     history = extract_chat_history(chat_messages_array)
+# MAGIC # Format the (compressed) converastion history to fit into the prompt template above.
+# MAGIC def format_chat_history_for_prompt(history):
 # MAGIC     formatted_chat_history = []
 # MAGIC     if len(history) > 0:
 # MAGIC         for chat_message in history:
@@ -195,13 +579,13 @@ model_config = mlflow.models.ModelConfig(development_config='rag_chain_config.ya
 # MAGIC # Prompt Template for query rewriting to allow converastion history to work - this will translate a query such as "how does it work?" after a question such as "what is spark?" to "how does spark work?".
 # MAGIC query_rewrite_template = """Based on the chat history below, we want you to generate a query for an external data source to retrieve relevant documents so that we can better answer the question. The query should be in natural language. The external data source uses similarity search to search for relevant documents in a vector space. So the query should be similar to the relevant documents semantically. Answer with only the query. Do not add explanation.
 # MAGIC
-# MAGIC Chat history: {chat_history}
+# MAGIC Chat history: {rewrite_chat_history}
 # MAGIC
 # MAGIC Question: {question}"""
 # MAGIC
 # MAGIC query_rewrite_prompt = PromptTemplate(
 # MAGIC     template=query_rewrite_template,
-# MAGIC     input_variables=["chat_history", "question"],
+# MAGIC     input_variables=["rewrite_chat_history", "question"],
 # MAGIC )
 # MAGIC
 # MAGIC
@@ -211,31 +595,71 @@ model_config = mlflow.models.ModelConfig(development_config='rag_chain_config.ya
 # MAGIC     extra_params=llm_config.get("llm_parameters"),
 # MAGIC )
 # MAGIC
+# MAGIC # Caching layer (see rag_cache.py): query rewriting, retriever and semantic answer caches, configured in the cache_config section
+# MAGIC caches = RagCaches.from_config(model_config.get("cache_config"), embed_query=embedding_model.embed_query)
+# MAGIC
+# MAGIC query_rewrite_chain = query_rewrite_prompt | model | StrOutputParser()
+# MAGIC
+# MAGIC # Prompt Template to summarize the older turns of the conversation, incrementally: only the new turns are sent with the previous summary
+# MAGIC history_summary_template = """Summarize the conversation below between a user and an assistant answering questions about Databricks. Keep the facts, product names and open questions needed to continue the conversation. Answer with only the summary, in a few sentences.
+# MAGIC
+# MAGIC Previous summary: {summary}
+# MAGIC
+# MAGIC New messages:
+# MAGIC {messages}"""
+# MAGIC
+# MAGIC history_summary_chain = PromptTemplate.from_template(history_summary_template) | model | StrOutputParser()
+# MAGIC
+# MAGIC def summarize_history(summary, messages):
+# MAGIC     return history_summary_chain.invoke({"summary": summary or "None", "messages": format_messages_as_text(messages)})
+# MAGIC
+# MAGIC # Token-budgeted history (see history_compression.py), configured in the history_config section. The summaries share the cache backend
+# MAGIC history_manager = HistoryManager.from_config(model_config.get("history_config"), summarize_history,
+# MAGIC                                              cache_backend=model_config.get("cache_config").get("backend", "memory"),
+# MAGIC                                              redis_url=model_config.get("cache_config").get("redis_url"))
+# MAGIC
+# MAGIC # Compress the history once per request, for the generation and the query rewriting prompts. Tokens saved are logged and added to history_manager.metrics
+# MAGIC def compress_chat_history(chat_messages_array):
+# MAGIC     compressed = history_manager.compress(extract_chat_history(chat_messages_array))
+# MAGIC     return {
+# MAGIC         "formatted_chat_history": format_chat_history_for_prompt(compressed.prompt_messages),
+# MAGIC         "rewrite_chat_history": compressed.rewrite_history,
+# MAGIC     }
+# MAGIC
+# MAGIC # Retrieval and generation, from the (re-written) query
+# MAGIC answer_chain = (
+# MAGIC     RunnablePassthrough.assign(
+# MAGIC         context=itemgetter("query")
+# MAGIC         | RunnableLambda(cached_retriever(vector_search_as_retriever, caches.retriever))
+# MAGIC         | RunnableLambda(format_context)
+# MAGIC     )
+# MAGIC     | prompt
+# MAGIC     | model
+# MAGIC     | StrOutputParser()
+# MAGIC )
+# MAGIC
 # MAGIC # RAG Chain
 # MAGIC chain = (
 # MAGIC     {
 # MAGIC         "question": itemgetter("messages") | RunnableLambda(extract_user_query_string),
 # MAGIC         "chat_history": itemgetter("messages") | RunnableLambda(extract_chat_history),
-# MAGIC         "formatted_chat_history": itemgetter("messages")
-# MAGIC         | RunnableLambda(format_chat_history_for_prompt),
+# MAGIC         "compressed_history": itemgetter("messages") | RunnableLambda(compress_chat_history),
 # MAGIC     }
-# MAGIC     | RunnablePassthrough()
-# MAGIC     | {
-# MAGIC         "context": RunnableBranch(  # Only re-write the question if there is a chat history
+# MAGIC     | RunnablePassthrough.assign(
+# MAGIC         formatted_chat_history=lambda x: x["compressed_history"]["formatted_chat_history"],
+# MAGIC         rewrite_chat_history=lambda x: x["compressed_history"]["rewrite_chat_history"],
+# MAGIC     )
+# MAGIC     | RunnablePassthrough.assign(
+# MAGIC         query=RunnableBranch(  # Only re-write the question if there is a chat history
 # MAGIC             (
 # MAGIC                 lambda x: len(x["chat_history"]) > 0,
-# MAGIC                 query_rewrite_prompt | model | StrOutputParser(),
+# MAGIC                 RunnableLambda(cached_query_rewrite(query_rewrite_chain, caches.query_rewrite)),
 # MAGIC             ),
 # MAGIC             itemgetter("question"),
 # MAGIC         )
-# MAGIC         | vector_search_as_retriever
-# MAGIC         | RunnableLambda(format_context),
-# MAGIC         "formatted_chat_history": itemgetter("formatted_chat_history"),
-# MAGIC         "question": itemgetter("question"),
-# MAGIC     }
-# MAGIC     | prompt
-# MAGIC     | model
-# MAGIC     | StrOutputParser()
+# MAGIC     )
+# MAGIC     # The semantic cache needs the full answer: only wrap the answer chain when it's enabled to keep streaming otherwise
+# MAGIC     | (RunnableLambda(cached_answer(answer_chain, caches.semantic_answer)) if caches.semantic_answer is not None else answer_chain)
 # MAGIC )
 # MAGIC
 # MAGIC ## Tell MLflow logging where to find your chain.
@@ -255,6 +679,7 @@ with mlflow.start_run(run_name=f"dbdemos_rag_advanced"):
     logged_chain_info = mlflow.langchain.log_model(
         lc_model=os.path.join(os.getcwd(), 'chain.py'),  # Chain code file e.g., /path/to/the/chain.py 
         model_config='rag_chain_config.yaml',  # Chain configuration 
+        code_paths=[os.path.join(os.getcwd(), 'rag_cache.py'), os.path.join(os.getcwd(), 'history_compression.py')],  # Caching and history modules imported by the chain
         artifact_path="chain",  # Required by MLflow
         input_example=model_config.get("input_example"),  # Save the chain's input schema.  MLflow will execute the chain before logging & capture it's output schema.
         example_no_conversion=True,  # Required by MLflow to use the input_example as the chain's schema
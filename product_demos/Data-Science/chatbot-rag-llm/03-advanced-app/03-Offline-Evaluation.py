@@ -85,8 +85,8 @@ request_table = f"{inference_table_catalog}.{inference_table_schema}.`{inference
 print(f"Request logs: {request_table}")
 requests_df = spark.table(request_table)
 print(f"Assessment logs: {assessment_table}")
-#Temporary helper to extract the table - see _resources/00-init-advanced 
-assessment_df = deduplicate_assessments_table(assessment_table)
+#Temporary helper to extract the table - see _resources/00-init-advanced. Only the assessments logged since the previous run are processed.
+assessment_df = update_deduplicated_assessments(assessment_table)
 
 # COMMAND ----------
 
@@ -204,6 +204,36 @@ with mlflow.start_run(run_name="eval_dataset_advanced"):
 
 # COMMAND ----------
 
+# MAGIC %md
+# MAGIC ## Comparing multiple chain versions and configurations
+# MAGIC
+# MAGIC Improving the chatbot requires comparing many variants: previous chain versions, number of retrieved chunks `k`, chunk template, prompt...
+# MAGIC
+# MAGIC The evaluation runner generates the answers of all the candidates in parallel (the retrieval is shared between the configurations for the same question), saves them as they come so that an interrupted run can resume with the same `run_name`, and evaluates each candidate with the same judges. The metrics are saved in a single `eval_comparison` table.
+
+# COMMAND ----------
+
+# MAGIC %run ../_resources/03-evaluation-runner
+
+# COMMAND ----------
+
+with open('rag_chain_config.yaml') as f:
+    base_config = yaml.safe_load(f)
+
+concise_prompt = "You are an assistant answering questions about Databricks, only based on the provided context. If you don't know, say you don't know. Answer in at most 3 sentences. Context: {context}. Question: {question}"
+candidates = [
+    {"name": f"chain_v{model.version}", "model_version": model.version},
+    {"name": "k3", "k": 3},
+    {"name": "k5", "k": 5},
+    {"name": "k10", "k": 10},
+    {"name": "k5_concise_prompt", "k": 5, "prompt": concise_prompt},
+]
+comparison = run_evaluation_comparison(run_name="rag_advanced_comparison", eval_df=spark.table("eval_set_databricks_documentation"),
+                                       candidates=candidates, base_config=base_config, model_name=MODEL_NAME_FQN, max_workers=8)
+display(comparison.select("candidate", "questions", "errors", "metrics", "eval_run_id").orderBy("candidate"))
+
+# COMMAND ----------
+
 # MAGIC %md
 # MAGIC ### This is looking good, let's tag our model as production ready
 # MAGIC
@@ -18,6 +18,9 @@ from langchain_core.prompts import (
 from langchain_core.runnables import RunnablePassthrough, RunnableBranch
 from langchain_core.messages import HumanMessage, AIMessage
 
+from rag_cache import RagCaches, cached_query_rewrite, cached_retriever, cached_answer
+from history_compression import HistoryManager, format_messages_as_text
+
 ## Enable MLflow Tracing
 mlflow.langchain.autolog()
 
@@ -83,7 +86,7 @@ def format_context(docs):
 prompt = ChatPromptTemplate.from_messages(
     [
         ("system", llm_config.get("llm_prompt_template")),
-        # Note: This chain does not compress the history, so very long converastions can overflow the context window.
+        # Note: the history is compressed to history_config.max_history_tokens (last turns verbatim, older turns summarized)
         MessagesPlaceholder(variable_name="formatted_chat_history"),
         # User's most current question
         ("user", "{question}"),
@@ -91,9 +94,8 @@ prompt = ChatPromptTemplate.from_messages(
 )
 
 
-# Format the converastion history to fit into the prompt template above.
-def format_chat_history_for_prompt(chat_messages_array):
-    history = extract_chat_history(chat_messages_array)
+# Format the (compressed) converastion history to fit into the prompt template above.
+def format_chat_history_for_prompt(history):
     formatted_chat_history = []
     if len(history) > 0:
         for chat_message in history:
@@ -107,13 +109,13 @@ def format_chat_history_for_prompt(chat_messages_array):
 # Prompt Template for query rewriting to allow converastion history to work - this will translate a query such as "how does it work?" after a question such as "what is spark?" to "how does spark work?".
 query_rewrite_template = """Based on the chat history below, we want you to generate a query for an external data source to retrieve relevant documents so that we can better answer the question. The query should be in natural language. The external data source uses similarity search to search for relevant documents in a vector space. So the query should be similar to the relevant documents semantically. Answer with only the query. Do not add explanation.
 
-Chat history: {chat_history}
+Chat history: {rewrite_chat_history}
 
 Question: {question}"""
 
 query_rewrite_prompt = PromptTemplate(
     template=query_rewrite_template,
-    input_variables=["chat_history", "question"],
+    input_variables=["rewrite_chat_history", "question"],
 )
 
 
@@ -123,31 +125,71 @@ model = ChatDatabricks(
     extra_params=llm_config.get("llm_parameters"),
 )
 
+# Caching layer (see rag_cache.py): query rewriting, retriever and semantic answer caches, configured in the cache_config section
+caches = RagCaches.from_config(model_config.get("cache_config"), embed_query=embedding_model.embed_query)
+
+query_rewrite_chain = query_rewrite_prompt | model | StrOutputParser()
+
+# Prompt Template to summarize the older turns of the conversation, incrementally: only the new turns are sent with the previous summary
+history_summary_template = """Summarize the conversation below between a user and an assistant answering questions about Databricks. Keep the facts, product names and open questions needed to continue the conversation. Answer with only the summary, in a few sentences.
+
+Previous summary: {summary}
+
+New messages:
+{messages}"""
+
+history_summary_chain = PromptTemplate.from_template(history_summary_template) | model | StrOutputParser()
+
+def summarize_history(summary, messages):
+    return history_summary_chain.invoke({"summary": summary or "None", "messages": format_messages_as_text(messages)})
+
+# Token-budgeted history (see history_compression.py), configured in the history_config section. The summaries share the cache backend
+history_manager = HistoryManager.from_config(model_config.get("history_config"), summarize_history,
+                                             cache_backend=model_config.get("cache_config").get("backend", "memory"),
+                                             redis_url=model_config.get("cache_config").get("redis_url"))
+
+# Compress the history once per request, for the generation and the query rewriting prompts. Tokens saved are logged and added to history_manager.metrics
+def compress_chat_history(chat_messages_array):
+    compressed = history_manager.compress(extract_chat_history(chat_messages_array))
+    return {
+        "formatted_chat_history": format_chat_history_for_prompt(compressed.prompt_messages),
+        "rewrite_chat_history": compressed.rewrite_history,
+    }
+
+# Retrieval and generation, from the (re-written) query
+answer_chain = (
+    RunnablePassthrough.assign(
+        context=itemgetter("query")
+        | RunnableLambda(cached_retriever(vector_search_as_retriever, caches.retriever))
+        | RunnableLambda(format_context)
+    )
+    | prompt
+    | model
+    | StrOutputParser()
+)
+
 # RAG Chain
 chain = (
     {
         "question": itemgetter("messages") | RunnableLambda(extract_user_query_string),
         "chat_history": itemgetter("messages") | RunnableLambda(extract_chat_history),
-        "formatted_chat_history": itemgetter("messages")
-        | RunnableLambda(format_chat_history_for_prompt),
+        "compressed_history": itemgetter("messages") | RunnableLambda(compress_chat_history),
     }
-    | RunnablePassthrough()
-    | {
-        "context": RunnableBranch(  # Only re-write the question if there is a chat history
+    | RunnablePassthrough.assign(
+        formatted_chat_history=lambda x: x["compressed_history"]["formatted_chat_history"],
+        rewrite_chat_history=lambda x: x["compressed_history"]["rewrite_chat_history"],
+    )
+    | RunnablePassthrough.assign(
+        query=RunnableBranch(  # Only re-write the question if there is a chat history
             (
                 lambda x: len(x["chat_history"]) > 0,
-                query_rewrite_prompt | model | StrOutputParser(),
+                RunnableLambda(cached_query_rewrite(query_rewrite_chain, caches.query_rewrite)),
             ),
             itemgetter("question"),
         )
-        | vector_search_as_retriever
-        | RunnableLambda(format_context),
-        "formatted_chat_history": itemgetter("formatted_chat_history"),
-        "question": itemgetter("question"),
-    }
-    | prompt
-    | model
-    | StrOutputParser()
+    )
+    # The semantic cache needs the full answer: only wrap the answer chain when it's enabled to keep streaming otherwise
+    | (RunnableLambda(cached_answer(answer_chain, caches.semantic_answer)) if caches.semantic_answer is not None else answer_chain)
 )
 
 ## Tell MLflow logging where to find your chain.
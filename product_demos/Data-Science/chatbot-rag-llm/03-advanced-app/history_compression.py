@@ -0,0 +1,119 @@
+import collections
+import hashlib
+import logging
+
+from rag_cache import create_backend
+
+# Token-budgeted conversation history for the RAG chain: the last turns are kept verbatim, older turns are summarized
+# incrementally (the summary is cached per conversation) and the query rewriting prompt gets its own, smaller budget.
+# Configured with the history_config section of rag_chain_config.yaml
+
+logger = logging.getLogger("history_compression")
+
+CompressedHistory = collections.namedtuple("CompressedHistory", ["prompt_messages", "rewrite_history", "summary", "prompt_tokens_saved", "rewrite_tokens_saved"])
+
+
+# Count the tokens with tiktoken when available, approximate with 4 characters per token otherwise
+def default_token_counter():
+    try:
+        import tiktoken
+        encoding = tiktoken.get_encoding("cl100k_base")
+        return lambda text: len(encoding.encode(text))
+    except Exception:
+        return lambda text: len(text) // 4 + 1
+
+
+def format_messages_as_text(messages):
+    return "\n".join([f"{m['role']}: {m['content']}" for m in messages])
+
+
+class HistoryManager:
+    # summarize(previous_summary, messages) returns the new summary, previous_summary being "" for the first call
+    def __init__(self, summarize, count_tokens=None, keep_last_turns=2, max_history_tokens=1500, max_rewrite_history_tokens=400, summary_cache=None):
+        self.summarize = summarize
+        self.count_tokens = count_tokens or default_token_counter()
+        self.keep_last_turns = keep_last_turns
+        self.max_history_tokens = max_history_tokens
+        self.max_rewrite_history_tokens = max_rewrite_history_tokens
+        self.summary_cache = summary_cache or create_backend("memory", "history_summary", 10000, 86400)
+        self.metrics = collections.Counter()
+
+    @staticmethod
+    def from_config(history_config, summarize, cache_backend="memory", redis_url=None):
+        history_config = history_config or {}
+        cache_conf = history_config.get("summary_cache", {})
+        summary_cache = create_backend(cache_backend, "history_summary", cache_conf.get("max_size", 10000), cache_conf.get("ttl_seconds", 86400), redis_url)
+        return HistoryManager(summarize, keep_last_turns=history_config.get("keep_last_turns", 2),
+                              max_history_tokens=history_config.get("max_history_tokens", 1500),
+                              max_rewrite_history_tokens=history_config.get("max_rewrite_history_tokens", 400),
+                              summary_cache=summary_cache)
+
+    def tokens(self, messages):
+        # +4 for the role and message separators
+        return sum([self.count_tokens(m["content"]) + 4 for m in messages])
+
+    # Key of each prefix of the conversation: the key of messages[:i+1] is chained from the key of messages[:i]
+    @staticmethod
+    def prefix_keys(messages):
+        keys, key = [], ""
+        for m in messages:
+            key = hashlib.sha256(f"{key}|{m['role']}|{m['content']}".encode("utf-8")).hexdigest()
+            keys.append(key)
+        return keys
+
+    # Returns the latest cached summary of the conversation, the messages it doesn't cover yet and the prefix keys of the older messages
+    def cached_summary(self, older):
+        keys = HistoryManager.prefix_keys(older)
+        for i in range(len(older), 0, -2):
+            summary = self.summary_cache.get(keys[i - 1])
+            if summary is not None:
+                return summary, older[i:], keys
+        return "", older, keys
+
+    def compress(self, history):
+        history_tokens = self.tokens(history)
+        summary, verbatim = "", history
+        if history_tokens > self.max_history_tokens:
+            # Keep full turns (user + assistant) so that the roles keep alternating
+            kept = history[-2 * self.keep_last_turns:] if self.keep_last_turns > 0 else []
+            older = history[:len(history) - len(kept)]
+            summary, pending, keys = self.cached_summary(older)
+            # Only summarize the new turns when they don't fit in the budget anymore
+            if pending and self.count_tokens(summary) + self.tokens(pending + kept) > self.max_history_tokens:
+                summary = self.summarize(summary, pending)
+                self.summary_cache.set(keys[-1], summary)
+                self.metrics["summaries"] += 1
+                pending = []
+            verbatim = pending + kept
+        prompt_messages = verbatim
+        if summary:
+            prompt_messages = [{"role": "user", "content": "Summarize our conversation so far."},
+                               {"role": "assistant", "content": summary}] + verbatim
+        rewrite_history = self.cap_rewrite_history(summary, verbatim)
+        compressed = CompressedHistory(prompt_messages, rewrite_history, summary,
+                                       history_tokens - self.tokens(prompt_messages),
+                                       history_tokens - self.count_tokens(rewrite_history))
+        self.metrics["requests"] += 1
+        self.metrics["prompt_tokens_saved"] += compressed.prompt_tokens_saved
+        self.metrics["rewrite_tokens_saved"] += compressed.rewrite_tokens_saved
+        logger.info(f"history of {len(history)} messages ({history_tokens} tokens): {compressed.prompt_tokens_saved} tokens saved in the prompt, "
+                    f"{compressed.rewrite_tokens_saved} in the query rewriting prompt")
+        return compressed
+
+    # Most recent messages fitting in max_rewrite_history_tokens, as text. The query rewriting mostly needs the last turns
+    def cap_rewrite_history(self, summary, messages):
+        budget = self.max_rewrite_history_tokens
+        lines = []
+        for m in reversed(messages):
+            line = f"{m['role']}: {m['content']}"
+            tokens = self.count_tokens(line)
+            if tokens > budget:
+                if not lines:
+                    # Always keep (the end of) the last message
+                    lines.append(line[-budget * 4:])
+                break
+            lines.append(line)
+            budget -= tokens
+        if summary and self.count_tokens(summary) <= budget:
+            lines.append(f"summary of the earlier conversation: {summary}")
+        return "\n".join(reversed(lines))
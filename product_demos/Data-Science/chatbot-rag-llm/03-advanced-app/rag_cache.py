@@ -0,0 +1,214 @@
+import collections
+import hashlib
+import json
+import threading
+import time
+
+import numpy as np
+
+# Caching layer for the RAG chain: exact match cache for the query rewriting, LRU+TTL cache for the retriever
+# and optional semantic cache for the answers. The caches are configured with the cache_config section of rag_chain_config.yaml
+
+
+# In-process backend: LRU eviction once max_size entries are stored, entries expire after ttl_seconds
+class InMemoryCacheBackend:
+    def __init__(self, max_size=10000, ttl_seconds=3600):
+        self.max_size = max_size
+        self.ttl_seconds = ttl_seconds
+        self.entries = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            value, expires_at = entry
+            if expires_at < time.time():
+                del self.entries[key]
+                return None
+            self.entries.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        with self.lock:
+            self.entries[key] = (value, time.time() + self.ttl_seconds)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+
+
+# Shared backend: all the serving replicas use the same cache. Values must be json serializable.
+class RedisCacheBackend:
+    def __init__(self, url, ttl_seconds=3600, prefix="rag_cache", **kwargs):
+        import redis
+        self.client = redis.Redis.from_url(url)
+        self.ttl_seconds = ttl_seconds
+        self.prefix = prefix
+
+    def get(self, key):
+        value = self.client.get(f"{self.prefix}:{key}")
+        return json.loads(value) if value is not None else None
+
+    def set(self, key, value):
+        self.client.set(f"{self.prefix}:{key}", json.dumps(value), ex=self.ttl_seconds)
+
+
+CACHE_BACKENDS = {"memory": InMemoryCacheBackend, "redis": RedisCacheBackend}
+
+
+def create_backend(backend, name, max_size, ttl_seconds, redis_url=None):
+    if backend not in CACHE_BACKENDS:
+        raise ValueError(f"Unknown cache backend {backend}, must be one of {list(CACHE_BACKENDS.keys())}")
+    if backend == "redis":
+        return RedisCacheBackend(redis_url, ttl_seconds=ttl_seconds, prefix=f"rag_cache:{name}")
+    return InMemoryCacheBackend(max_size=max_size, ttl_seconds=ttl_seconds)
+
+
+# Lower case and collapse the whitespaces so that "What is  Spark?" and "what is spark?" share the same entry
+def normalize_text(text):
+    return " ".join(str(text).lower().split())
+
+
+def cache_key(*parts):
+    return hashlib.sha256(json.dumps(parts, sort_keys=True).encode("utf-8")).hexdigest()
+
+
+# Exact match cache with hit/miss metrics
+class ExactCache:
+    def __init__(self, name, backend):
+        self.name = name
+        self.backend = backend
+        self.metrics = collections.Counter()
+
+    def get_or_compute(self, key, compute):
+        value = self.backend.get(key)
+        if value is not None:
+            self.metrics["hits"] += 1
+            return value
+        self.metrics["misses"] += 1
+        value = compute()
+        if value is not None:
+            self.backend.set(key, value)
+        return value
+
+
+# Reuse the answer of a previous query if the cosine similarity of their embeddings is above the threshold.
+# The entries are kept in process (the lookup is a brute force scan of at most max_size vectors).
+class SemanticCache:
+    def __init__(self, embed_query, similarity_threshold=0.95, max_size=1000, ttl_seconds=3600):
+        self.name = "semantic_answer"
+        self.embed_query = embed_query
+        self.similarity_threshold = similarity_threshold
+        self.max_size = max_size
+        self.ttl_seconds = ttl_seconds
+        self.vectors, self.answers, self.expires_at = [], [], []
+        self.metrics = collections.Counter()
+        self.lock = threading.Lock()
+
+    def embed(self, query):
+        vector = np.asarray(self.embed_query(query), dtype=np.float32)
+        return vector / (np.linalg.norm(vector) or 1.0)
+
+    # Returns (cached answer or None, normalized query embedding)
+    def lookup(self, query):
+        vector = self.embed(query)
+        with self.lock:
+            now = time.time()
+            valid = [i for i, expires_at in enumerate(self.expires_at) if expires_at >= now]
+            if len(valid) < len(self.expires_at):
+                self.vectors = [self.vectors[i] for i in valid]
+                self.answers = [self.answers[i] for i in valid]
+                self.expires_at = [self.expires_at[i] for i in valid]
+            if self.vectors:
+                similarities = np.stack(self.vectors) @ vector
+                best = int(np.argmax(similarities))
+                if similarities[best] >= self.similarity_threshold:
+                    self.metrics["hits"] += 1
+                    return self.answers[best], vector
+        self.metrics["misses"] += 1
+        return None, vector
+
+    def add(self, vector, answer):
+        with self.lock:
+            self.vectors.append(vector)
+            self.answers.append(answer)
+            self.expires_at.append(time.time() + self.ttl_seconds)
+            if len(self.vectors) > self.max_size:
+                self.vectors, self.answers, self.expires_at = self.vectors[1:], self.answers[1:], self.expires_at[1:]
+
+
+class RagCaches:
+    def __init__(self, query_rewrite=None, retriever=None, semantic_answer=None):
+        self.query_rewrite = query_rewrite
+        self.retriever = retriever
+        self.semantic_answer = semantic_answer
+
+    # Build the caches from the cache_config section. Disabled caches are None.
+    @staticmethod
+    def from_config(cache_config, embed_query=None):
+        cache_config = cache_config or {}
+        backend = cache_config.get("backend", "memory")
+        redis_url = cache_config.get("redis_url")
+
+        def exact_cache(name):
+            conf = cache_config.get(name, {})
+            if not conf.get("enabled", False):
+                return None
+            return ExactCache(name, create_backend(backend, name, conf.get("max_size", 10000), conf.get("ttl_seconds", 3600), redis_url))
+
+        semantic_conf = cache_config.get("semantic_answer", {})
+        semantic_answer = None
+        if semantic_conf.get("enabled", False):
+            semantic_answer = SemanticCache(embed_query, semantic_conf.get("similarity_threshold", 0.95),
+                                            semantic_conf.get("max_size", 1000), semantic_conf.get("ttl_seconds", 3600))
+        return RagCaches(exact_cache("query_rewrite"), exact_cache("retriever"), semantic_answer)
+
+    # Hit/miss metrics of the enabled caches
+    def stats(self):
+        stats = {}
+        for cache in [self.query_rewrite, self.retriever, self.semantic_answer]:
+            if cache is not None:
+                hits, misses = cache.metrics["hits"], cache.metrics["misses"]
+                stats[cache.name] = {"hits": hits, "misses": misses, "hit_rate": round(hits / (hits + misses), 3) if hits + misses > 0 else None}
+        return stats
+
+
+def format_history_for_key(chat_history):
+    return [[m["role"], normalize_text(m["content"])] for m in chat_history]
+
+
+# Wrap the query rewriting step. Only called when there is a chat history, the rewritten query is cached on the normalized (history, question)
+def cached_query_rewrite(rewrite_chain, cache):
+    def rewrite(x, config=None):
+        if cache is None:
+            return rewrite_chain.invoke(x, config)
+        key = cache_key(format_history_for_key(x["chat_history"]), normalize_text(x["question"]))
+        return cache.get_or_compute(key, lambda: rewrite_chain.invoke(x, config))
+    return rewrite
+
+
+# Wrap the retriever. The documents are cached as dicts on the normalized query text
+def cached_retriever(retriever, cache):
+    def retrieve(query, config=None):
+        if cache is None:
+            return retriever.invoke(query, config)
+        from langchain_core.documents import Document
+        docs = cache.get_or_compute(cache_key(normalize_text(query)),
+                                    lambda: [{"page_content": d.page_content, "metadata": d.metadata} for d in retriever.invoke(query, config)])
+        return [Document(page_content=d["page_content"], metadata=d["metadata"]) for d in docs]
+    return retrieve
+
+
+# Wrap the retrieval + generation steps: answer from the semantic cache when a similar query was already answered
+def cached_answer(answer_chain, cache):
+    def answer(x, config=None):
+        if cache is None:
+            return answer_chain.invoke(x, config)
+        cached, vector = cache.lookup(x["query"])
+        if cached is not None:
+            return cached
+        result = answer_chain.invoke(x, config)
+        cache.add(vector, result)
+        return result
+    return answer
@@ -13,34 +13,168 @@
 
 # COMMAND ----------
 
+# MAGIC %run ../../../../_resources/03-dataset-downloader
+
+# COMMAND ----------
+
 import requests
 import collections
 import os
  
-def download_file_from_git(dest, owner, repo, path):
-    def download_file(url, destination):
-      local_filename = url.split('/')[-1]
-      # NOTE the stream=True parameter below
-      with requests.get(url, stream=True) as r:
-          r.raise_for_status()
-          print('saving '+destination+'/'+local_filename)
-          with open(destination+'/'+local_filename, 'wb') as f:
-              for chunk in r.iter_content(chunk_size=8192): 
-                  # If you have chunk encoded response uncomment if
-                  # and set chunk_size parameter to None.
-                  #if chunk: 
-                  f.write(chunk)
-      return local_filename
-
-    if not os.path.exists(dest):
-      os.makedirs(dest)
-    from concurrent.futures import ThreadPoolExecutor
-    files = requests.get(f'https://api.github.com/repos/{owner}/{repo}/contents{path}').json()
-    files = [f['download_url'] for f in files if 'NOTICE' not in f['name']]
-    def download_to_dest(url):
-         download_file(url, dest)
-    with ThreadPoolExecutor(max_workers=10) as executor:
-        collections.deque(executor.map(download_to_dest, files))
+
+# COMMAND ----------
+
+import re
+import time
+import random
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+#Compute embeddings with a bounded number of concurrent requests, retrying with backoff on throttling/server errors and splitting the batches exceeding the endpoint payload limits.
+#Uses the mlflow deploy client by default. Set base_url (and token) to call the invocations api of another server directly, ex: a local stub endpoint for tests.
+class EmbeddingClient():
+  RETRYABLE_STATUS = [429, 500, 502, 503, 504]
+
+  def __init__(self, endpoint = "databricks-gte-large-en", base_url = None, token = None, max_batch_size = 150, max_workers = 4, max_retries = 5, backoff_factor = 0.5, timeout = 120, verbose = True):
+    self.endpoint = endpoint
+    self.base_url = base_url
+    #Reduced when the endpoint rejects a batch as too large
+    self.batch_size = max_batch_size
+    self.max_retries = max_retries
+    self.backoff_factor = backoff_factor
+    self.timeout = timeout
+    self.verbose = verbose
+    self.lock = threading.Lock()
+    self.stats = collections.Counter()
+    self.metrics = []
+    if base_url is None:
+      import mlflow.deployments
+      self.deploy_client = mlflow.deployments.get_deploy_client("databricks")
+    else:
+      from requests.adapters import HTTPAdapter
+      self.session = requests.Session()
+      self.session.mount(base_url, HTTPAdapter(pool_connections=1, pool_maxsize=max_workers))
+      if token is not None:
+        self.session.headers["Authorization"] = f"Bearer {token}"
+    self.executor = ThreadPoolExecutor(max_workers=max_workers)
+
+  def predict(self, batch):
+    if self.base_url is None:
+      response = self.deploy_client.predict(endpoint=self.endpoint, inputs={"input": batch})
+    else:
+      r = self.session.post(f"{self.base_url.rstrip('/')}/serving-endpoints/{self.endpoint}/invocations", json={"input": batch}, timeout=self.timeout)
+      r.raise_for_status()
+      response = r.json()
+    return [e['embedding'] for e in response['data']]
+
+  @staticmethod
+  def error_details(e):
+    response = getattr(e, "response", None)
+    status = getattr(response, "status_code", None)
+    message = str(e) + (response.text if response is not None else "")
+    if status is None:
+      #Some clients only report the http status in the error message
+      match = re.search(r"\b(400|413|429|5\d\d)\b", message)
+      status = int(match.group(1)) if match else None
+    retry_after = response.headers.get("Retry-After") if response is not None else None
+    return status, message, float(retry_after) if retry_after and retry_after.isdigit() else None
+
+  def embed_batch(self, batch):
+    for attempt in range(self.max_retries + 1):
+      try:
+        embeddings = self.predict(batch)
+        with self.lock:
+          self.stats["requests"] += 1
+        return embeddings
+      except Exception as e:
+        status, message, retry_after = EmbeddingClient.error_details(e)
+        too_large = status == 413 or (status == 400 and re.search(r"too large|too many|exceed|maximum", message, re.IGNORECASE))
+        if too_large and len(batch) > 1:
+          #Split the batch in 2 and keep the smaller size for the next batches
+          half = len(batch) // 2
+          with self.lock:
+            self.stats["splits"] += 1
+            self.batch_size = min(self.batch_size, half)
+          return self.embed_batch(batch[:half]) + self.embed_batch(batch[half:])
+        retryable = status in EmbeddingClient.RETRYABLE_STATUS or isinstance(e, (requests.ConnectionError, requests.Timeout))
+        if not retryable or attempt == self.max_retries:
+          raise
+        with self.lock:
+          self.stats["retries"] += 1
+        #Exponential backoff with jitter, unless the server told us how long to wait
+        time.sleep(retry_after if retry_after is not None else self.backoff_factor * 2**attempt * (0.5 + random.random()))
+
+  #Returns the embeddings of the texts, in the same order
+  def embed(self, texts):
+    start = time.time()
+    self.stats.clear()
+    batches = [texts[i:i + self.batch_size] for i in range(0, len(texts), self.batch_size)]
+    embeddings = [e for batch_embeddings in self.executor.map(self.embed_batch, batches) for e in batch_embeddings]
+    duration = time.time() - start
+    metrics = {"rows": len(texts), "batch_size": self.batch_size, "requests": self.stats["requests"], "retries": self.stats["retries"], "splits": self.stats["splits"],
+               "latency_sec": round(duration, 3), "rows_per_sec": round(len(texts) / duration, 1) if duration > 0 else None}
+    self.metrics.append(metrics)
+    if self.verbose:
+      print(f"embedding batch: {metrics}")
+    return embeddings
+
+  def close(self):
+    self.executor.shutdown(wait=False)
+
+# COMMAND ----------
+
+#Delta cache of the chunk embeddings, keyed by the embedding endpoint and the sha256 of the chunk text.
+#Unchanged chunks are never sent again to the embedding endpoint when the documentation is re-indexed.
+def create_embedding_cache(cache_table = "embedding_cache"):
+  spark.sql(f"""CREATE TABLE IF NOT EXISTS {cache_table} (
+                  endpoint STRING,
+                  content_sha STRING,
+                  embedding ARRAY<FLOAT>,
+                  created_at TIMESTAMP)""")
+
+#Insert the new (endpoint, content_sha, embedding) entries in the cache. Returns the number of inserted entries
+def merge_into_embedding_cache(df, cache_table = "embedding_cache"):
+  df.createOrReplaceTempView("embedding_cache_updates")
+  metrics = df.sparkSession.sql(f"""MERGE INTO {cache_table} c USING embedding_cache_updates u
+                                      ON c.endpoint = u.endpoint AND c.content_sha = u.content_sha
+                                    WHEN NOT MATCHED THEN INSERT (endpoint, content_sha, embedding, created_at) VALUES (u.endpoint, u.content_sha, u.embedding, current_timestamp())""").collect()
+  return metrics[0]["num_inserted_rows"] if metrics else 0
+
+#Append the chunks with their embedding to the target table, only calling the embedding udf for the chunks missing from the cache.
+#Use it as a foreachBatch function: lambda batch_df, batch_id: append_with_cached_embeddings(batch_df, ...)
+def append_with_cached_embeddings(df, target_table, embedding_udf, endpoint, content_col = "content", cache_table = "embedding_cache"):
+  #the chunks are used twice (cache lookup and final write): persist them to avoid parsing the documents again
+  chunks = df.withColumn("content_sha", F.sha2(F.col(content_col), 256)).persist()
+  try:
+    cache = df.sparkSession.table(cache_table).filter(F.col("endpoint") == endpoint)
+    misses = (chunks.select("content_sha", content_col).dropDuplicates(["content_sha"])
+                    .join(cache, "content_sha", "left_anti")
+                    .select(F.lit(endpoint).alias("endpoint"), "content_sha", embedding_udf(content_col).alias("embedding")))
+    embedded = merge_into_embedding_cache(misses, cache_table)
+    (chunks.join(cache.select("content_sha", "embedding"), "content_sha")
+           .drop("content_sha")
+           .write.mode("append").saveAsTable(target_table))
+    total = chunks.count()
+    print(f"{total} chunks written to {target_table}: {total - embedded} embeddings from the cache, {embedded} new chunks embedded with {endpoint}")
+  finally:
+    chunks.unpersist()
+
+#Bulk load embeddings already computed in a table (ex: databricks_pdf_documentation) in the cache, without calling the endpoint
+def backfill_embedding_cache(source_table, endpoint, content_col = "content", embedding_col = "embedding", cache_table = "embedding_cache"):
+  entries = (spark.table(source_table).filter(F.col(embedding_col).isNotNull() & F.col(content_col).isNotNull())
+                  .select(F.lit(endpoint).alias("endpoint"), F.sha2(F.col(content_col), 256).alias("content_sha"), F.col(embedding_col).alias("embedding"))
+                  .dropDuplicates(["endpoint", "content_sha"]))
+  inserted = merge_into_embedding_cache(entries, cache_table)
+  print(f"{inserted} embeddings from {source_table} added to {cache_table}")
+  return inserted
+
+#Remove the entries of the retired embedding models (all endpoints not in keep_endpoints)
+def evict_embedding_cache(keep_endpoints, cache_table = "embedding_cache"):
+  endpoints = ", ".join([f"'{e}'" for e in keep_endpoints])
+  metrics = spark.sql(f"DELETE FROM {cache_table} WHERE endpoint NOT IN ({endpoints})").collect()
+  deleted = metrics[0]["num_affected_rows"] if metrics else 0
+  print(f"{deleted} embeddings of retired endpoints removed from {cache_table}")
+  return deleted
 
 # COMMAND ----------
 
@@ -86,6 +220,81 @@ def deduplicate_assessments_table(assessment_table):
 
 # COMMAND ----------
 
+from pyspark.sql.window import Window
+
+# Incremental version of deduplicate_assessments_table, materialized in 3 tables: <target_table>_requests (latest text assessment per request_id),
+# <target_table>_retrievals (retrieval assessments per request_id, source and step) and <target_table> (the 2 joined, same output as deduplicate_assessments_table).
+# The assessment logs are read with an availableNow stream: each run only reads the rows appended since the previous one, whatever their (event) timestamp,
+# and only the request_ids of these rows are joined again. All the steps are idempotent: a batch can safely be processed again after a failure.
+def update_deduplicated_assessments(assessment_table, target_table = "assessments_deduplicated", checkpoint_location = None):
+    requests_table, retrievals_table = f"{target_table}_requests", f"{target_table}_retrievals"
+    if checkpoint_location is None:
+        spark.sql(f"CREATE VOLUME IF NOT EXISTS `{catalog}`.`{db}`.volume_databricks_documentation")
+        checkpoint_location = f"/Volumes/{catalog}/{db}/volume_databricks_documentation/checkpoints/{target_table}"
+
+    def deduplicate(assessments):
+        latest_requests = (assessments.where("text_assessment is not NULL")
+                                      .withColumn("row_number", F.row_number().over(Window.partitionBy("request_id").orderBy(F.col("timestamp").desc())))
+                                      .where("row_number = 1").drop("row_number", "retrieval_assessment", "step_id"))
+        retrievals = (assessments.where("retrieval_assessment is not NULL")
+                                 .groupBy("request_id", F.col("source.id").alias("source_id"), "step_id")
+                                 .agg(F.max("timestamp").alias("timestamp"), F.any_value("source").alias("source"), F.collect_list("retrieval_assessment").alias("retrieval_assessments")))
+        return latest_requests, retrievals
+
+    # Full join of the requests and retrievals of the given request_ids. The key is kept in _request_id: the rows without text assessment have a null request_id
+    def join_assessments(request_ids):
+        requests = spark.table(requests_table).join(request_ids, "request_id", "left_semi")
+        retrievals = (spark.table(retrievals_table).join(request_ids, "request_id", "left_semi").drop("source_id", "step_id", "timestamp")
+                           .withColumnRenamed("request_id", "request_id2").withColumnRenamed("source", "source2"))
+        return requests.join(
+            retrievals,
+            (requests.request_id == retrievals.request_id2) & (requests.source.id == retrievals.source2.id),
+            "full"
+        ).select(
+            [str(col) for col in requests.columns] + [retrievals.retrieval_assessments, F.coalesce(requests.request_id, retrievals.request_id2).alias("_request_id")]
+        )
+
+    assessments = spark.table(assessment_table)
+    if not spark.catalog.tableExists(target_table):
+        # New (or reset) target: read the full assessment logs again
+        dbutils.fs.rm(checkpoint_location, True)
+        latest_requests, retrievals = deduplicate(assessments)
+        latest_requests.limit(0).write.mode("ignore").saveAsTable(requests_table)
+        retrievals.limit(0).write.mode("ignore").saveAsTable(retrievals_table)
+        join_assessments(spark.table(requests_table).select("request_id")).limit(0).write.mode("ignore").saveAsTable(target_table)
+
+    def merge_assessments(batch, batch_id):
+        batch = batch.persist()
+        latest_requests, retrievals = deduplicate(batch)
+        latest_requests.createOrReplaceTempView("new_request_assessments")
+        batch.sparkSession.sql(f"""MERGE INTO {requests_table} t USING new_request_assessments s ON t.request_id = s.request_id
+                      WHEN MATCHED AND s.timestamp > t.timestamp THEN UPDATE SET *
+                      WHEN NOT MATCHED THEN INSERT *""")
+        # Only append the retrieval assessments not already saved (compared as json as they contain maps)
+        retrievals.createOrReplaceTempView("new_retrieval_assessments")
+        batch.sparkSession.sql(f"""MERGE INTO {retrievals_table} t USING new_retrieval_assessments s
+                        ON t.request_id = s.request_id AND t.source_id = s.source_id AND t.step_id <=> s.step_id
+                      WHEN MATCHED THEN UPDATE SET
+                        t.retrieval_assessments = concat(t.retrieval_assessments, filter(s.retrieval_assessments, a -> NOT array_contains(transform(t.retrieval_assessments, b -> to_json(b)), to_json(a)))),
+                        t.timestamp = greatest(t.timestamp, s.timestamp)
+                      WHEN NOT MATCHED THEN INSERT *""")
+        # Replace the joined rows of the request_ids of this batch only
+        request_ids = batch.select("request_id").distinct()
+        request_ids.createOrReplaceTempView("new_assessment_request_ids")
+        batch.sparkSession.sql(f"DELETE FROM {target_table} WHERE _request_id IN (SELECT request_id FROM new_assessment_request_ids)")
+        join_assessments(request_ids).write.mode("append").saveAsTable(target_table)
+        batch.unpersist()
+
+    (spark.readStream.option("skipChangeCommits", "true").table(assessment_table)
+          .writeStream
+            .foreachBatch(merge_assessments)
+            .option("checkpointLocation", checkpoint_location)
+            .trigger(availableNow=True)
+          .start().awaitTermination())
+    return spark.table(target_table).drop("_request_id")
+
+# COMMAND ----------
+
 # Helper function
 def get_latest_model(model_name):
     from mlflow.tracking import MlflowClient
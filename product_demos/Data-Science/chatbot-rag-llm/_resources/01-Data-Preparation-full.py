@@ -109,9 +109,10 @@ import tiktoken
 #Create our tokenizer
 tokenizer = tiktoken.encoding_for_model("gpt-3.5-turbo")
 
-#Truncate the given text to the number of token.
-def truncate(text, tokenizer, max_tokens = 4000):
-    token_count = len(tokenizer.encode(text))y
+#Truncate the given text to the number of token. The token count can be given to avoid tokenizing the text again.
+def truncate(text, tokenizer, max_tokens = 4000, token_count = None):
+    if token_count is None:
+        token_count = len(tokenizer.encode(text))
     if token_count <= max_tokens:
         return text
         # Tokenize the text to get the tokens
@@ -143,29 +144,28 @@ print(f"truncated to 10 tokens: {truncated_sentence}")
 from bs4 import BeautifulSoup
 
 # Remove multiple line breaks and truncate the model
-def cleanup_and_truncate_text(text, tokenizer, max_tokens = 4000):
-    return truncate(re.sub(r'\n{3,}', '\n\n', text).strip(), tokenizer, max_tokens)
+def cleanup_and_truncate_text(text, tokenizer, max_tokens = 4000, token_count = None):
+    return truncate(re.sub(r'\n{3,}', '\n\n', text).strip(), tokenizer, max_tokens, token_count)
     
 #Split the text in chunk between 1000 and 4000 tokens
 #This consider that our sections between H2 are of decent size (not > 4000 tokens), which is the case with our corpus. 
 #H2 Sections longer than 4000 will be truncated.
+#The html is cut before each h2 in a single pass and each section is parsed and tokenized once: chunks are merged on the token counts carried forward.
 def split_html_by_h2(soup, html_content, tokenizer, max_tokens = 4000, min_chunk_size = 1000):
     chunks = []
-    last_index = 0
-    for element in soup.find_all(['h2']):
-        h2_position = html_content.find(str(element))
-        chunk = html_content[last_index:h2_position]
-        chunk_text = BeautifulSoup(chunk).get_text()
+    chunk_text, chunk_tokens = "", 0
+    for section in re.split(r'(?=<h2[\s>])', html_content):
         # Split on the next H2 only if we have more than half the max. 
         # This prevents from having too small chunks
-        if len(tokenizer.encode(chunk_text)) > max_tokens/2:
-            last_index = h2_position
-            chunks.append(cleanup_and_truncate_text(chunk_text, tokenizer, max_tokens))
+        if chunk_tokens > max_tokens/2:
+            chunks.append(cleanup_and_truncate_text(chunk_text, tokenizer, max_tokens, chunk_tokens))
+            chunk_text, chunk_tokens = "", 0
+        section_text = BeautifulSoup(section).get_text()
+        chunk_text += section_text
+        chunk_tokens += len(tokenizer.encode(section_text))
     #Append the last chunk
-    chunk = html_content[last_index:]
-    chunk_text = BeautifulSoup(chunk).get_text()
-    if len(tokenizer.encode(chunk_text)) > min_chunk_size:
-        chunks.append(cleanup_and_truncate_text(chunk_text, tokenizer, max_tokens))
+    if chunk_tokens > min_chunk_size:
+        chunks.append(cleanup_and_truncate_text(chunk_text, tokenizer, max_tokens, chunk_tokens))
     return chunks
   
 #Let's try to split our doc between h2:
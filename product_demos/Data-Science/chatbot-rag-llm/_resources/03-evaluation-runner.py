@@ -0,0 +1,176 @@
+# Databricks notebook source
+# MAGIC %md
+# MAGIC # Evaluation runner comparing multiple chain versions and configurations
+# MAGIC
+# MAGIC Helper for the offline evaluation notebook, do not edit.
+# MAGIC
+# MAGIC Each candidate is either a registered chain version (`{"name": ..., "model_version": 3}`) or a configuration overriding the `rag_chain_config.yaml` retriever/prompt settings (`{"name": ..., "k": 5, "chunk_template": ..., "prompt": ...}`):
+# MAGIC
+# MAGIC - the answers of all the candidates are generated in parallel with a bounded worker pool
+# MAGIC - the retrieval is cached per (index, question, k) across the configurations: a cached result with a bigger k also serves the smaller ones
+# MAGIC - the answers are saved in the `eval_candidate_outputs` table as they are generated: a run restarted with the same `run_name` only generates the missing answers and skips the candidates already evaluated
+# MAGIC - the metrics of all the candidates are saved in a single `eval_comparison` table
+
+# COMMAND ----------
+
+import json
+import time
+import threading
+import collections
+import pandas as pd
+import mlflow.deployments
+from databricks.vector_search.client import VectorSearchClient
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+EVAL_OUTPUTS_SCHEMA = "run_name STRING, candidate STRING, request_id STRING, response STRING, retrieved_context ARRAY<STRUCT<doc_uri: STRING, content: STRING>>, latency_ms DOUBLE, error STRING"
+EVAL_COMPARISON_SCHEMA = "run_name STRING, candidate STRING, candidate_config STRING, eval_run_id STRING, questions INT, errors INT, metrics MAP<STRING, DOUBLE>, evaluated_at TIMESTAMP"
+
+
+# Vector search results cached per (index, question, k)
+class RetrievalCache:
+    def __init__(self, embedding_endpoint):
+        self.embedding_endpoint = embedding_endpoint
+        self.entries = {}
+        self.metrics = collections.Counter()
+        self.lock = threading.Lock()
+        self.deploy_client = mlflow.deployments.get_deploy_client("databricks")
+        self.vsc = VectorSearchClient(disable_notice=True)
+        self.indexes = {}
+
+    def search(self, index_name, question, k, schema):
+        with self.lock:
+            if index_name not in self.indexes:
+                self.indexes[index_name] = self.vsc.get_index(VECTOR_SEARCH_ENDPOINT_NAME, index_name)
+            index = self.indexes[index_name]
+        # Self-managed index: compute the question embedding with the same model as the documents
+        embedding = self.deploy_client.predict(endpoint=self.embedding_endpoint, inputs={"input": [question]})['data'][0]['embedding']
+        results = index.similarity_search(query_vector=embedding, columns=[schema["document_uri"], schema["chunk_text"]], num_results=k)
+        return [{"doc_uri": r[0], "content": r[1]} for r in results.get('result', {}).get('data_array', [])]
+
+    def get(self, index_name, question, k, schema):
+        key = (index_name, question)
+        with self.lock:
+            entry = self.entries.get(key)
+        if entry is not None and entry[0] >= k:
+            self.metrics["hits"] += 1
+            return entry[1][:k]
+        self.metrics["misses"] += 1
+        docs = self.search(index_name, question, k, schema)
+        with self.lock:
+            if key not in self.entries or self.entries[key][0] < k:
+                self.entries[key] = (k, docs)
+        return docs
+
+
+# Merge the candidate overrides in the base rag_chain_config
+def candidate_chain_config(base_config, candidate):
+    config = json.loads(json.dumps(base_config))
+    retriever_config, llm_config = config["retriever_config"], config["llm_config"]
+    if "k" in candidate:
+        retriever_config["parameters"]["k"] = candidate["k"]
+    if "chunk_template" in candidate:
+        retriever_config["chunk_template"] = candidate["chunk_template"]
+    if "vector_search_index" in candidate:
+        retriever_config["vector_search_index"] = candidate["vector_search_index"]
+    if "prompt" in candidate:
+        llm_config["llm_prompt_template"] = candidate["prompt"]
+    if "llm_endpoint_name" in candidate:
+        config["databricks_resources"]["llm_endpoint_name"] = candidate["llm_endpoint_name"]
+    return config
+
+
+# Same steps as the chain for a single question: retrieval, prompt with the formatted context, generation
+def answer_with_config(config, question, retrieval_cache, deploy_client):
+    retriever_config, llm_config = config["retriever_config"], config["llm_config"]
+    docs = retrieval_cache.get(retriever_config["vector_search_index"], question, retriever_config["parameters"]["k"], retriever_config["schema"])
+    context = "".join([retriever_config["chunk_template"].format(chunk_text=d["content"], document_uri=d["doc_uri"]) for d in docs])
+    messages = [{"role": "system", "content": llm_config["llm_prompt_template"].format(context=context, question=question)},
+                {"role": "user", "content": question}]
+    response = deploy_client.predict(endpoint=config["databricks_resources"]["llm_endpoint_name"], inputs={"messages": messages, **llm_config["llm_parameters"]})
+    return response["choices"][0]["message"]["content"], docs
+
+
+def answer_with_chain(chain, question):
+    return chain.invoke({"messages": [{"role": "user", "content": question}]}), None
+
+
+def save_eval_outputs(rows, outputs_table):
+    if len(rows) > 0:
+        spark.createDataFrame(rows, EVAL_OUTPUTS_SCHEMA).write.mode("append").saveAsTable(outputs_table)
+
+
+# Evaluate all the candidates on the eval set and return the comparison (one row per candidate)
+def run_evaluation_comparison(run_name, eval_df, candidates, base_config, model_name, max_workers=8, outputs_table="eval_candidate_outputs",
+                              comparison_table="eval_comparison", flush_every=50):
+    spark.sql(f"CREATE TABLE IF NOT EXISTS {outputs_table} ({EVAL_OUTPUTS_SCHEMA})")
+    spark.sql(f"CREATE TABLE IF NOT EXISTS {comparison_table} ({EVAL_COMPARISON_SCHEMA})")
+    if "request_id" not in eval_df.columns:
+        eval_df = eval_df.withColumn("request_id", F.sha2("request", 256))
+    eval_pdf = eval_df.toPandas()
+    questions = dict(zip(eval_pdf["request_id"], eval_pdf["request"]))
+
+    # Resume: skip the candidates already evaluated and the answers already generated for this run
+    evaluated = {r["candidate"] for r in spark.table(comparison_table).filter(F.col("run_name") == run_name).select("candidate").collect()}
+    candidates = [c for c in candidates if c["name"] not in evaluated]
+    done = collections.defaultdict(set)
+    for r in spark.table(outputs_table).filter((F.col("run_name") == run_name) & F.col("error").isNull()).select("candidate", "request_id").collect():
+        done[r["candidate"]].add(r["request_id"])
+    print(f"{len(evaluated)} candidates already evaluated for {run_name}, {len(candidates)} to evaluate, {sum([len(v) for v in done.values()])} answers already generated")
+    if len(candidates) == 0:
+        return spark.table(comparison_table).filter(F.col("run_name") == run_name)
+
+    deploy_client = mlflow.deployments.get_deploy_client("databricks")
+    retrieval_cache = RetrievalCache(base_config["retriever_config"]["embedding_model"])
+    configs = {c["name"]: candidate_chain_config(base_config, c) for c in candidates if "model_version" not in c}
+    chains = {c["name"]: mlflow.langchain.load_model(f"models:/{model_name}/{c['model_version']}") for c in candidates if "model_version" in c}
+    tasks = [(c["name"], request_id) for c in candidates for request_id in questions if request_id not in done[c["name"]]]
+
+    def generate(candidate, request_id):
+        start = time.time()
+        try:
+            if candidate in chains:
+                response, docs = answer_with_chain(chains[candidate], questions[request_id])
+            else:
+                response, docs = answer_with_config(configs[candidate], questions[request_id], retrieval_cache, deploy_client)
+            return (run_name, candidate, request_id, response, docs, (time.time() - start) * 1000, None)
+        except Exception as e:
+            return (run_name, candidate, request_id, None, None, (time.time() - start) * 1000, str(e)[:1000])
+
+    # Warm the retrieval cache with the biggest k of each index: the configurations with a smaller k reuse it
+    max_k = collections.defaultdict(int)
+    for config in configs.values():
+        index_name = config["retriever_config"]["vector_search_index"]
+        max_k[index_name] = max(max_k[index_name], config["retriever_config"]["parameters"]["k"])
+    schema = base_config["retriever_config"]["schema"]
+    start = time.time()
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        list(executor.map(lambda t: retrieval_cache.get(t[0], t[1], t[2], schema), [(i, q, k) for i, k in max_k.items() for q in set(questions.values())]))
+        # Generate the answers, saving them every flush_every answers so that an interrupted run can resume
+        rows = []
+        futures = [executor.submit(generate, candidate, request_id) for candidate, request_id in tasks]
+        for i, future in enumerate(as_completed(futures)):
+            rows.append(future.result())
+            if len(rows) >= flush_every or i == len(futures) - 1:
+                save_eval_outputs(rows, outputs_table)
+                rows = []
+    print(f"{len(tasks)} answers generated in {time.time() - start:.1f}s, retrieval cache: {dict(retrieval_cache.metrics)}")
+
+    # Evaluate each candidate on its generated answers with the agent evaluation judges (the judge calls are parallelized by mlflow.evaluate)
+    outputs = spark.table(outputs_table).filter((F.col("run_name") == run_name) & F.col("error").isNull()).toPandas()
+    comparison = []
+    for candidate in candidates:
+        candidate_outputs = outputs[outputs["candidate"] == candidate["name"]].drop_duplicates("request_id", keep="last")
+        data = eval_pdf.merge(candidate_outputs[["request_id", "response", "retrieved_context"]], on="request_id")
+        if "model_version" in candidate:
+            # The retrieved documents of the registered chains are only available in their traces
+            data = data.drop(columns=["retrieved_context"])
+        else:
+            data["retrieved_context"] = data["retrieved_context"].apply(lambda docs: [d.asDict() if hasattr(d, "asDict") else d for d in docs])
+        with mlflow.start_run(run_name=f"{run_name}_{candidate['name']}") as run:
+            mlflow.log_param("candidate_config", json.dumps(candidate))
+            eval_results = mlflow.evaluate(data=data, model_type="databricks-agent")
+        metrics = {k: float(v) for k, v in eval_results.metrics.items() if isinstance(v, (int, float))}
+        comparison.append((run_name, candidate["name"], json.dumps(candidate), run.info.run_id, len(questions), len(questions) - len(data), metrics, pd.Timestamp.now().to_pydatetime()))
+        # Save each candidate as soon as it's evaluated
+        spark.createDataFrame(comparison[-1:], EVAL_COMPARISON_SCHEMA).write.mode("append").saveAsTable(comparison_table)
+    return spark.table(comparison_table).filter(F.col("run_name") == run_name)
@@ -132,6 +132,30 @@ val_ds.set_transform(preprocess_val)
 
 # COMMAND ----------
 
+# MAGIC %md
+# MAGIC ### Faster epochs with preprocessed image shards
+# MAGIC
+# MAGIC The transformations above decode every JPEG image again at each epoch. With `use_preprocessed_shards`, the images are decoded and resized once with `materialize_image_shards` (see the `_resources/00-init` notebook) and saved as uint8 `.npy` shards in the volume. The training then memory-maps the shards and only applies the random crop and the normalization.
+
+# COMMAND ----------
+
+# DBTITLE 1,Use preprocessed shards (decode the images once)
+from torchvision.transforms import ConvertImageDtype
+
+use_preprocessed_shards = True
+
+if use_preprocessed_shards:
+  image_size = (model_def.size['height'], model_def.size['width'])
+  #Only rebuilt when training_dataset_augmented changes
+  materialize_image_shards("training_dataset_augmented", "training_dataset_preprocessed", f"{volume_folder}/preprocessed_shards", *image_size)
+  shards_index = spark.table("training_dataset_preprocessed").toPandas().sample(frac=1, random_state=42)
+  train_size = int(len(shards_index) * 0.8)
+  #Same transformations as above, applied on the uint8 tensors already resized to the model size
+  train_ds = ImageShardDataset(shards_index[:train_size], Compose([RandomResizedCrop(image_size, antialias=True), ConvertImageDtype(torch.float), normalize]))
+  val_ds = ImageShardDataset(shards_index[train_size:], Compose([ConvertImageDtype(torch.float), normalize]))
+
+# COMMAND ----------
+
 # DBTITLE 1,Build our model from the pretrained model
 from transformers import AutoModelForImageClassification, TrainingArguments, Trainer
 
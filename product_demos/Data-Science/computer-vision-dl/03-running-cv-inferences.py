@@ -128,6 +128,151 @@ display(df.select('filename', 'content').withColumn("prediction", detect_damaged
 
 # COMMAND ----------
 
+# MAGIC %md 
+# MAGIC ### High-throughput inference: pipelined image decoding and batched model calls
+# MAGIC
+# MAGIC The UDF above decodes every image on the main thread, then lets the pipeline pre-process the images one by one. Image decoding often costs as much as the model itself, especially on CPU.
+# MAGIC
+# MAGIC Let's build a faster inference path:
+# MAGIC
+# MAGIC - the JPEG images are decoded and resized by a pool of background threads (PIL releases the GIL while decoding)
+# MAGIC - the decoded images are copied into a pre-allocated tensor of `micro_batch_size` images, normalized in place and sent to the model
+# MAGIC - the decoding of the next micro-batches runs while the model processes the current one
+# MAGIC - the best class is extracted with a single vectorized softmax/argmax over the logits
+# MAGIC
+# MAGIC Each Spark task runs its own model with `spark.task.cpus` torch threads, so the inference scales on all the executor cores (or GPUs) without oversubscribing the CPUs.
+
+# COMMAND ----------
+
+import collections
+from concurrent.futures import ThreadPoolExecutor
+
+#Decode the JPEG bytes as a HWC uint8 array of the model input size
+def decode_and_resize(content, size):
+  image = Image.open(io.BytesIO(content))
+  #JPEG only: let the decoder downscale the image directly (much faster than decoding the full size image)
+  image.draft("RGB", size)
+  return np.asarray(image.convert("RGB").resize(size, Image.BILINEAR))
+
+#Batched image classification with the image decoding running in background threads, overlapping the model calls
+class PipelinedImageClassifier():
+  def __init__(self, model, image_processor, device = torch.device("cpu"), micro_batch_size = 64, decode_threads = 4, prefetch_batches = 2):
+    self.model = model.to(device).eval()
+    self.device = device
+    self.micro_batch_size = micro_batch_size
+    self.decode_threads = decode_threads
+    self.prefetch_batches = prefetch_batches
+    size = image_processor.size
+    #PIL expects (width, height)
+    self.size = (size["width"], size["height"]) if "height" in size else (size["shortest_edge"], size["shortest_edge"])
+    self.mean = torch.tensor(image_processor.image_mean, device=device).view(1, 3, 1, 1) * 255
+    self.std = torch.tensor(image_processor.image_std, device=device).view(1, 3, 1, 1) * 255
+    id2label = model.config.id2label
+    self.labels = np.array([id2label[i] for i in range(len(id2label))])
+    #Reused for all the micro-batches: pinned memory speeds up the copy to the GPU
+    self.buffer = torch.empty((micro_batch_size, self.size[1], self.size[0], 3), dtype=torch.uint8)
+    if device.type == "cuda":
+      self.buffer = self.buffer.pin_memory()
+
+  def decode_batch(self, contents):
+    return [decode_and_resize(c, self.size) for c in contents]
+
+  def infer_batch(self, images):
+    n = len(images)
+    np.stack(images, out=self.buffer[:n].numpy())
+    #HWC uint8 to normalized NCHW float, done on the device
+    pixel_values = self.buffer[:n].to(self.device, non_blocking=True).permute(0, 3, 1, 2).float()
+    pixel_values.sub_(self.mean).div_(self.std)
+    logits = self.model(pixel_values=pixel_values).logits
+    scores, classes = torch.softmax(logits.float(), dim=-1).max(dim=-1)
+    return scores.cpu().numpy(), classes.cpu().numpy()
+
+  #Returns a DataFrame with the best label and its score for each image of the series
+  def predict(self, contents, executor):
+    contents = contents.to_list()
+    batches = [contents[i:i+self.micro_batch_size] for i in range(0, len(contents), self.micro_batch_size)]
+    pending = collections.deque()
+    scores, classes = [], []
+    with torch.inference_mode():
+      for i in range(len(batches)):
+        #Keep the next micro-batches decoding in the background while the model runs
+        while len(pending) <= self.prefetch_batches and i + len(pending) < len(batches):
+          next_batch = batches[i + len(pending)]
+          #Split the decoding of each micro-batch between all the threads
+          chunk = -(-len(next_batch) // self.decode_threads)
+          pending.append([executor.submit(self.decode_batch, next_batch[j:j+chunk]) for j in range(0, len(next_batch), chunk)])
+        images = [image for future in pending.popleft() for image in future.result()]
+        batch_scores, batch_classes = self.infer_batch(images)
+        scores.append(batch_scores)
+        classes.append(batch_classes)
+    if len(batches) == 0:
+      return pd.DataFrame({"score": pd.Series(dtype="float32"), "label": pd.Series(dtype="str")})
+    return pd.DataFrame({"score": np.concatenate(scores), "label": self.labels[np.concatenate(classes)]})
+
+# COMMAND ----------
+
+#Images per model call, decoding threads and arrow batch size (the images of an arrow batch are kept in memory as bytes only)
+inference_conf = {"micro_batch_size": 64, "decode_threads": 4, "prefetch_batches": 2, "arrow_batch_size": 2000}
+#Number of cores available to each task: the model gets all of them, tasks don't compete for the same cores
+task_cpus = int(spark.conf.get("spark.task.cpus", "1"))
+spark.conf.set("spark.sql.execution.arrow.maxRecordsPerBatch", inference_conf["arrow_batch_size"])
+image_processor = getattr(pipeline, "image_processor", None) or pipeline.feature_extractor
+model = pipeline.model
+
+@pandas_udf("struct<score: float, label: string>")
+def detect_damaged_pcb_pipelined(images_iter: Iterator[pd.Series]) -> Iterator[pd.DataFrame]:
+  device = torch.device("cuda:0") if torch.cuda.is_available() else torch.device("cpu")
+  if device.type == "cpu":
+    torch.set_num_threads(task_cpus)
+  classifier = PipelinedImageClassifier(model, image_processor, device, inference_conf["micro_batch_size"], inference_conf["decode_threads"], inference_conf["prefetch_batches"])
+  with ThreadPoolExecutor(max_workers=inference_conf["decode_threads"]) as executor:
+    for images in images_iter:
+      yield classifier.predict(images, executor)
+
+# COMMAND ----------
+
+display(df.select('filename', 'content').withColumn("prediction", detect_damaged_pcb_pipelined("content")))
+
+# COMMAND ----------
+
+# MAGIC %md
+# MAGIC #### Benchmark: images/sec on CPU
+# MAGIC
+# MAGIC Compare the throughput of the pipeline-based UDF with the pipelined version for a few micro-batch sizes and decoding threads. Set `run_inference_benchmark` to `True` to run it (the model is moved to the CPU).
+
+# COMMAND ----------
+
+import time
+
+run_inference_benchmark = False
+
+def benchmark_inference(contents, micro_batch_sizes = [16, 32, 64], decode_threads = [1, 4], repeat = 3):
+  cpu = torch.device("cpu")
+  results = []
+  def images_per_sec(predict):
+    durations = []
+    for _ in range(repeat):
+      start = time.time()
+      predict()
+      durations.append(time.time() - start)
+    #best of the runs, to limit the noise of the other processes
+    return round(len(contents) / min(durations), 1)
+  pipeline.model.to(cpu).eval()
+  with torch.set_grad_enabled(False):
+    results.append(("pipeline", None, None, images_per_sec(lambda: predict_byte_series(contents, pipeline))))
+  for threads in decode_threads:
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+      for batch_size in micro_batch_sizes:
+        classifier = PipelinedImageClassifier(pipeline.model, image_processor, cpu, batch_size, threads)
+        results.append(("pipelined", batch_size, threads, images_per_sec(lambda: classifier.predict(contents, executor))))
+  return pd.DataFrame(results, columns=["method", "micro_batch_size", "decode_threads", "images_per_sec"])
+
+if run_inference_benchmark:
+  benchmark_contents = spark.read.table("training_dataset_augmented").limit(256).toPandas()['content']
+  display(benchmark_inference(benchmark_contents))
+
+# COMMAND ----------
+
 # MAGIC %md 
 # MAGIC ## Realtime inferences with REST API
 # MAGIC
@@ -315,6 +460,33 @@ for i in range(3):
 
 # COMMAND ----------
 
+# MAGIC %md
+# MAGIC ## Load testing the endpoint
+# MAGIC
+# MAGIC Let's send our PCB images one by one with an increasing number of concurrent clients, to size the endpoint for our production line.
+# MAGIC
+# MAGIC The latency percentiles (p50/p95/p99), error rate and throughput of each run are saved in the `load_test_results` table (and each request in `load_test_results_requests`). Set `use_local_stub` to `True` to try the load test offline against a local FastAPI stub endpoint.
+
+# COMMAND ----------
+
+# MAGIC %run ../../../_resources/01-load-test
+
+# COMMAND ----------
+
+run_load_test = False
+use_local_stub = False
+
+if run_load_test:
+  base_url = start_load_test_stub()[1] if use_local_stub else None
+  payloads = [{"dataframe_records": df_input[i:i+1].to_dict(orient='records')} for i in range(len(df_input))]
+  tester = serving_endpoint_load_tester(serving_endpoint_name, base_url=base_url)
+  for concurrency in [1, 4, 16]:
+    summary, requests_df = tester.run(payloads, concurrency=concurrency, duration_sec=60, name=f"pcb_classification concurrency={concurrency}")
+    save_load_test_results(summary, requests_df)
+  display(spark.table("load_test_results").orderBy("timestamp"))
+
+# COMMAND ----------
+
 # MAGIC %md 
 # MAGIC ## Conclusion
 # MAGIC
@@ -82,6 +82,98 @@ else:
 
 # COMMAND ----------
 
+# MAGIC %md
+# MAGIC ## Preprocessed image shards
+# MAGIC
+# MAGIC Decoding the JPEG images is the most expensive step of a training epoch on CPU. `materialize_image_shards` decodes and resizes the images once and saves them as uint8 `.npy` shards in the volume, referenced by a Delta table (one row per image with its shard and position).
+# MAGIC
+# MAGIC `ImageShardDataset` memory-maps the shards: the training only applies cheap augmentations on the uint8 tensors at each epoch.
+
+# COMMAND ----------
+
+import io
+import uuid
+from PIL import Image
+
+def decode_and_resize_image(content, height, width):
+  image = Image.open(io.BytesIO(content))
+  #JPEG only: decode directly at a reduced scale when the image is much bigger than the target size
+  image.draft("RGB", (width, height))
+  return np.asarray(image.convert("RGB").resize((width, height), Image.BILINEAR))
+
+#Decode and resize the images of the source table once, saved as (N, height, width, 3) uint8 .npy shards in shards_folder.
+#The shards are rebuilt only when the source table has a new version or the image size changed.
+def materialize_image_shards(source_table, table_name, shards_folder, height, width, images_per_shard = 1024, reset = False):
+  source_version = spark.sql(f"DESCRIBE HISTORY {source_table} LIMIT 1").first()["version"]
+  shards_version = f"{source_version}-{height}x{width}"
+  if not reset and spark.catalog.tableExists(table_name):
+    properties = {r["key"]: r["value"] for r in spark.sql(f"SHOW TBLPROPERTIES {table_name}").collect()}
+    if properties.get("dbdemos.shards_version") == shards_version:
+      print(f"Image shards of {source_table} already up to date in {table_name}")
+      return spark.table(table_name)
+  #Each version gets its own folder: the previous shards stay valid until the new table is written
+  version_folder = f"{shards_folder}/{uuid.uuid4().hex}"
+  os.makedirs(version_folder, exist_ok=True)
+
+  def write_shards(batches):
+    images, rows = [], []
+    for pdf in batches:
+      for filename, label, content in zip(pdf["filename"], pdf["label"], pdf["content"]):
+        images.append(decode_and_resize_image(content, height, width))
+        rows.append((filename, label, len(rows)))
+        if len(images) == images_per_shard:
+          yield save_image_shard(images, rows, version_folder)
+          images, rows = [], []
+    if len(images) > 0:
+      yield save_image_shard(images, rows, version_folder)
+
+  (spark.table(source_table).select("filename", "label", "content")
+        .mapInPandas(write_shards, "filename STRING, label STRING, shard_index INT, shard_path STRING")
+        .withColumn("height", F.lit(height)).withColumn("width", F.lit(width))
+        .write.mode("overwrite").option("overwriteSchema", "true").saveAsTable(table_name))
+  spark.sql(f"ALTER TABLE {table_name} SET TBLPROPERTIES ('dbdemos.shards_version' = '{shards_version}')")
+  #Cleanup the shards of the previous versions
+  for folder in os.listdir(shards_folder):
+    if f"{shards_folder}/{folder}" != version_folder:
+      dbutils.fs.rm(f"{shards_folder}/{folder}", True)
+  print(f"Image shards of {source_table} saved in {version_folder} and referenced in {table_name}")
+  return spark.table(table_name)
+
+def save_image_shard(images, rows, folder):
+  shard_path = f"{folder}/{uuid.uuid4().hex}.npy"
+  np.save(shard_path, np.stack(images))
+  pdf = pd.DataFrame(rows, columns=["filename", "label", "shard_index"])
+  pdf["shard_path"] = shard_path
+  return pdf
+
+#Torch dataset reading the images from the memory-mapped shards, as CHW uint8 tensors passed to the transform
+class ImageShardDataset(torch.utils.data.Dataset):
+  def __init__(self, index_pdf, transform = None, image_key = "image", label_key = "label"):
+    self.shard_paths = index_pdf["shard_path"].to_list()
+    self.shard_index = index_pdf["shard_index"].to_list()
+    self.labels = index_pdf["label"].to_list()
+    self.transform = transform
+    self.image_key = image_key
+    self.label_key = label_key
+    self.shards = {}
+
+  def __len__(self):
+    return len(self.shard_paths)
+
+  def shard(self, path):
+    #Opened lazily (once per dataloader worker), the pages are read from the disk on demand
+    if path not in self.shards:
+      self.shards[path] = np.load(path, mmap_mode="r")
+    return self.shards[path]
+
+  def __getitem__(self, i):
+    image = torch.from_numpy(np.array(self.shard(self.shard_paths[i])[self.shard_index[i]])).permute(2, 0, 1)
+    if self.transform is not None:
+      image = self.transform(image)
+    return {self.image_key: image, self.label_key: self.labels[i]}
+
+# COMMAND ----------
+
 # MAGIC %md
 # MAGIC ## Example code: lightning dataloader from hugging face dataset example
 # MAGIC
@@ -95,12 +187,25 @@ def define_lightning_dataset_moduel():
   from datasets import Dataset
   class DeltaDataModuleHF(pl.LightningDataModule):
       from torch.utils.data import random_split, DataLoader
-      def __init__(self, df, batch_size: int = 64):
+      def __init__(self, df, batch_size: int = 64, shards_table: str = None):
           super().__init__()
+          self.batch_size = batch_size
+          if shards_table is not None:
+              # Images already decoded and resized with materialize_image_shards: only resize/crop the uint8 tensors
+              transform = tf.Compose([
+                  tf.Resize(256, antialias=True),
+                  tf.CenterCrop(224),
+                  tf.ConvertImageDtype(torch.float),
+                  tf.Normalize(mean=[0.485, 0.456, 0.406], std=[0.229, 0.224, 0.225])
+              ])
+              index = spark.table(shards_table).toPandas().sample(frac=1, random_state=42)
+              train_size = int(len(index) * 0.9)
+              self.train_ds = ImageShardDataset(index[:train_size], transform, image_key='content')
+              self.val_ds = ImageShardDataset(index[train_size:], transform, image_key='content')
+              return
           # For big dataset, you can use IterableDataset.from_spark()
           self.dataset = Dataset.from_spark(df.select('content', 'label'))
           self.splits = self.dataset.train_test_split(test_size=0.1)
-          self.batch_size = batch_size
           self.transform = tf.Compose([
                   tf.Lambda(lambda b: Image.open(io.BytesIO(b)).convert("RGB")),
                   tf.Resize(256),
@@ -456,6 +456,33 @@ print(response.predictions)
 
 # COMMAND ----------
 
+# MAGIC %md
+# MAGIC ## Load testing the endpoint
+# MAGIC
+# MAGIC Real-time churn scoring must stay fast when many applications call the endpoint at the same time. Let's send our test customers with an increasing number of concurrent clients.
+# MAGIC
+# MAGIC The latency percentiles (p50/p95/p99), error rate and throughput of each run are saved in the `load_test_results` table (and each request in `load_test_results_requests`). Set `use_local_stub` to `True` to try the load test offline against a local FastAPI stub endpoint.
+
+# COMMAND ----------
+
+# MAGIC %run ../../../../_resources/01-load-test
+
+# COMMAND ----------
+
+run_load_test = False
+use_local_stub = False
+
+if run_load_test:
+  base_url = start_load_test_stub()[1] if use_local_stub else None
+  payloads = [{"dataframe_records": [record]} for record in dataframe_records]
+  tester = serving_endpoint_load_tester(endpoint_name, base_url=base_url)
+  for concurrency in [1, 4, 16]:
+    summary, requests_df = tester.run(payloads, concurrency=concurrency, duration_sec=60, name=f"churn concurrency={concurrency}")
+    save_load_test_results(summary, requests_df)
+  display(spark.table("load_test_results").orderBy("timestamp"))
+
+# COMMAND ----------
+
 # MAGIC %md
 # MAGIC ### Congratulations! You have deployed a feature and model serving endpoint.
 # MAGIC
@@ -75,26 +75,20 @@ cleanup_folder(output_path+'/ref_accounting_treatment')
 
 # COMMAND ----------
 
-from faker import Faker
+# MAGIC %run ../../../../_resources/02-fake-data
+
+# COMMAND ----------
+
 from collections import OrderedDict 
 import pyspark.sql.functions as F
-import uuid
-import random
+import datetime
 
-fake = Faker()
+set_fake_data_seed(0)
 base_rates = OrderedDict([("ZERO", 0.5),("UKBRBASE", 0.1),("FDTR", 0.3),(None, 0.01)])
-base_rate = F.udf(lambda:fake.random_elements(elements=base_rates, length=1)[0])
-fake_country_code = F.udf(fake.country_code)
-
-fake_date = F.udf(lambda:fake.date_time_between(start_date="-2y", end_date="+0y").strftime("%m-%d-%Y %H:%M:%S"))
-fake_date_future = F.udf(lambda:fake.date_time_between(start_date="+0y", end_date="+2y").strftime("%m-%d-%Y %H:%M:%S"))
-fake_date_current = F.udf(lambda:fake.date_time_this_month().strftime("%m-%d-%Y %H:%M:%S"))
-def random_choice(enum_list):
-  return F.udf(lambda:random.choice(enum_list))
-
-fake.date_time_between(start_date="-10y", end_date="+30y")
+date_format = "MM-dd-yyyy HH:mm:ss"
 
 def generate_transactions(num, folder, file_count, mode):
+  now = datetime.datetime.now()
   (spark.range(0,num)
   .withColumn("acc_fv_change_before_taxes", (F.rand()*1000+100).cast('int'))
   .withColumn("purpose", (F.rand()*1000+100).cast('int'))
@@ -102,34 +96,34 @@ def generate_transactions(num, folder, file_count, mode):
   .withColumn("accounting_treatment_id", (F.rand()*6).cast('int'))
   .withColumn("accrued_interest", (F.rand()*100+100).cast('int'))
   .withColumn("arrears_balance", (F.rand()*100+100).cast('int'))
-  .withColumn("base_rate", base_rate())
+  .withColumn("base_rate", weighted_choice(base_rates))
   .withColumn("behavioral_curve_id", (F.rand()*6).cast('int'))
-  .withColumn("cost_center_code", fake_country_code())
-  .withColumn("country_code", fake_country_code())
-  .withColumn("date", fake_date())
-  .withColumn("end_date", fake_date_future())
-  .withColumn("next_payment_date", fake_date_current())
-  .withColumn("first_payment_date", fake_date_current())
-  .withColumn("last_payment_date", fake_date_current())
+  .withColumn("cost_center_code", fake_pool_udf(lambda f: f.country_code())("id"))
+  .withColumn("country_code", fake_pool_udf(lambda f: f.country_code())("id"))
+  .withColumn("date", fake_date_between(now - datetime.timedelta(days=730), now, date_format))
+  .withColumn("end_date", fake_date_between(now, now + datetime.timedelta(days=730), date_format))
+  .withColumn("next_payment_date", fake_date_this_month(date_format))
+  .withColumn("first_payment_date", fake_date_this_month(date_format))
+  .withColumn("last_payment_date", fake_date_this_month(date_format))
   .withColumn("behavioral_curve_id", (F.rand()*6).cast('int'))
   .withColumn("count", (F.rand()*500).cast('int'))
   .withColumn("arrears_balance", (F.rand()*500).cast('int'))
   .withColumn("balance", (F.rand()*500-30).cast('int'))
   .withColumn("imit_amount", (F.rand()*500).cast('int'))
   .withColumn("minimum_balance_eur", (F.rand()*500).cast('int'))
-  .withColumn("type", random_choice([
+  .withColumn("type", random_element([
           "bonds","call","cd","credit_card","current","depreciation","internet_only","ira",
           "isa","money_market","non_product","deferred","expense","income","intangible","prepaid_card",
           "provision","reserve","suspense","tangible","non_deferred","retail_bonds","savings",
           "time_deposit","vostro","other","amortisation"
-        ])())
-  .withColumn("status", random_choice(["active", "cancelled", "cancelled_payout_agreed", "transactional", "other"])())
-  .withColumn("guarantee_scheme", random_choice(["repo", "covered_bond", "derivative", "none", "other"])())
-  .withColumn("encumbrance_type", random_choice(["be_pf", "bg_dif", "hr_di", "cy_dps", "cz_dif", "dk_gdfi", "ee_dgs", "fi_dgf", "fr_fdg",  "gb_fscs",
+        ]))
+  .withColumn("status", random_element(["active", "cancelled", "cancelled_payout_agreed", "transactional", "other"]))
+  .withColumn("guarantee_scheme", random_element(["repo", "covered_bond", "derivative", "none", "other"]))
+  .withColumn("encumbrance_type", random_element(["be_pf", "bg_dif", "hr_di", "cy_dps", "cz_dif", "dk_gdfi", "ee_dgs", "fi_dgf", "fr_fdg",  "gb_fscs",
                                                  "de_edb", "de_edo", "de_edw", "gr_dgs", "hu_ndif", "ie_dgs", "it_fitd", "lv_dgf", "lt_vi",
                                                  "lu_fgdl", "mt_dcs", "nl_dgs", "pl_bfg", "pt_fgd", "ro_fgdb", "sk_dpf", "si_dgs", "es_fgd",
-                                                 "se_ndo", "us_fdic"])())
-  .withColumn("purpose", random_choice(['admin','annual_bonus_accruals','benefit_in_kind','capital_gain_tax','cash_management','cf_hedge','ci_service',
+                                                 "se_ndo", "us_fdic"]))
+  .withColumn("purpose", random_element(['admin','annual_bonus_accruals','benefit_in_kind','capital_gain_tax','cash_management','cf_hedge','ci_service',
                     'clearing','collateral','commitments','computer_and_it_cost','corporation_tax','credit_card_fee','critical_service','current_account_fee',
                     'custody','employee_stock_option','dealing_revenue','dealing_rev_deriv','dealing_rev_deriv_nse','dealing_rev_fx','dealing_rev_fx_nse',
                     'dealing_rev_sec','dealing_rev_sec_nse','deposit','derivative_fee','dividend','div_from_cis','div_from_money_mkt','donation','employee',
@@ -140,7 +134,7 @@ def generate_transactions(num, folder, file_count, mode):
                     'operational_excess','operational_escrow','other','other_expenditure','other_fs_fee','other_non_fs_fee','other_social_contrib',
                     'other_staff_rem','other_staff_cost','overdraft_fee','own_property','pension','ppe','prime_brokerage','property','recovery',
                     'redundancy_pymt','reference','reg_loss','regular_wages','release','rent','restructuring','retained_earnings','revaluation',
-                    'revenue_reserve','share_plan','staff','system','tax','unsecured_loan_fee','write_off'])())
+                    'revenue_reserve','share_plan','staff','system','tax','unsecured_loan_fee','write_off']))
   ).repartition(file_count).write.format('json').mode(mode).save(folder)
   cleanup_folder(output_path+'/raw_transactions')
   
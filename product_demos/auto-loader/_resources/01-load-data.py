@@ -13,28 +13,29 @@ dbutils.widgets.text("volume_folder", "/dbdemos/raw_data", "Raw data location (s
 
 # COMMAND ----------
 
+# MAGIC %run ../../../_resources/02-fake-data
+
+# COMMAND ----------
+
 from pyspark.sql import functions as F
-from faker import Faker
-from collections import OrderedDict 
-import uuid
-fake = Faker()
-
-fake_firstname = F.udf(fake.first_name)
-fake_lastname = F.udf(fake.last_name)
-fake_email = F.udf(fake.ascii_company_email)
-fake_date = F.udf(lambda:fake.date_time_this_month().strftime("%m-%d-%Y %H:%M:%S"))
-fake_address = F.udf(fake.address)
-fake_id = F.udf(lambda: str(uuid.uuid4()))
-
-df = spark.range(0, 100000)
-#TODO: need to increment ID for each write batch to avoid duplicate. Could get the max reading existing data, zero if none, and add it ti the ID to garantee almost unique ID (doesn't have to be perfect)  
-df = df.withColumn("id", F.monotonically_increasing_id())
-df = df.withColumn("creation_date", fake_date())
-df = df.withColumn("firstname", fake_firstname())
-df = df.withColumn("lastname", fake_lastname())
+
+volume_folder = dbutils.widgets.get("volume_folder")
+set_fake_data_seed(0)
+#Ids allocated from a high-water mark: a new write batch never reuses existing ids
+first_id = allocate_ids(volume_folder+"/_generator_state", "users", 100000)
+df = spark.range(first_id, first_id + 100000)
+df = df.withColumn("creation_date", fake_date_this_month("MM-dd-yyyy HH:mm:ss"))
+df = df.withColumn("firstname", fake_first_name())
+df = df.withColumn("lastname", fake_last_name())
 df = df.withColumn("email", fake_email())
 df = df.withColumn("address", fake_address())
 df = df.withColumn("gender", F.round(F.rand()+0.2))
 df = df.withColumn("age_group", F.round(F.rand()*10))
-volume_folder = dbutils.widgets.get("volume_folder")
 df.repartition(100).write.mode("overwrite").format("json").save(volume_folder+"/user_json")
+
+# COMMAND ----------
+
+#Set to True to compare the rows/sec of the previous Faker UDFs with the vectorized generators
+run_fake_data_benchmark = False
+if run_fake_data_benchmark:
+  display(benchmark_fake_data())
@@ -116,20 +116,16 @@ time.sleep(20)
 
 # DBTITLE 1,And run our MERGE statement the upsert the CDC information in our final table
 #for each batch / incremental update from the raw cdc table, we'll run a MERGE on the silver table
+#The upserter adds the id range of the batch to the MERGE condition so that only the files containing these ids are rewritten (see _resources/00-setup)
+silver_upserter = CDCUpserter("retail_client_silver", exclude_columns=[], optimize_every=100)
 def merge_stream(df, i):
   df.createOrReplaceTempView("clients_cdc_microbatch")
   #First we need to dedup the incoming data based on ID (we can have multiple update of the same row in our incoming data)
   #Then we run the merge (upsert or delete). We could do it with a window and filter on rank() == 1 too
-  df._jdf.sparkSession().sql("""MERGE INTO retail_client_silver target
-                                USING
-                                (select id, name, address, email, operation from 
-                                  (SELECT *, ROW_NUMBER() OVER (PARTITION BY id ORDER BY operation_date DESC) as rank from clients_cdc_microbatch) 
-                                 where rank = 1
-                                ) as source
-                                ON source.id = target.id
-                                WHEN MATCHED AND source.operation = 'DELETE' THEN DELETE
-                                WHEN MATCHED AND source.operation != 'DELETE' THEN UPDATE SET *
-                                WHEN NOT MATCHED AND source.operation != 'DELETE' THEN INSERT *""")
+  updates = df.sparkSession.sql("""select id, name, address, email, operation from 
+                                   (SELECT *, ROW_NUMBER() OVER (PARTITION BY id ORDER BY operation_date DESC) as rank from clients_cdc_microbatch) 
+                                 where rank = 1""")
+  silver_upserter.upsert(updates, i)
   
 spark.readStream \
        .table("clients_cdc") \
@@ -175,6 +171,26 @@ time.sleep(20)
 
 # COMMAND ----------
 
+# MAGIC %md
+# MAGIC ### Load testing the CDC pipeline with a continuous generator (optional)
+# MAGIC
+# MAGIC To benchmark `merge_stream` under a realistic load, the `_resources/02-cdc-continuous-generator` notebook appends batches of APPEND/UPDATE/DELETE operations to the landing folder at a target files/sec rate. New ids come from a high-water mark saved in a Delta state table, and the UPDATE/DELETE operations target existing keys with a hot key skew (a few keys get most of the updates).
+# MAGIC
+# MAGIC Set `run_cdc_load_test` to `True` while the streams above are running, and check the micro-batch durations in the streams dashboards.
+
+# COMMAND ----------
+
+run_cdc_load_test = False
+
+if run_cdc_load_test:
+  path = dbutils.notebook.entry_point.getDbutils().notebook().getContext().notebookPath().get()
+  prefix = path[:path.rfind("/")] + "/_resources/"
+  print(dbutils.notebook.run(prefix+"02-cdc-continuous-generator", 3600, {"raw_data_location": raw_data_location, "batch_count": "20", "rows_per_batch": "10000",
+                                                                          "files_per_batch": "4", "files_per_sec": "1", "hot_key_skew": "3"}))
+  print(f"retail_client_silver now has {spark.table('retail_client_silver').count()} rows")
+
+# COMMAND ----------
+
 # MAGIC %md-sandbox
 # MAGIC ## Gold: capture and propagate Silver modifications downstream
 # MAGIC
@@ -241,6 +257,8 @@ display(changes)
 # MAGIC
 # MAGIC The same logic as the Silver layer must be implemented. Since we now consume the CDF data, we also need to perform a deduplication stage. Let's do it using the python APIs this time for the example.
 # MAGIC
+# MAGIC Instead of running one MERGE per silver commit, the `CDFConsumer` (see `_resources/00-setup`) reads several silver versions at once with `startingVersion`/`endingVersion` and applies them in a single MERGE. It saves the last consumed version in the `cdf_consumer_state` table, along with the lag of the gold table (latest silver version - consumed version).
+# MAGIC
 # MAGIC *Note: Streaming operations with CDC are supported from DBR 8.1+*
 
 # COMMAND ----------
@@ -251,19 +269,18 @@ display(changes)
 
 # COMMAND ----------
 
-from pyspark.sql.window import Window
-from pyspark.sql.functions import dense_rank, regexp_replace, lit, col
+from pyspark.sql.functions import regexp_replace, lit, col
 
-#Function to upsert `microBatchOutputDF` into Delta table using MERGE
+#Function to upsert the CDF changes of one or several silver versions into the gold Delta table using MERGE
 def upsertToDelta(data, batchId):
-  #First we need to deduplicate based on the id and take the most recent update
-  windowSpec = Window.partitionBy("id").orderBy(col("_commit_version").desc())
-  #Select only the first value 
-  #getting the latest change is still needed if the cdc contains multiple time the same id. We can rank over the id and get the most recent _commit_version
-  data_deduplicated = data.withColumn("rank", dense_rank().over(windowSpec)).where("rank = 1 and _change_type!='update_preimage'").drop("_commit_version", "rank")
+  #First we need to deduplicate based on the id and take the most recent change (the update_preimage rows are the values before the update)
+  #max_by keeps the row of the latest _commit_version for each id with a single aggregation, without sorting the changes in a window
+  data = data.where("_change_type != 'update_preimage'")
+  value_columns = [c for c in data.columns if c not in ["id", "_commit_version", "_commit_timestamp"]]
+  data_deduplicated = data.groupBy("id").agg(F.max_by(F.struct(*value_columns), "_commit_version").alias("latest")).select("id", "latest.*")
 
   #Add some data cleaning for the gold layer to remove quotes from the address
-  data_deduplicated = data_deduplicated.withColumn("address", regexp_replace(col("address"), "\"", ""))
+  data_deduplicated = data_deduplicated.withColumn("address", regexp_replace(col("address"), "\"", "")).withColumn("gold_data", lit("Delta CDF is Awesome"))
   
   #run the merge in the gold table directly
   (DeltaTable.forName(spark, "retail_client_gold").alias("target")
@@ -273,17 +290,19 @@ def upsertToDelta(data, batchId):
       .whenNotMatchedInsertAll("source._change_type != 'delete'")
       .execute())
 
+#Instead of one MERGE per silver commit, the consumer coalesces up to 100 silver versions in a single MERGE (fewer small files in the gold table).
+#The last consumed version is saved in the cdf_consumer_state table: a restart continues from there instead of replaying the feed from version 1 (see _resources/00-setup)
+gold_consumer = CDFConsumer("retail_client_silver", "retail_client_gold", upsertToDelta, starting_version=1, min_versions=5, max_delay_sec=60, max_versions=100)
+#Catch up with the silver table, max_versions at a time
+while gold_consumer.consume(force=True) > 0:
+  pass
+print(f"retail_client_gold is {gold_consumer.lag()} versions behind retail_client_silver")
 
-(spark.readStream
-       .option("readChangeData", "true")
-       .option("startingVersion", 1)
-       .table("retail_client_silver")
-       .withColumn("gold_data", lit("Delta CDF is Awesome"))
-      .writeStream
-        .foreachBatch(upsertToDelta)
-      .start())
+#Set to True to keep the gold table in sync while the silver stream runs: the silver table is polled every 10 sec for 10 min
+run_gold_sync = False
 
-time.sleep(20)
+if run_gold_sync:
+  gold_consumer.run(interval_sec=10, timeout_sec=600)
 
 # COMMAND ----------
 
@@ -291,6 +310,11 @@ time.sleep(20)
 
 # COMMAND ----------
 
+# DBTITLE 1,Last consumed silver version and lag of the gold table
+# MAGIC %sql SELECT * FROM cdf_consumer_state
+
+# COMMAND ----------
+
 # MAGIC %md-sandbox
 # MAGIC ### Support for data sharing and Datamesh organization
 # MAGIC <img src="https://github.com/databricks-demos/dbdemos-resources/raw/main/images/product/Delta-Lake-CDC-CDF/delta-cdf-datamesh.png" style="float:right; margin-right: 50px" width="300px" />
@@ -69,10 +69,14 @@ dbutils.fs.rm(f"{raw_data_location}/cdc_full", True)
 
 # DBTITLE 1,Bronze ingestion with autoloader
 
-#Stream using the autoloader to ingest raw files and load them in a delta table
+#Number of rows read by a finished availableNow stream, from the stream listener (recentProgress only keeps the last 100 micro-batches)
+def stream_input_rows(query):
+  return stream_waiter.run_input_rows(query)
+
+#Stream using the autoloader to ingest raw files and load them in a delta table. Returns the number of rows ingested
 def update_bronze_layer(path, bronze_table):
   print(f"ingesting RAW cdc data for {bronze_table} and building bronze layer...")
-  (spark.readStream
+  query = (spark.readStream
           .format("cloudFiles")
           .option("cloudFiles.format", "csv")
           .option("cloudFiles.schemaLocation", f"{raw_data_location}/cdc_full/schemas/{bronze_table}")
@@ -84,12 +88,14 @@ def update_bronze_layer(path, bronze_table):
           .option("checkpointLocation", f"{raw_data_location}/cdc_full/checkpoints/{bronze_table}")
           .option("mergeSchema", "true")
           .trigger(availableNow=True)
-          .table(bronze_table).awaitTermination())
+          .table(bronze_table))
+  query.awaitTermination()
+  return stream_input_rows(query)
 
 # COMMAND ----------
 
 # DBTITLE 1,Silver step: materialize tables with MERGE based on CDC events
-#Stream incrementally loading new data from the bronze CDC table and merging them in the Silver table
+#Stream incrementally loading new data from the bronze CDC table and merging them in the Silver table. Returns the number of CDC events merged
 def update_silver_layer(bronze_table, silver_table):
   print(f"ingesting {bronze_table} update and materializing silver layer using a MERGE statement...")
   #First create the silver table if it doesn't exists:
@@ -98,65 +104,143 @@ def update_silver_layer(bronze_table, silver_table):
     spark.read.table(bronze_table).drop("operation", "operation_date", "_rescued_data", "file_name").write.saveAsTable(silver_table)
 
   #for each batch / incremental update from the raw cdc table, we'll run a MERGE on the silver table
+  #The upserter prunes the MERGE to the id range of the batch and caches the silver columns for the stream (see _resources/00-setup)
+  upserter = CDCUpserter(silver_table, optimize_every=100)
   def merge_stream(updates, i):
     #First we need to deduplicate based on the id and take the most recent update
     windowSpec = Window.partitionBy("id").orderBy(col("operation_date").desc())
     #Select only the first value 
     #getting the latest change is still needed if the cdc contains multiple time the same id. We can rank over the id and get the most recent _commit_version
     updates_deduplicated = updates.withColumn("rank", row_number().over(windowSpec)).where("rank = 1").drop("operation_date", "_rescued_data", "file_name", "rank")
-    #Remove the "operation" field from the column to update in the silver table (we don't want the technical "operation" field to appear here)
-    columns_to_update = {c: f"updates.{c}"  for c in spark.read.table(silver_table).columns if c != "operation"}
-    #run the merge in the silver table directly
-    DeltaTable.forName(spark, silver_table).alias("target") \
-        .merge(updates_deduplicated.alias("updates"), "updates.id = target.id") \
-        .whenMatchedDelete("updates.operation = 'DELETE'") \
-        .whenMatchedUpdate("updates.operation != 'DELETE'", set=columns_to_update) \
-        .whenNotMatchedInsert("updates.operation != 'DELETE'", values=columns_to_update) \
-        .execute()
+    #run the merge in the silver table directly. The "operation" field isn't updated in the silver table (we don't want the technical "operation" field to appear here)
+    upserter.upsert(updates_deduplicated, i)
     
-  (spark.readStream
+  query = (spark.readStream
          .table(bronze_table)
        .writeStream
          .foreachBatch(merge_stream)
          .option("checkpointLocation", f"{raw_data_location}/cdc_full/checkpoints/{silver_table}")
          .trigger(availableNow=True)
-       .start().awaitTermination())
+       .start())
+  query.awaitTermination()
+  return stream_input_rows(query)
 
 # COMMAND ----------
 
 # MAGIC %md ## Starting all the streams
 # MAGIC
 # MAGIC We can now iterate over the folders to start the bronze & silver streams for each table.
+# MAGIC
+# MAGIC With hundreds of tables, the orchestration matters as much as the streams themselves:
+# MAGIC
+# MAGIC - **Largest tables first**: the tables are scheduled by decreasing size of their raw folder. A big table started last would otherwise keep the cluster busy long after all the small ones are done.
+# MAGIC - **Configurable concurrency**: `max_concurrency` tables are refreshed at the same time (by default from the number of cores of the cluster). A worker picks the next table as soon as it is done with its own.
+# MAGIC - **Scheduler pools**: each table runs its Spark jobs in its own fair scheduler pool, so a big table can't starve the others of cores.
+# MAGIC - **Per-table state**: the status, last bronze/silver versions, rows ingested and duration of each table are saved in the `cdc_sync_state` control table. Failed tables are retried up to `max_attempts` times, and `only_failed=True` reruns the failed tables of a previous run without touching the successful ones.
 
 # COMMAND ----------
 
-from concurrent.futures import ThreadPoolExecutor
-from collections import deque
+import uuid
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from delta.tables import *
- 
-def refresh_cdc_table(table):
-  try:
-    #update the bronze table
-    bronze_table = f'bronze_{table}'
-    update_bronze_layer(f"{base_folder}/{table}", bronze_table)
 
-    #then refresh the silver layer
-    silver_table = f'silver_{table}'
-    update_silver_layer(bronze_table, silver_table)
+sync_state_table = "cdc_sync_state"
+sync_state_schema = """table_name STRING, status STRING, bronze_version BIGINT, silver_version BIGINT, bronze_rows BIGINT, silver_rows BIGINT,
+                       source_bytes BIGINT, duration_sec DOUBLE, attempts INT, error STRING, run_id STRING, updated_at TIMESTAMP"""
+
+#Total size of the raw files of a table (recursive), used to schedule the largest tables first
+def source_size(path):
+  return sum(f.size if not f.isDir() else source_size(f.path) for f in dbutils.fs.ls(path))
+
+def table_version(table):
+  return DeltaTable.forName(spark, table).history(1).first()["version"]
+
+def refresh_cdc_table(table, run_id, attempt, source_bytes):
+  bronze_table, silver_table = f'bronze_{table}', f'silver_{table}'
+  #Every Spark job started from this thread (including the stream micro-batches) runs in the table's fair scheduler pool
+  spark.sparkContext.setLocalProperty("spark.scheduler.pool", f"cdc_{table}")
+  start = time.time()
+  try:
+    #update the bronze table, then refresh the silver layer
+    bronze_rows = update_bronze_layer(f"{base_folder}/{table}", bronze_table)
+    silver_rows = update_silver_layer(bronze_table, silver_table)
+    return (table, "SUCCESS", table_version(bronze_table), table_version(silver_table), bronze_rows, silver_rows,
+            source_bytes, round(time.time() - start, 2), attempt, None, run_id, datetime.datetime.now())
   except Exception as e:
-    #prod workload should properly process errors
-    print(f"couldn't properly process {bronze_table}")
-    raise e
-  
+    #The error is saved in the state table, the other tables keep running
+    print(f"couldn't properly process {table} (attempt {attempt}): {e}")
+    return (table, "FAILED", None, None, None, None, source_bytes, round(time.time() - start, 2), attempt, str(e)[:2000], run_id, datetime.datetime.now())
+  finally:
+    spark.sparkContext.setLocalProperty("spark.scheduler.pool", None)
+
+#One row per table. A failed refresh keeps the versions and row counts of the last successful one
+def save_sync_state(results):
+  updates = spark.createDataFrame(results, sync_state_schema)
+  if not spark.catalog.tableExists(sync_state_table):
+    updates.write.saveAsTable(sync_state_table)
+    return
+  DeltaTable.forName(spark, sync_state_table).alias("s") \
+      .merge(updates.alias("u"), "s.table_name = u.table_name") \
+      .whenMatchedUpdate("u.status = 'FAILED'", set={c: f"u.{c}" for c in ["status", "source_bytes", "duration_sec", "attempts", "error", "run_id", "updated_at"]}) \
+      .whenMatchedUpdateAll() \
+      .whenNotMatchedInsertAll() \
+      .execute()
+
+#Tables whose last refresh failed (or never ran)
+def failed_tables(tables):
+  if not spark.catalog.tableExists(sync_state_table):
+    return tables
+  succeeded = {r["table_name"] for r in spark.table(sync_state_table).where("status = 'SUCCESS'").select("table_name").collect()}
+  return [t for t in tables if t not in succeeded]
+
+def sync_cdc_tables(tables, max_concurrency = None, max_attempts = 2, only_failed = False):
+  run_id = uuid.uuid4().hex
+  if only_failed:
+    tables = failed_tables(tables)
+  if len(tables) == 0:
+    print("All the tables are already in sync")
+    return None
+  #Each table stream needs a few cores: by default, 1 table per 4 cores of the cluster
+  max_concurrency = max_concurrency or max(2, spark.sparkContext.defaultParallelism // 4)
+  start = time.time()
+  with ThreadPoolExecutor(max_workers=max_concurrency) as executor:
+    sizes = dict(zip(tables, executor.map(lambda t: source_size(f"{base_folder}/{t}"), tables)))
+    pending, results = sorted(tables, key=lambda t: sizes[t], reverse=True), {}
+    for attempt in range(1, max_attempts + 1):
+      print(f"Refreshing {len(pending)} tables with {max_concurrency} concurrent streams (attempt {attempt}/{max_attempts})...")
+      futures = [executor.submit(refresh_cdc_table, table, run_id, attempt, sizes[table]) for table in pending]
+      attempt_results = [f.result() for f in as_completed(futures)]
+      save_sync_state(attempt_results)
+      results.update({r[0]: r for r in attempt_results})
+      #Only the failed tables are retried, largest first
+      pending = [t for t in pending if results[t][1] == "FAILED"]
+      if len(pending) == 0:
+        break
+  summary = spark.createDataFrame(list(results.values()), sync_state_schema).orderBy(F.col("duration_sec").desc())
+  failed = summary.where("status = 'FAILED'").count()
+  print(f"Database refreshed in {time.time() - start:.0f}s: {len(tables) - failed} tables synchronized, {failed} failed (run {run_id}).")
+  if failed > 0:
+    print("Run sync_cdc_tables(tables, only_failed=True) to retry the failed tables only.")
+  return summary
+
+# COMMAND ----------
+
 #Enable Schema evolution during merges (to capture new columns)  
 spark.conf.set("spark.databricks.delta.schema.autoMerge.enabled", "true")
 
 #iterate over all the tables folders
 tables = [table_path.name[:-1] for table_path in dbutils.fs.ls(base_folder)]
-#Let's start 3 CDC flow at the same time in 3 different thread to speed up ingestion
-with ThreadPoolExecutor(max_workers=3) as executor:
-  deque(executor.map(refresh_cdc_table, tables))
-  print(f"Database refreshed!")
+summary = sync_cdc_tables(tables, max_concurrency=3)
+
+# COMMAND ----------
+
+# DBTITLE 1,Summary report of the run: slowest tables first, with the errors of the failed ones
+display(summary)
+
+# COMMAND ----------
+
+# DBTITLE 1,Current state of each table (last successful versions and row counts)
+# MAGIC %sql select * from cdc_sync_state order by status, duration_sec desc
 
 # COMMAND ----------
 
@@ -172,13 +256,18 @@ with ThreadPoolExecutor(max_workers=3) as executor:
 
 # COMMAND ----------
 
+# DBTITLE 1,Files touched and rewritten by each MERGE (see CDCUpserter in _resources/00-setup)
+# MAGIC %sql select * from cdc_merge_metrics order by timestamp desc
+
+# COMMAND ----------
+
 # MAGIC %md 
 # MAGIC ## What's next
 # MAGIC
 # MAGIC All our silver tables are now materialized using the CDC events! We can then work extra transformation (gold layer) based on your business requirement.
 # MAGIC
 # MAGIC ### Production readiness
-# MAGIC Error and exception in each stream should be properly captured. Multiple strategy exist: send a notification when a table has some error and continue processing the others, stop the entire job, define table "priorities" etc.
+# MAGIC Error and exception in each stream should be properly captured. `sync_cdc_tables` keeps processing the other tables, retries the failed ones and saves their error in the `cdc_sync_state` table. Other strategies exist: send a notification when a table has some error, stop the entire job, define table "priorities" etc.
 # MAGIC
 # MAGIC ### Delta Live Table
 # MAGIC To simplify these operations & error handling, we strongly advise you to run your CDC pipelines on top of Delta Live Table: `dbdemos.install('delta-live-table')`
@@ -22,6 +22,7 @@ volume_folder =  f"/Volumes/{catalog}/{db}/{volume_name}"
 
 import json
 import time
+import datetime
 from pyspark.sql.window import Window
 from pyspark.sql.functions import row_number, col
 import pyspark.sql.functions as F
@@ -31,6 +32,10 @@ raw_data_location = volume_folder
 if reset_all_data or DBDemos.is_folder_empty(raw_data_location+"/user_csv"):
   spark.sql("""DROP TABLE if exists clients_cdc""")
   spark.sql("""DROP TABLE if exists retail_client_silver""")
+  #The gold table and its CDF consumer state are built from the silver table: reset them with it
+  spark.sql("""DROP TABLE if exists retail_client_gold""")
+  if spark.catalog.tableExists("cdf_consumer_state"):
+    spark.sql("""DELETE FROM cdf_consumer_state WHERE source_table = 'retail_client_silver'""")
   #data generation on another notebook to avoid installing libraries (takes a few seconds to setup pip env)
   print(f"Generating data under {raw_data_location} , please wait a few sec...")
   path = dbutils.notebook.entry_point.getDbutils().notebook().getContext().notebookPath().get()
@@ -40,3 +45,172 @@ if reset_all_data or DBDemos.is_folder_empty(raw_data_location+"/user_csv"):
   dbutils.notebook.run(prefix+"01-load-data", 120, {"raw_data_location": raw_data_location})
 else:
   print("data already existing. Run with reset_all_data=true to force a data cleanup for your local demo.")
+
+# COMMAND ----------
+
+from delta.tables import DeltaTable
+from pyspark.sql.types import IntegralType
+
+#Upsert the deduplicated CDC micro-batches (with an `operation` column) in a silver table, without reading and rewriting the files all over the table:
+# - the MERGE condition gets the key range of the batch (min/max, or the non-empty buckets when the keys are spread): Delta skips the files whose key stats don't overlap
+# - the target columns are read once per stream (and refreshed when a new column shows up)
+# - the target can be clustered by key (liquid clustering when possible, ZORDER otherwise) every optimize_every batches
+# - the files scanned, touched and rewritten by each MERGE are saved in the metrics_table
+class CDCUpserter():
+  def __init__(self, target_table, key = "id", exclude_columns = ["operation"], bucket_count = 16, optimize_every = None, cluster_by_key = False, metrics_table = "cdc_merge_metrics"):
+    self.target_table = target_table
+    self.key = key
+    self.exclude_columns = exclude_columns
+    self.bucket_count = bucket_count
+    self.optimize_every = optimize_every
+    self.metrics_table = metrics_table
+    self.columns = None
+    self.liquid_clustering = False
+    #Created upfront: several tables can be upserted concurrently (see 02-CDC-CDF-full-multi-tables)
+    spark.sql(f"""CREATE TABLE IF NOT EXISTS {metrics_table} (target_table STRING, batch_id BIGINT, version BIGINT, key_range STRING, files_before_skipping BIGINT,
+                  files_touched BIGINT, files_rewritten BIGINT, files_added BIGINT, rows_copied BIGINT, duration_sec DOUBLE, timestamp TIMESTAMP)""")
+    if cluster_by_key:
+      try:
+        spark.sql(f"ALTER TABLE {target_table} CLUSTER BY ({key})")
+        self.liquid_clustering = True
+      except Exception as e:
+        print(f"Liquid clustering not available for {target_table}, the table will be z-ordered by {key} instead: {e}")
+
+  def target_columns(self, updates):
+    technical_columns = set(self.exclude_columns + ["operation", "operation_date", "_rescued_data", "file_name"])
+    if self.columns is None or len(set(updates.columns) - set(self.columns) - technical_columns) > 0:
+      self.columns = spark.read.table(self.target_table).columns
+    return {c: f"updates.{c}" for c in self.columns if c not in self.exclude_columns}
+
+  #Key range(s) of the batch. A single [min, max] range when the keys are dense, otherwise one range per contiguous run of non-empty buckets
+  def key_range_condition(self, updates):
+    if not isinstance(updates.schema[self.key].dataType, IntegralType):
+      return None
+    stats = updates.agg(F.min(self.key).alias("min"), F.max(self.key).alias("max"), F.count("*").alias("count")).first()
+    if stats["count"] == 0:
+      return None
+    low, high = stats["min"], stats["max"]
+    if high - low + 1 <= stats["count"] * self.bucket_count:
+      return f"target.{self.key} BETWEEN {low} AND {high}"
+    width = (high - low) // self.bucket_count + 1
+    buckets = sorted([r["bucket"] for r in updates.select(F.floor((F.col(self.key) - low) / width).alias("bucket")).distinct().collect()])
+    ranges, start = [], buckets[0]
+    for previous, bucket in zip(buckets, buckets[1:] + [None]):
+      if bucket != previous + 1:
+        #Clamp the last range to the max key of the batch
+        ranges.append(f"target.{self.key} BETWEEN {low + start * width} AND {min(high, low + (previous + 1) * width - 1)}")
+        start = bucket
+    return "(" + " OR ".join(ranges) + ")"
+
+  def upsert(self, updates, batch_id):
+    updates = updates.persist()
+    try:
+      columns = self.target_columns(updates)
+      range_condition = self.key_range_condition(updates)
+      condition = f"updates.{self.key} = target.{self.key}" + (f" AND {range_condition}" if range_condition else "")
+      start = time.time()
+      target = DeltaTable.forName(spark, self.target_table)
+      target.alias("target") \
+          .merge(updates.alias("updates"), condition) \
+          .whenMatchedDelete("updates.operation = 'DELETE'") \
+          .whenMatchedUpdate("updates.operation != 'DELETE'", set=columns) \
+          .whenNotMatchedInsert("updates.operation != 'DELETE'", values=columns) \
+          .execute()
+      self.save_metrics(target, batch_id, range_condition, time.time() - start)
+    finally:
+      updates.unpersist()
+    if self.optimize_every and batch_id > 0 and batch_id % self.optimize_every == 0:
+      spark.sql(f"OPTIMIZE {self.target_table}" + ("" if self.liquid_clustering else f" ZORDER BY ({self.key})"))
+
+  def save_metrics(self, target, batch_id, range_condition, duration):
+    commit = target.history(1).first()
+    if commit is None or commit["operation"] != "MERGE":
+      return
+    metrics = {k: int(v) for k, v in commit["operationMetrics"].items() if v.isdigit()}
+    row = (self.target_table, batch_id, commit["version"], range_condition, metrics.get("numTargetFilesBeforeSkipping"), metrics.get("numTargetFilesAfterSkipping"),
+           metrics.get("numTargetFilesRemoved"), metrics.get("numTargetFilesAdded"), metrics.get("numTargetRowsCopied"), round(duration, 2), datetime.datetime.now())
+    spark.createDataFrame([row], spark.table(self.metrics_table).schema).write.insertInto(self.metrics_table)
+    print(f"{self.target_table} batch {batch_id}: {row[5]} files touched out of {row[4]}, {row[6]} rewritten, {row[8]} rows copied in {duration:.1f}s")
+
+# COMMAND ----------
+
+#Consume the Change Data Feed of a source table in batches of commit versions, applied with apply_changes(changes, last_version) (ex: a MERGE in a gold table):
+# - several commit versions are coalesced in one call: we wait for min_versions new versions (or max_delay_sec since the last call), and read at most max_versions at once
+# - the last consumed version is saved in the state_table: a restart resumes after it instead of replaying the feed from starting_version
+# - the lag (latest source version - consumed version) is saved in the state_table and returned by lag()
+#apply_changes must be idempotent (ex: MERGE of the latest change per key): the versions are consumed again if it fails before the state is saved
+class CDFConsumer():
+  def __init__(self, source_table, consumer_name, apply_changes, starting_version = 1, min_versions = 1, max_versions = 100, max_delay_sec = 60, state_table = "cdf_consumer_state"):
+    self.source_table = source_table
+    self.consumer_name = consumer_name
+    self.apply_changes = apply_changes
+    self.starting_version = starting_version
+    self.min_versions = min_versions
+    self.max_versions = max_versions
+    self.max_delay_sec = max_delay_sec
+    self.state_table = state_table
+    spark.sql(f"""CREATE TABLE IF NOT EXISTS {state_table} (consumer_name STRING, source_table STRING, source_table_id STRING, consumed_version BIGINT, latest_version BIGINT,
+                  lag_versions BIGINT, versions_consumed BIGINT, duration_sec DOUBLE, updated_at TIMESTAMP)""")
+    if "source_table_id" not in spark.table(state_table).columns:
+      spark.sql(f"ALTER TABLE {state_table} ADD COLUMNS (source_table_id STRING AFTER source_table)")
+
+  #Unique id of the source table: a dropped and recreated table gets a new id (and its versions restart)
+  def source_table_id(self):
+    return spark.sql(f"DESCRIBE DETAIL {self.source_table}").first()["id"]
+
+  #State of the consumer, None if it never consumed the current source table
+  def state(self):
+    state = spark.table(self.state_table).where(F.col("consumer_name") == self.consumer_name).first()
+    if state is not None and state["source_table_id"] != self.source_table_id():
+      print(f"{self.consumer_name}: {self.source_table} has been recreated since the last consumed version {state['consumed_version']}. Consuming it again from version {self.starting_version}")
+      return None
+    return state
+
+  def consumed_version(self):
+    state = self.state()
+    return state["consumed_version"] if state is not None else self.starting_version - 1
+
+  def latest_version(self):
+    return DeltaTable.forName(spark, self.source_table).history(1).first()["version"]
+
+  def lag(self):
+    return self.latest_version() - self.consumed_version()
+
+  #Apply the next batch of versions if there are enough of them (or force=True). Returns the number of versions consumed
+  def consume(self, force = False):
+    state = self.state()
+    consumed = state["consumed_version"] if state is not None else self.starting_version - 1
+    latest = self.latest_version()
+    if latest <= consumed:
+      return 0
+    waited = state is None or (datetime.datetime.now() - state["updated_at"]).total_seconds() >= self.max_delay_sec
+    if latest - consumed < self.min_versions and not waited and not force:
+      print(f"{self.consumer_name}: {latest - consumed} new versions of {self.source_table}, waiting for {self.min_versions} to coalesce them")
+      return 0
+    end = min(latest, consumed + self.max_versions)
+    start = time.time()
+    changes = spark.read.format("delta") \
+                   .option("readChangeFeed", "true") \
+                   .option("startingVersion", consumed + 1) \
+                   .option("endingVersion", end) \
+                   .table(self.source_table)
+    self.apply_changes(changes, end)
+    self.save_state(end, latest, end - consumed, time.time() - start)
+    return end - consumed
+
+  def save_state(self, consumed, latest, versions_consumed, duration):
+    row = (self.consumer_name, self.source_table, self.source_table_id(), consumed, latest, latest - consumed, versions_consumed, round(duration, 2), datetime.datetime.now())
+    state = spark.createDataFrame([row], spark.table(self.state_table).schema)
+    DeltaTable.forName(spark, self.state_table).alias("s") \
+        .merge(state.alias("u"), "s.consumer_name = u.consumer_name") \
+        .whenMatchedUpdateAll() \
+        .whenNotMatchedInsertAll() \
+        .execute()
+    print(f"{self.consumer_name}: versions {consumed - versions_consumed + 1} to {consumed} of {self.source_table} applied in one batch ({duration:.1f}s), lag: {latest - consumed} versions")
+
+  #Poll the source table every interval_sec, for timeout_sec (forever if None)
+  def run(self, interval_sec = 10, timeout_sec = None):
+    start = time.time()
+    while timeout_sec is None or time.time() - start < timeout_sec:
+      self.consume()
+      time.sleep(interval_sec)
@@ -13,48 +13,46 @@ dbutils.widgets.text("raw_data_location", "/demos/retail/delta_cdf", "Raw data l
 
 # COMMAND ----------
 
-from pyspark.sql import functions as F
-from faker import Faker
-from collections import OrderedDict 
-import uuid
-fake = Faker()
+# MAGIC %run ../../../_resources/02-fake-data
+
+# COMMAND ----------
 
-fake_firstname = F.udf(fake.first_name)
-fake_lastname = F.udf(fake.last_name)
-fake_email = F.udf(fake.ascii_company_email)
-fake_date = F.udf(lambda:fake.date_time_this_month().strftime("%Y-%m-%d %H:%M:%S"))
-fake_address = F.udf(lambda: fake.address().replace('\n', ''))
-fake_id = F.udf(lambda: str(uuid.uuid4()))
+from pyspark.sql import functions as F
 
 raw_data_location = dbutils.widgets.get("raw_data_location")
+#High-water mark of the user ids, the continuous generator (02-cdc-continuous-generator) allocates the next ids from it
+generator_state_path = raw_data_location+"/_generator_state"
+#Ids deleted by the CDC events: the continuous generator doesn't UPDATE or DELETE them again
+deleted_keys_path = raw_data_location+"/_generator_state_deleted_keys"
 
-#TODO: need to increment ID for each write batch to avoid duplicate. Could get the max reading existing data, zero if none, and add it ti the ID to garantee almost unique ID (doesn't have to be perfect)  
+#The id column comes from spark.range: contiguous and unique within the batch
 def create_dataset(df):
-  df = df.withColumn("id", F.monotonically_increasing_id())
   df = df.withColumn("operation_date", F.current_timestamp())
-  df = df.withColumn("name", fake_firstname())
+  df = df.withColumn("name", fake_first_name())
   df = df.withColumn("email", fake_email())
-  df = df.withColumn("address", fake_address())
+  df = df.withColumn("address", fake_address(single_line=True))
   return df
 #APPEND
-Faker.seed(0)
-df = spark.range(0, 10000)
+set_fake_data_seed(0)
+first_id = allocate_ids(generator_state_path, "users", 10000)
+df = spark.range(first_id, first_id + 10000)
 df = create_dataset(df)
 df = df.withColumn("operation", F.lit('APPEND'))
 df.repartition(5).write.mode("overwrite").option("header", "true").format("csv").save(raw_data_location+"/user_csv")
 df.repartition(1).write.mode("overwrite").option("header", "true").format("csv").save(raw_data_location+"/cdc/users")
 
 #DELETES
-Faker.seed(0)
-df = spark.range(0, 400).repartition(1)
+set_fake_data_seed(0)
+df = spark.range(first_id, first_id + 400).repartition(1)
 df = create_dataset(df)
 df = df.withColumn("operation", F.lit('DELETE'))
 df.repartition(1).write.mode("append").option("header", "true").format("csv").save(raw_data_location+"/user_csv")
 df.repartition(1).write.mode("append").option("header", "true").format("csv").save(raw_data_location+"/cdc/users")
+df.select("id").write.format("delta").mode("append").save(deleted_keys_path)
 
 #UPDATE
-Faker.seed(2)
-df = spark.range(0, 400).repartition(1)
+set_fake_data_seed(2)
+df = spark.range(first_id, first_id + 400).repartition(1)
 df = create_dataset(df)
 df = df.withColumn("operation", F.lit('UPDATE'))
 df = df.withColumn("id", F.col('id') + 1000)
@@ -69,7 +67,7 @@ def cleanup_folder(path):
     
     
 #Transactions
-Faker.seed(2)
+set_fake_data_seed(2)
 df = spark.range(0, 1000).repartition(1)
 df = df.withColumn("id", F.monotonically_increasing_id())
 df = df.withColumn("operation_date", F.current_timestamp())
@@ -0,0 +1,85 @@
+# Databricks notebook source
+# MAGIC %md
+# MAGIC # Continuous CDC data generator
+# MAGIC Appends batches of APPEND/UPDATE/DELETE operations to the `user_csv` landing folder, to load test the CDC pipeline (`merge_stream`) with a realistic key skew:
+# MAGIC
+# MAGIC - the new ids are allocated from the high-water mark saved in the `_generator_state` Delta table: no duplicate id across batches and runs
+# MAGIC - UPDATE and DELETE operations only target existing keys (below the high-water mark and not deleted yet). The keys follow a power law: `hot_key_skew` = 1 is uniform, higher values concentrate the operations on a few hot keys
+# MAGIC - the batches are written at the target `files_per_sec` rate
+# MAGIC
+# MAGIC Do not run outside of the main notebook (optional load test section of 01-CDC-CDF-simple-pipeline).
+
+# COMMAND ----------
+
+# MAGIC %pip install Faker
+
+# COMMAND ----------
+
+dbutils.widgets.text("raw_data_location", "/demos/retail/delta_cdf", "Raw data location (stating dir)")
+dbutils.widgets.text("batch_count", "10", "Number of batches")
+dbutils.widgets.text("rows_per_batch", "10000", "Operations per batch")
+dbutils.widgets.text("files_per_batch", "4", "Files per batch")
+dbutils.widgets.text("files_per_sec", "1", "Target files/sec")
+dbutils.widgets.text("update_ratio", "0.3", "UPDATE ratio")
+dbutils.widgets.text("delete_ratio", "0.05", "DELETE ratio")
+dbutils.widgets.text("hot_key_skew", "3", "Hot key skew")
+
+# COMMAND ----------
+
+# MAGIC %run ../../../_resources/02-fake-data
+
+# COMMAND ----------
+
+import time
+from pyspark.sql import functions as F
+from delta.tables import DeltaTable
+
+raw_data_location = dbutils.widgets.get("raw_data_location")
+generator_state_path = raw_data_location+"/_generator_state"
+deleted_keys_path = raw_data_location+"/_generator_state_deleted_keys"
+
+#The pools are sampled once, all the batches reuse the same columns
+user_columns = {"name": fake_first_name(), "email": fake_email(), "address": fake_address(single_line=True)}
+
+def with_user_columns(df, operation, delay_sec = 0):
+  #The deletes get a later operation_date: merge_stream keeps the last operation of a key within a micro-batch
+  df = df.withColumn("operation_date", F.current_timestamp() + F.expr(f"INTERVAL {delay_sec} SECONDS"))
+  for name, column in user_columns.items():
+    df = df.withColumn(name, column)
+  return df.withColumn("operation", F.lit(operation)).select("id", "operation_date", "name", "email", "address", "operation")
+
+#Existing keys (below the high-water mark and not deleted), following the hot key distribution. Hot keys can be drawn several times
+def existing_keys(count, high_water_mark, skew, distinct = False):
+  #Oversample to compensate the deleted keys (including the hot ids deleted by the initial load) and the duplicates removed
+  keys = spark.range(0, int(count * (3 if distinct else 2)) + 10).select(skewed_key(high_water_mark, skew).alias("id"))
+  if distinct:
+    keys = keys.dropDuplicates(["id"])
+  if DeltaTable.isDeltaTable(spark, deleted_keys_path):
+    keys = keys.join(spark.read.format("delta").load(deleted_keys_path), "id", "left_anti")
+  return keys.limit(count)
+
+def generate_cdc_batch(rows, files, update_ratio, delete_ratio, skew):
+  updates, deletes = int(rows * update_ratio), int(rows * delete_ratio)
+  appends = rows - updates - deletes
+  first_id = allocate_ids(generator_state_path, "users", appends)
+  df = with_user_columns(spark.range(first_id, first_id + appends), "APPEND")
+  if first_id > 0:
+    df = df.union(with_user_columns(existing_keys(updates, first_id, skew), "UPDATE"))
+    deleted = existing_keys(deletes, first_id, skew, distinct=True).cache()
+    df = df.union(with_user_columns(deleted, "DELETE", delay_sec=1))
+  df.repartition(files).write.mode("append").option("header", "true").format("csv").save(raw_data_location+"/user_csv")
+  if first_id > 0:
+    deleted.write.format("delta").mode("append").save(deleted_keys_path)
+    deleted.unpersist()
+
+batch_count, rows_per_batch, files_per_batch = int(dbutils.widgets.get("batch_count")), int(dbutils.widgets.get("rows_per_batch")), int(dbutils.widgets.get("files_per_batch"))
+files_per_sec = float(dbutils.widgets.get("files_per_sec"))
+start = time.time()
+for i in range(batch_count):
+  generate_cdc_batch(rows_per_batch, files_per_batch, float(dbutils.widgets.get("update_ratio")), float(dbutils.widgets.get("delete_ratio")), float(dbutils.widgets.get("hot_key_skew")))
+  #Wait to stay at the target files/sec rate
+  time.sleep(max(0, start + (i + 1) * files_per_batch / files_per_sec - time.time()))
+elapsed = time.time() - start
+result = f"{batch_count} batches, {batch_count * files_per_batch / elapsed:.2f} files/sec, {batch_count * rows_per_batch / elapsed:.0f} operations/sec"
+print(result)
+dbutils.notebook.exit(result)
@@ -1,5 +1,15 @@
 # Databricks notebook source
 dbutils.widgets.text("produce_time_sec", "600", "How long we'll produce data (sec)")
+#demo: a few users browsing the website. load_test: high-rate generator (see the end of the notebook)
+dbutils.widgets.dropdown("producer_mode", "demo", ["demo", "load_test"], "Producer mode")
+#kafka: send to the dbdemos-sessions topic. delta/file: write the same messages to a Delta table or json files, to benchmark without kafka
+dbutils.widgets.dropdown("sink", "kafka", ["kafka", "delta", "file"], "Sink")
+dbutils.widgets.text("events_per_sec", "100000", "Load test: target events/sec")
+dbutils.widgets.text("producer_threads", "8", "Load test: producer threads")
+dbutils.widgets.text("out_of_order_ratio", "0.1", "Load test: out-of-order events ratio")
+dbutils.widgets.text("duplicate_ratio", "0.04", "Load test: duplicate events ratio")
+dbutils.widgets.text("delta_sink_table", "events_raw_load_test", "Load test: delta sink table")
+dbutils.widgets.text("file_sink_path", "/dbfs/tmp/dbdemos/sessions/load_test", "Load test: file sink folder")
 
 # COMMAND ----------
 
@@ -21,8 +31,18 @@ dbutils.widgets.text("produce_time_sec", "600", "How long we'll produce data (se
 
 kafka_bootstrap_servers_tls = "b-1.oetrta.kpgu3r.c1.kafka.us-west-2.amazonaws.com:9094,b-3.oetrta.kpgu3r.c1.kafka.us-west-2.amazonaws.com:9094,b-2.oetrta.kpgu3r.c1.kafka.us-west-2.amazonaws.com:9094"
 
-from kafka import KafkaProducer
-producer = KafkaProducer(security_protocol="SSL", bootstrap_servers=kafka_bootstrap_servers_tls.split(","), value_serializer=lambda x: x.encode('utf-8'))
+producer_mode = dbutils.widgets.get("producer_mode")
+sink = dbutils.widgets.get("sink")
+
+#the delta/file sinks are only available in load_test mode
+if sink == "kafka" or producer_mode == "demo":
+  from kafka import KafkaProducer
+  if producer_mode == "load_test":
+    #Let the producer buffer and batch the messages instead of sending them one by one
+    producer = KafkaProducer(security_protocol="SSL", bootstrap_servers=kafka_bootstrap_servers_tls.split(","), value_serializer=lambda x: x.encode('utf-8'),
+                             linger_ms=50, batch_size=1024*1024, buffer_memory=256*1024*1024, acks=1)
+  else:
+    producer = KafkaProducer(security_protocol="SSL", bootstrap_servers=kafka_bootstrap_servers_tls.split(","), value_serializer=lambda x: x.encode('utf-8'))
 
 # COMMAND ----------
 
@@ -69,7 +89,7 @@ user_creation_rate = 2
 #Max duration a user stays in the website (after this time user will stop producing events)
 user_max_duration_time = 120
 
-for _ in range(produce_time_sec):
+for _ in range(produce_time_sec if producer_mode == "demo" else 0):
   #print(len(users))
   for id in list(users.keys()):
     user = users[id]
@@ -97,3 +117,107 @@ for _ in range(produce_time_sec):
 
 print("closed")
 
+# COMMAND ----------
+
+# MAGIC %md
+# MAGIC ## High-rate load generator
+# MAGIC
+# MAGIC With `producer_mode=load_test`, this generator sustains 100k+ events/sec to load test the sessionization pipeline:
+# MAGIC
+# MAGIC - URIs, platforms and actions are drawn from precomputed pools with NumPy (no Faker call per event)
+# MAGIC - Event timestamps follow NumPy-drawn (exponential) inter-arrival times, with a configurable ratio of out-of-order (late) events and duplicates
+# MAGIC - Events are generated and serialized by batch, and sent by multiple producer threads with kafka batching (linger/batch size)
+# MAGIC - With the `delta` or `file` sink, the same messages are written to a Delta table (`key`, `value` as in `events_raw`) or json files, so the pipeline can be benchmarked without kafka
+
+# COMMAND ----------
+
+import numpy as np
+import pandas as pd
+import threading
+import os
+
+events_per_sec = int(dbutils.widgets.get("events_per_sec"))
+producer_threads = int(dbutils.widgets.get("producer_threads"))
+out_of_order_ratio = float(dbutils.widgets.get("out_of_order_ratio"))
+duplicate_ratio = float(dbutils.widgets.get("duplicate_ratio"))
+#Events generated and sent at once by each thread
+load_test_batch_size = 10000
+#Active users the events are spread over, and max delay of the out-of-order events
+load_test_users = 100000
+max_out_of_order_delay_sec = 60
+
+def normalized_pool(weights):
+  values = list(weights.keys())
+  p = np.array(list(weights.values()))
+  return np.array(values, dtype=object), p / p.sum()
+
+platform_pool, platform_p = normalized_pool(platform)
+action_pool, action_p = normalized_pool(action_type)
+uri_pool = np.array([re.sub(r'https?:\/\/.*?\/', "https://databricks.com/", fake.uri()) for _ in range(10000)], dtype=object)
+user_pool = np.array([str(uuid.uuid4()) for _ in range(load_test_users)], dtype=object)
+
+def generate_event_batch(rng, start_time, rate):
+  #Exponential inter-arrival times for a poisson stream of events at the given rate
+  clock = start_time + np.cumsum(rng.exponential(1 / rate, load_test_batch_size))
+  #Only the emitted event dates are shifted back: the next batch starts from the un-shifted clock
+  late = rng.random(load_test_batch_size) < out_of_order_ratio
+  event_times = np.where(late, clock - rng.uniform(0, max_out_of_order_delay_sec, load_test_batch_size), clock)
+  #event id with 2% of null event to have some errors/cleanup
+  raw_ids = rng.bytes(16 * load_test_batch_size)
+  event_ids = np.where(rng.random(load_test_batch_size) < 0.98, [str(uuid.UUID(bytes=raw_ids[i:i+16], version=4)) for i in range(0, len(raw_ids), 16)], None)
+  events = pd.DataFrame({"user_id": rng.choice(user_pool, load_test_batch_size),
+                         "platform": rng.choice(platform_pool, load_test_batch_size, p=platform_p),
+                         "event_id": event_ids,
+                         "event_date": event_times.astype(np.int64),
+                         "action": rng.choice(action_pool, load_test_batch_size, p=action_p),
+                         "uri": rng.choice(uri_pool, load_test_batch_size)})
+  #Serialize the whole batch at once
+  messages = np.array(events.to_json(orient="records", lines=True).splitlines(), dtype=object)
+  duplicates = messages[rng.random(load_test_batch_size) < duplicate_ratio]
+  return np.concatenate([messages, duplicates]), late.sum(), len(duplicates), clock[-1]
+
+def send_batch(messages, thread_id, batch_id):
+  if sink == "kafka":
+    for m in messages:
+      producer.send('dbdemos-sessions', value=m)
+  elif sink == "delta":
+    spark.createDataFrame(pd.DataFrame({"key": None, "value": messages}), "key string, value string") \
+         .write.mode("append").saveAsTable(dbutils.widgets.get("delta_sink_table"))
+  else:
+    with open(f"{dbutils.widgets.get('file_sink_path')}/events-{thread_id}-{batch_id}.json", "w") as f:
+      f.write("\n".join(messages))
+
+def run_producer_thread(thread_id, stats):
+  rng = np.random.default_rng(thread_id)
+  rate = events_per_sec / producer_threads
+  start = time.time()
+  next_time = start
+  batch_id = 0
+  while time.time() - start < produce_time_sec:
+    messages, late, duplicates, next_time = generate_event_batch(rng, next_time, rate)
+    send_batch(messages, thread_id, batch_id)
+    batch_id += 1
+    with stats["lock"]:
+      stats["events"] += len(messages)
+      stats["late"] += late
+      stats["duplicates"] += duplicates
+    #Throttle to the target rate: wait until the last event of the batch is due
+    time.sleep(max(0, next_time - time.time()))
+
+if producer_mode == "load_test":
+  if sink == "file":
+    os.makedirs(dbutils.widgets.get("file_sink_path"), exist_ok=True)
+  stats = {"lock": threading.Lock(), "events": 0, "late": 0, "duplicates": 0}
+  start = time.time()
+  threads = [threading.Thread(target=run_producer_thread, args=(i, stats)) for i in range(producer_threads)]
+  for t in threads:
+    t.start()
+  for t in threads:
+    t.join()
+  if sink == "kafka":
+    producer.flush()
+  duration = time.time() - start
+  print(f"Sent {stats['events']} events to {sink} in {duration:.1f}s: {stats['events'] / duration:.0f} events/sec (target: {events_per_sec})")
+  unique_events = stats['events'] - stats['duplicates']
+  print(f"Out-of-order ratio: {out_of_order_ratio} configured, {stats['late'] / unique_events:.3f} produced")
+  print(f"Duplicate ratio: {duplicate_ratio} configured, {stats['duplicates'] / unique_events:.3f} produced")